@@ -1,9 +1,19 @@
+import fcntl
 import logging
+import os
 
-from .sql import models, engine
-from .config import settings
+from .sql import migrations, models, engine
+from .config import settings, worker_settings
 
-models.Base.metadata.create_all(bind=engine)
+# the workers of the server import it at the same time, so the tables are created by one
+# of them at a time. The tables of an older version are upgraded before (see
+# `migrations.upgrade`), and the app does not start if they could not be.
+os.makedirs(worker_settings.directory, exist_ok=True)
+with open(os.path.join(worker_settings.directory, "schema.lock"), "w") as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    with engine.begin() as connection:
+        migrations.upgrade(connection)
+    models.Base.metadata.create_all(bind=engine)
 
 logging_level = logging.DEBUG if settings.debug else logging.INFO
 logging.basicConfig(level=logging_level)
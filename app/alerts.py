@@ -0,0 +1,190 @@
+import collections
+import logging
+import math
+import operator
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+from .broadcast import ALERT, alert_hub, share
+from .sql import ReadSessionLocal, SessionLocal, run_db, run_write
+from .sql import crud, schemas
+from .sql.ring import to_micros
+
+
+OPERATORS = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le}
+
+
+class ThresholdEvaluator:
+    """Evaluates the value of the field itself"""
+    def __init__(self, rule: schemas.AlertRule):
+        pass
+
+    def update(self, seconds: float, value: float) -> Optional[float]:
+        return value
+
+
+class ZScoreEvaluator:
+    """Evaluates how many standard deviations the value is away from the mean. The mean
+    and variance are exponentially weighted moving ones, so only two numbers are kept
+    and they follow a slow change of the usage. The value is scored against the state
+    before it, then it's added to the state."""
+    def __init__(self, rule: schemas.AlertRule):
+        self.alpha = rule.alpha
+        self.min_samples = rule.min_samples
+        self.count = 0
+        self.mean = 0.0
+        self.variance = 0.0
+
+    def update(self, seconds: float, value: float) -> Optional[float]:
+        self.count += 1
+        if self.count == 1:
+            self.mean = value
+            return None
+        diff = value - self.mean
+        score = None
+        if self.count > self.min_samples:
+            if self.variance > 0:
+                score = diff / math.sqrt(self.variance)
+            else:
+                score = 0.0 if diff == 0 else math.copysign(math.inf, diff)
+        increment = self.alpha * diff
+        self.mean += increment
+        self.variance = (1 - self.alpha) * (self.variance + diff * increment)
+        return score
+
+
+class RateEvaluator:
+    """Evaluates the change of the value per second since the oldest sample in the
+    window. Each sample is added and removed from the window once, so it's amortized
+    O(1)."""
+    def __init__(self, rule: schemas.AlertRule):
+        self.window = rule.window
+        self.samples: Deque[Tuple[float, float]] = collections.deque()
+
+    def update(self, seconds: float, value: float) -> Optional[float]:
+        while self.samples and seconds - self.samples[0][0] > self.window:
+            self.samples.popleft()
+        self.samples.append((seconds, value))
+        oldest_seconds, oldest_value = self.samples[0]
+        if seconds == oldest_seconds:
+            return None
+        return (value - oldest_value) / (seconds - oldest_seconds)
+
+
+EVALUATORS = {"threshold": ThresholdEvaluator,
+              "zscore": ZScoreEvaluator,
+              "rate": RateEvaluator}
+
+
+class _RuleState:
+    """The rolling state of a rule for a host"""
+    def __init__(self, rule: schemas.AlertRule):
+        self.evaluator = EVALUATORS[rule.kind](rule)
+        self.firing = False
+        self.last_seconds: Optional[float] = None
+
+
+class AlertEngine:
+    """Evaluates the alert rules on each new sample and returns the changes of their
+    states as events. Each rule keeps a small rolling state for each host (see the
+    evaluators), so a sample costs O(1) for each rule and no sample is read again.
+
+    A rule fires when its value passes the threshold and it's resolved when the value
+    does not pass it anymore, so an event is only made for a change. The state of a rule
+    is reset when it's changed. It should be used from the thread of the event loop.
+    """
+    def __init__(self):
+        self.rules: Dict[int, schemas.AlertRule] = {}
+        self._states: Dict[Tuple[int, str], _RuleState] = {}
+
+    def load(self, rules: Iterable[schemas.AlertRule]):
+        self.rules = {}
+        self._states.clear()
+        for rule in rules:
+            self.set_rule(rule)
+
+    def set_rule(self, rule: schemas.AlertRule):
+        self.remove_rule(rule.id)
+        if rule.enabled:
+            self.rules[rule.id] = rule
+
+    def remove_rule(self, rule_id: int):
+        self.rules.pop(rule_id, None)
+        for key in [key for key in self._states if key[0] == rule_id]:
+            del self._states[key]
+
+    def evaluate(self, sample: schemas.MemCreate) -> List[schemas.AlertEventCreate]:
+        events = []
+        seconds = to_micros(sample.time) / 1e6
+        for rule in self.rules.values():
+            if rule.host is not None and rule.host != sample.host:
+                continue
+            value = getattr(sample, rule.field)
+            if value is None:
+                continue
+            state = self._states.get((rule.id, sample.host))
+            if state is None:
+                state = self._states[rule.id, sample.host] = _RuleState(rule)
+            elif seconds <= state.last_seconds:
+                # an old sample (e.g. of a late batch) could not be evaluated in order
+                continue
+            state.last_seconds = seconds
+            score = state.evaluator.update(seconds, value)
+            firing = score is not None and OPERATORS[rule.operator](score, rule.threshold)
+            if firing != state.firing:
+                state.firing = firing
+                events.append(schemas.AlertEventCreate(
+                    rule_id=rule.id, host=sample.host, time=sample.time,
+                    state="firing" if firing else "resolved",
+                    value=value if score is None else score))
+        return events
+
+
+alert_engine = AlertEngine()
+
+def _load_rules() -> List[schemas.AlertRule]:
+    with ReadSessionLocal() as db:
+        return [schemas.AlertRule.model_validate(rule)
+                for rule in crud.get_alert_rules(db)]
+
+def _store_events(events: List[schemas.AlertEventCreate]) -> List[schemas.AlertEvent]:
+    with SessionLocal() as db:
+        return [schemas.AlertEvent.model_validate(event)
+                for event in crud.create_alert_events(db, events)]
+
+def _load_rule(rule_id: int) -> Optional[schemas.AlertRule]:
+    with ReadSessionLocal() as db:
+        rule = crud.get_alert_rule(db, rule_id)
+        return None if rule is None else schemas.AlertRule.model_validate(rule)
+
+async def reload_alert_rule(rule_id: int):
+    """Reads a rule which is changed by another worker into `alert_engine`"""
+    rule = await run_db(_load_rule, rule_id)
+    if rule is None:
+        alert_engine.remove_rule(rule_id)
+    else:
+        alert_engine.set_rule(rule)
+
+async def load_alert_rules():
+    """Loads the stored rules into `alert_engine`"""
+    alert_engine.load(await run_db(_load_rules))
+
+async def evaluate_alerts(samples: Iterable[schemas.MemCreate]):
+    """Evaluates the rules on new samples (in order of time), then stores the events and
+    publishes them to `alert_hub`"""
+    events = []
+    for sample in samples:
+        events += alert_engine.evaluate(sample)
+    if not events:
+        return
+    try:
+        stored = await run_write(_store_events, events)
+    except Exception:
+        # the sampler should not be stopped by database
+        logging.exception("Storing the alert events is failed.")
+        return
+    for event in stored:
+        logging.warning(f"alert: rule {event.rule_id} is {event.state} on {event.host} "
+                        f"({event.value})")
+        message = event.model_dump_json()
+        alert_hub.publish(message, topic=event.host)
+        share(ALERT, message)
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Callable, Hashable, Iterator, List, Optional, Set
+
+from .config import stream_settings
+
+
+class Subscriber:
+    """A subscriber of `BroadcastHub` with a bounded queue. When a slow subscriber's
+    queue is full, its oldest message is dropped, so publishing never waits for it."""
+    def __init__(self, queue_size: int, topic: Optional[Hashable] = None):
+        # it only gets the messages of the topic, or all of them if it's None
+        self.topic = topic
+        self.queue = deque(maxlen=queue_size)
+        self.event = asyncio.Event()
+        # the number of messages which are dropped because the queue was full
+        self.dropped = 0
+
+    def put(self, message: Any):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(message)
+        self.event.set()
+
+    async def get(self) -> Any:
+        """Waits for the next message. Cancelling it does not lose any message."""
+        while not self.queue:
+            self.event.clear()
+            await self.event.wait()
+        return self.queue.popleft()
+
+
+class BroadcastHub:
+    """Fans out each published message to all the subscribers in the process.
+
+    The message is passed as it is, so a producer could serialize it once for all the
+    subscribers. It should be used from the thread of the event loop.
+    """
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.subscribers: Set[Subscriber] = set()
+
+    def __len__(self) -> int:
+        return len(self.subscribers)
+
+    @contextmanager
+    def subscribe(self, topic: Optional[Hashable] = None) -> Iterator[Subscriber]:
+        """Adds a subscriber of a topic (or all of them) until the end of the context"""
+        subscriber = Subscriber(self.queue_size, topic)
+        self.subscribers.add(subscriber)
+        try:
+            yield subscriber
+        finally:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, message: Any, topic: Optional[Hashable] = None):
+        for subscriber in self.subscribers:
+            if subscriber.topic is None or subscriber.topic == topic:
+                subscriber.put(message)
+
+    async def events(self, topic: Optional[Hashable] = None) -> AsyncIterator[str]:
+        """Yields each message of a topic (or all of them) as a Server-Sent Event, and
+        a comment as keep-alive when there is no message for `keepalive` of
+        `stream_settings`. Its subscriber is removed when it's closed, e.g. when the
+        client is disconnected."""
+        keepalive = stream_settings.keepalive.total_seconds()
+        with self.subscribe(topic) as subscriber:
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {message}\n\n"
+
+
+class WorkerChannel:
+    """Sends messages to the other workers of the server on this machine by Unix datagram
+    sockets. Each worker binds a socket in a shared directory and a message is sent to
+    all the other sockets in it, so a worker could join or leave at any time. The socket
+    of a worker which is gone is removed by the first sender which finds it.
+
+    A message is a kind (one byte) and a payload. The kinds are `SAMPLE`, `ALERT` and
+    `RULE`. Sending never waits: a message for a worker whose socket buffer is full is
+    dropped, like the one of a slow `Subscriber`.
+    """
+    # the directory is listed at most once in this time (in seconds)
+    PEERS_TTL = 1.0
+
+    def __init__(self, path: str, name: Optional[str] = None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.address = os.path.join(path, f"{name or os.getpid()}.sock")
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.address)
+        self.socket.setblocking(False)
+        self._peers: List[str] = []
+        self._peers_time = -self.PEERS_TTL
+        self._reading = False
+        # the number of messages which are not delivered because a worker was slow
+        self.dropped = 0
+
+    def peers(self) -> List[str]:
+        """Returns the addresses of the sockets of the other workers"""
+        now = time.monotonic()
+        if now - self._peers_time >= self.PEERS_TTL:
+            self._peers = [os.path.join(self.path, name) for name in os.listdir(self.path)
+                           if name.endswith(".sock")
+                           and os.path.join(self.path, name) != self.address]
+            self._peers_time = now
+        return self._peers
+
+    def send(self, kind: bytes, payload: bytes):
+        data = kind + payload
+        for peer in self.peers():
+            try:
+                self.socket.sendto(data, peer)
+            except BlockingIOError:
+                self.dropped += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # its worker is gone
+                try:
+                    os.unlink(peer)
+                except OSError:
+                    pass
+                self._peers_time = -self.PEERS_TTL
+            except OSError:
+                logging.warning(f"Sending a message to {peer} is failed.", exc_info=True)
+
+    def start(self, handler: Callable[[bytes, bytes], None]):
+        """Calls the handler by the kind and payload of each received message in the
+        event loop"""
+        asyncio.get_running_loop().add_reader(self.socket.fileno(), self._receive, handler)
+        self._reading = True
+
+    def _receive(self, handler: Callable[[bytes, bytes], None]):
+        while True:
+            try:
+                data = self.socket.recv(1 << 16)
+            except BlockingIOError:
+                return
+            try:
+                handler(data[:1], data[1:])
+            except Exception:
+                logging.exception("Handling a message of another worker is failed.")
+
+    def close(self):
+        if self._reading:
+            asyncio.get_running_loop().remove_reader(self.socket.fileno())
+            self._reading = False
+        self.socket.close()
+        try:
+            os.unlink(self.address)
+        except OSError:
+            pass
+
+
+# the kinds of the messages of `WorkerChannel`: a memory sample, an alert event and the
+# id of a changed alert rule
+SAMPLE = b"M"
+ALERT = b"A"
+RULE = b"R"
+
+# the channel of this worker. It's only opened by the startup of the app.
+_worker_channel: Optional[WorkerChannel] = None
+
+def open_worker_channel(path: str, handler: Callable[[bytes, bytes], None]
+) -> WorkerChannel:
+    global _worker_channel
+    _worker_channel = WorkerChannel(path)
+    _worker_channel.start(handler)
+    return _worker_channel
+
+def close_worker_channel():
+    global _worker_channel
+    if _worker_channel is not None:
+        _worker_channel.close()
+        _worker_channel = None
+
+def share(kind: bytes, message: str):
+    """Sends a message to the other workers if the channel is open"""
+    if _worker_channel is not None:
+        _worker_channel.send(kind, message.encode())
+
+
+# the hub of the new memory samples as JSON whose topics are their hosts
+memory_hub = BroadcastHub(stream_settings.queue_size)
+# the hub of the alert events as JSON whose topics are their hosts
+alert_hub = BroadcastHub(stream_settings.queue_size)
@@ -0,0 +1,146 @@
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from .config import cache_settings
+from .sql import schemas
+
+
+class TTLCache:
+    """A bounded LRU cache whose entries expire after `ttl` seconds or at their own
+    expiry time, whichever comes first. Expiry times are UNIX timestamps."""
+    def __init__(self, capacity: int, ttl: float):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # the entries could be invalidated from the database threads
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expire_at, value = entry
+                if expire_at > time.time():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key: Hashable, value: Any, expire_at: Optional[float] = None):
+        """Adds an entry. It never lives after `expire_at` if it's passed."""
+        if self.capacity == 0:
+            return
+        expire = time.time() + self.ttl
+        if expire_at is not None:
+            expire = min(expire, expire_at)
+        with self.lock:
+            self.entries[key] = (expire, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def invalidate_if(self, predicate: Callable[[Any], bool]):
+        """Removes the entries whose value matches the predicate"""
+        with self.lock:
+            for key in [key for key, (_, value) in self.entries.items()
+                        if predicate(value)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> schemas.CacheStats:
+        return schemas.CacheStats(hits=self.hits,
+                                  misses=self.misses,
+                                  size=len(self.entries),
+                                  capacity=self.capacity)
+
+
+class ResponseCache:
+    """Keeps serialized responses per query shape until the data changes.
+
+    The data is split into scopes (hosts) and each scope has a version, which is the time
+    of its latest sample. Setting a new version drops the responses of the scope, and an
+    entry is only stored if the version has not changed since its data was read.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.versions: Dict[Hashable, int] = {}
+        self.entries: "OrderedDict[Tuple[Hashable, Hashable], bytes]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, scope: Hashable) -> Optional[int]:
+        return self.versions.get(scope)
+
+    def invalidate(self, scope: Hashable, version: int):
+        """Sets a new version of the data of a scope and drops its old responses"""
+        self.versions[scope] = version
+        for key in [key for key in self.entries if key[0] == scope]:
+            del self.entries[key]
+
+    def etag(self, scope: Hashable, key: Hashable) -> Optional[str]:
+        """Returns the ETag of a query shape in the current version"""
+        version = self.versions.get(scope)
+        if version is None:
+            return None
+        return f'"{version:x}-{zlib.crc32(repr((scope, key)).encode()):x}"'
+
+    def get(self, scope: Hashable, key: Hashable) -> Optional[bytes]:
+        body = self.entries.get((scope, key))
+        if body is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end((scope, key))
+        self.hits += 1
+        return body
+
+    def set(self, scope: Hashable, key: Hashable, body: bytes, version: Optional[int]):
+        """Stores a response which is made from the data of the version"""
+        if (version is None or version != self.versions.get(scope)
+                or self.capacity == 0):
+            return
+        self.entries[(scope, key)] = body
+        self.entries.move_to_end((scope, key))
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> schemas.CacheStats:
+        return schemas.CacheStats(hits=self.hits,
+                                  misses=self.misses,
+                                  size=len(self.entries),
+                                  capacity=self.capacity)
+
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Checks an If-None-Match header matches the ETag or not"""
+    if if_none_match is None or etag is None:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+# the resolved users of tokens
+user_cache = TTLCache(cache_settings.user_cache_size,
+                      cache_settings.user_cache_ttl.total_seconds())
+
+def invalidate_user(username: str):
+    """Removes the cached tokens of a user, e.g. when it's changed"""
+    user_cache.invalidate_if(lambda user: user.username == username)
+
+# the serialized responses of the memory reads
+response_cache = ResponseCache(cache_settings.response_cache_size)
@@ -1,5 +1,6 @@
 import datetime
-from typing import Dict
+import socket
+from typing import Dict, List, Optional
 
 from pydantic_settings import BaseSettings
 
@@ -17,6 +18,28 @@ class AppSettings(BaseSettings):
     class Sql(BaseSettings):
         """Configs to use in sql"""
         url: str = "sqlite:///./sql_app.sqlite"
+        # the number of connections which are kept in the pool (of the readers for SQLite)
+        pool_size: int = 5
+        # the number of connections which could be opened more than pool_size
+        max_overflow: int = 10
+        # seconds to wait for a connection of the pool
+        pool_timeout: float = 30
+        # the number of threads which run the blocking database calls. The writes run in
+        # one more thread, so SQLite has a single writer.
+        threads: int = 8
+        # the pragmas of each SQLite connection (see https://www.sqlite.org/pragma.html).
+        # In WAL mode, the readers do not wait for the writer and the writer does not
+        # wait for them.
+        journal_mode: str = "WAL"
+        # NORMAL only syncs the WAL at checkpoints, not on each commit. The last commits
+        # could be lost by a power failure, but the database is never corrupted.
+        synchronous: str = "NORMAL"
+        # the page cache of each connection, in KiB if it's negative or in pages
+        cache_size: int = -16000
+        # the number of bytes of the file which are read by memory mapping
+        mmap_size: int = 256 * 1024 * 1024
+        # time to wait for a lock of another process (e.g. another worker)
+        busy_timeout: datetime.timedelta = datetime.timedelta(seconds=5)
         class Session(BaseSettings):
             autocommit: bool = False
             autoflush: bool = False
@@ -30,14 +53,145 @@ class AppSettings(BaseSettings):
         # time in which is valid
         access_token_expire_minutes: datetime.timedelta = datetime.timedelta(minutes=30)
 
+    class Writer(BaseSettings):
+        """Configs to use in buffering memory samples before writing them to database"""
+        # the number of buffered samples which are written by one insert
+        flush_size: int = 100
+        # the max time that a sample could wait in the buffer
+        flush_interval: datetime.timedelta = datetime.timedelta(minutes=1)
+        # the max number of samples which are kept in the buffer while writing them
+        # fails. The oldest ones are dropped after it.
+        max_buffer: int = 10_000
+
+    class Cache(BaseSettings):
+        """Configs to use in the in-memory caches"""
+        # the number of the last memory samples which are kept in memory (0 disables it)
+        memory_ring_size: int = 1440
+        # the number of tokens whose users are kept in memory (0 disables it)
+        user_cache_size: int = 1024
+        # the max time to keep the user of a token. It's never more than the token's
+        # expiry time.
+        user_cache_ttl: datetime.timedelta = datetime.timedelta(minutes=1)
+        # the number of query shapes whose responses are kept until the next sample
+        response_cache_size: int = 128
+
+    class Stream(BaseSettings):
+        """Configs to use in streaming live samples to clients"""
+        # the max number of samples which are queued for a slow client. The oldest ones
+        # are dropped when it's full.
+        queue_size: int = 16
+        # time between keep-alive messages of an idle stream
+        keepalive: datetime.timedelta = datetime.timedelta(seconds=15)
+
+    class Storage(BaseSettings):
+        """Configs to use in storing raw memory samples"""
+        # "sql" stores samples in the Memory table and "segments" in compressed
+        # append-only files
+        backend: str = "sql"
+        # the directory of the segment files
+        directory: str = "./segments"
+        # the number of samples in a segment file
+        segment_size: int = 1 << 16
+        # the max number of samples in a block of a segment file
+        block_size: int = 1024
+
+    class Retention(BaseSettings):
+        """Configs to use in deleting old memory samples. None keeps them forever."""
+        # the max age of raw samples
+        raw: Optional[datetime.timedelta] = datetime.timedelta(days=7)
+        # the max age of each rollup tier
+        rollup_1m: Optional[datetime.timedelta] = datetime.timedelta(days=90)
+        rollup_1h: Optional[datetime.timedelta] = datetime.timedelta(days=2 * 365)
+        rollup_1d: Optional[datetime.timedelta] = None
+        # time between each enforcing of the retention
+        interval: datetime.timedelta = datetime.timedelta(hours=1)
+        # the max number of rows which are deleted in one transaction
+        chunk_size: int = 1000
+        # the target time of a chunk. The chunk is shrunk when it takes longer, so the
+        # write lock is never held for long.
+        chunk_time: datetime.timedelta = datetime.timedelta(milliseconds=50)
+        # time to sleep between chunks to let the sampler and readers in
+        pause: datetime.timedelta = datetime.timedelta(milliseconds=10)
+        # the max number of free pages which are given back to the file system after
+        # each enforcing by SQLite incremental vacuum (0 disables it)
+        vacuum_pages: int = 1000
+
+    class Processes(BaseSettings):
+        """Configs to use in sampling the memory usage of processes"""
+        # storing the top processes by RSS on each tick of the sampler
+        enabled: bool = False
+        # the number of processes which are stored on each tick
+        top_n: int = 10
+        # the directory of procfs
+        procfs: str = "/proc"
+
+    class Workers(BaseSettings):
+        """Configs to use in sharing one sampler between the workers of the server"""
+        # the directory of the lock of the leader and the sockets of the workers
+        directory: str = "./workers"
+        # time between the tries of the other workers to take the lead. One of them
+        # becomes the leader in this time when the leader stops.
+        lease_poll: datetime.timedelta = datetime.timedelta(seconds=1)
+
+    class Pressure(BaseSettings):
+        """Configs to use in sampling memory on memory pressure (Linux PSI)"""
+        # sampling also when a PSI trigger of /proc/pressure/memory fires. The sampler
+        # runs every `pressure_interval` while there is pressure and drops back to every
+        # `delta_time_check_memory` when it's calm.
+        pressure_sampling: bool = False
+        # the PSI file of memory, which is also read for the averages of each sample
+        psi_path: str = "/proc/pressure/memory"
+        # a trigger fires when some tasks are stalled on memory for `psi_stall` in a
+        # `psi_window`. The kernel needs a window of 0.5 to 10 seconds (a multiple of 2
+        # seconds for the unprivileged users).
+        psi_stall: datetime.timedelta = datetime.timedelta(milliseconds=200)
+        psi_window: datetime.timedelta = datetime.timedelta(seconds=2)
+        # time between the samples while there is pressure
+        pressure_interval: datetime.timedelta = datetime.timedelta(seconds=1)
+        # time without any trigger after which the pressure is over
+        calm_after: datetime.timedelta = datetime.timedelta(seconds=30)
+
+    class Profiling(BaseSettings):
+        """Configs to use in profiling requests on demand"""
+        # profiling requests or not. It adds nothing to the requests when it's disabled.
+        profile_requests: bool = False
+        # the header by which an admin asks to profile a request
+        profile_header: str = "X-Profile"
+        # profiling one of each N requests (0 disables sampling)
+        sample_every: int = 0
+        # the number of the last profiles which are kept in memory
+        keep_profiles: int = 20
+        # the number of the functions of the call-stack profile
+        top_functions: int = 30
+        # the usernames which could profile requests and read the profiles
+        admins: List[str] = []
+
     # debug mode or not
     debug: bool = True
-    # delta time to sleep between each memory checking.
+    # delta time between the starts of memory checkings. It could be less than a second
+    # (down to about 10 ms).
     delta_time_check_memory: datetime.timedelta = datetime.timedelta(minutes=1)
+    # the way to read memory usage. It could be "procfs" (reading /proc/meminfo), "free"
+    # (running `free` command) or "auto" (procfs if it's available otherwise free).
+    mem_collector: str = "auto"
+    # measuring the latency of requests for /metrics (the Prometheus format)
+    metrics: bool = True
+    # the host name of the samples of this machine. The samples of other hosts are sent
+    # to /memory/ingest.
+    local_host: str = socket.gethostname()
 
 
 settings = AppSettings()
 info_settings = settings.Info()
 sql_settings = settings.Sql()
 sql_session_settings = sql_settings.Session()
-token_settings = settings.Token()
\ No newline at end of file
+token_settings = settings.Token()
+writer_settings = settings.Writer()
+cache_settings = settings.Cache()
+stream_settings = settings.Stream()
+storage_settings = settings.Storage()
+retention_settings = settings.Retention()
+process_settings = settings.Processes()
+worker_settings = settings.Workers()
+pressure_settings = settings.Pressure()
+profiling_settings = settings.Profiling()
\ No newline at end of file
@@ -5,10 +5,13 @@ from typing import Annotated, Optional
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel
+from sqlalchemy.orm import Session
 import jwt
 
-from .config import token_settings
-from .sql import crud, schemas, get_db
+from .cache import user_cache
+from .config import profiling_settings, token_settings
+from .metrics import phase
+from .sql import crud, schemas, get_session, run_db
 
 
 class Token(BaseModel):
@@ -33,10 +36,10 @@ def verify_password(plain_password: str, hashed_password: bytes) -> bool:
     calculated_hash = (sha256(plain_password.encode()).digest())
     return (calculated_hash == hashed_password)
 
-def authenticate_user(username: int, password: str) -> schemas.User:
+def authenticate_user(db: Session, username: str, password: str) -> schemas.User:
     """Checks user has already existed or not and then check the user password. At the
     end return user object."""
-    user = crud.get_user(get_db(), username)
+    user = crud.get_user(db, username)
     if not user:
         return None
     if not verify_password(password, user.password):
@@ -66,32 +69,52 @@ def create_access_token(data: dict,
     else:
         expire = datetime.datetime.now() + token_settings.access_token_expire_minutes
     to_encode.update({"exp": expire.timestamp()})
-    encoded_jwt = jwt.encode(to_encode,
-                             token_settings.secret_key,
-                             algorithm=token_settings.algorithm)
+    with phase("jwt"):
+        encoded_jwt = jwt.encode(to_encode,
+                                 token_settings.secret_key,
+                                 algorithm=token_settings.algorithm)
     return encoded_jwt
 
-async def get_user_by_token(token: Annotated[str, Depends(oauth2_scheme)]) -> schemas.User:
-    """Decode the user data from its token."""
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+def _read_user(db: Session, username: str) -> Optional[schemas.User]:
+    """reads a user and ends the read transaction, so the connection is not held by the
+    request while it's waiting for something else (e.g. a coalesced query)"""
     try:
-        payload = jwt.decode(token,
-                             token_settings.secret_key,
-                             algorithms=[token_settings.algorithm])
-        username: str = payload.get("username", None)
-        if username is None:
+        user = crud.get_user(db, username=username)
+        return None if user is None else schemas.User.model_validate(user,
+                                                                     from_attributes=True)
+    finally:
+        db.rollback()
+
+async def get_user_by_token(token: Annotated[str, Depends(oauth2_scheme)],
+                            db: Annotated[Session, Depends(get_session)]
+) -> schemas.User:
+    """Decode the user data from its token. The resolved users are cached for a short
+    time (see `user_cache`)."""
+    with phase("auth"):
+        user = user_cache.get(token)
+        if user is not None:
+            return user
+        credentials_exception = HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+        try:
+            with phase("jwt"):
+                payload = jwt.decode(token,
+                                     token_settings.secret_key,
+                                     algorithms=[token_settings.algorithm])
+            username: str = payload.get("username", None)
+            if username is None:
+                raise credentials_exception
+            token_data = TokenData(username=username)
+        except jwt.exceptions.PyJWTError:
             raise credentials_exception
-        token_data = TokenData(username=username)
-    except jwt.exceptions.PyJWTError:
-        raise credentials_exception
-    user = crud.get_user(get_db(), username=token_data.username)
-    if user is None:
-        raise credentials_exception
-    return user
+        user = await run_db(_read_user, db, token_data.username)
+        if user is None:
+            raise credentials_exception
+        user_cache.set(token, user, expire_at=payload.get("exp", None))
+        return user
 
 async def get_current_active_user(
     current_user: Annotated[schemas.User, Depends(get_user_by_token)]
@@ -99,4 +122,12 @@ async def get_current_active_user(
     """Checks the user is active or not"""
     if not current_user.activated:
         raise HTTPException(status_code=400, detail="Inactive user")
-    return current_user
\ No newline at end of file
+    return current_user
+
+async def get_current_admin_user(
+    current_user: Annotated[schemas.User, Depends(get_current_active_user)]
+):
+    """Checks the user is an admin (see `AppSettings.Profiling.admins`)"""
+    if current_user.username not in profiling_settings.admins:
+        raise HTTPException(status_code=403, detail="Not an admin")
+    return current_user
@@ -0,0 +1,190 @@
+import csv
+import datetime
+import io
+import itertools
+import json
+import math
+import struct
+import zlib
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+from sqlalchemy import select
+
+from .config import settings, storage_settings
+from .sql import ReadSessionLocal, models
+from .sql.ring import MEMORY_FIELDS, memory_ring, from_micros, to_micros
+from .sql.segments import get_segment_store
+
+try:
+    import zstandard
+except ImportError:  # it's an optional dependency
+    zstandard = None
+
+
+# the exported columns in order
+EXPORT_COLUMNS = ("time",) + MEMORY_FIELDS
+# the rows which are read from database and encoded together
+CHUNK_SIZE = 1000
+
+# the binary format is a header and then fixed-width little-endian records:
+# header: b"MEMX", version (uint8), the number of value columns (uint16) and their
+#         comma separated names (uint16 length + ASCII)
+# record: time as microseconds since epoch (int64) + each value column (float64,
+#         NaN for null)
+BINARY_MAGIC = b"MEMX"
+BINARY_VERSION = 1
+BINARY_RECORD = struct.Struct("<q" + "d" * len(MEMORY_FIELDS))
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "binary": "application/octet-stream",
+}
+COMPRESSIONS = {
+    "none": None,
+    "gzip": "application/gzip",
+    "zstd": "application/zstd",
+}
+
+
+def iter_rows(host: str,
+              start: Optional[datetime.datetime] = None,
+              end: Optional[datetime.datetime] = None
+) -> Iterator[List[Sequence]]:
+    """Yields chunks of rows (time and MEMORY_FIELDS) of a host in [start, end) from the
+    oldest one.
+
+    Rows are streamed from a server-side cursor with its own session (or from the
+    segment files), so the memory does not grow with the number of rows. The recent
+    samples which are not written to database yet come from `memory_ring`.
+    """
+    last_time = None
+    if storage_settings.backend == "segments":
+        rows = get_segment_store(host).scan(start, end)
+        while True:
+            chunk = list(itertools.islice(rows, CHUNK_SIZE))
+            if not chunk:
+                break
+            last_time = chunk[-1][0]
+            yield chunk
+    else:
+        columns = [getattr(models.Memory, name) for name in EXPORT_COLUMNS]
+        q = (select(*columns).where(models.Memory.host == host)
+                             .order_by(models.Memory.time))
+        if start is not None:
+            q = q.where(models.Memory.time >= start)
+        if end is not None:
+            q = q.where(models.Memory.time < end)
+        with ReadSessionLocal() as db:
+            result = db.execute(q.execution_options(yield_per=CHUNK_SIZE))
+            for rows in result.partitions():
+                last_time = rows[-1][0]
+                yield rows
+    if host != settings.local_host:
+        return
+    if last_time is not None:
+        after = last_time + datetime.timedelta(microseconds=1)
+        start = after if start is None else max(start, after)
+    cached = memory_ring.between(start, end)[::-1]
+    for i in range(0, len(cached), CHUNK_SIZE):
+        yield [tuple(getattr(mem, name) for name in EXPORT_COLUMNS)
+               for mem in cached[i:i + CHUNK_SIZE]]
+
+
+def encode_ndjson(chunks: Iterable[List[Sequence]]) -> Iterator[bytes]:
+    """Encodes each row as a JSON object in a line"""
+    names = EXPORT_COLUMNS[1:]
+    for rows in chunks:
+        lines = []
+        for row in rows:
+            item = {"time": row[0].isoformat()}
+            item.update(zip(names, row[1:]))
+            lines.append(json.dumps(item, separators=(",", ":")))
+        lines.append("")
+        yield "\n".join(lines).encode()
+
+
+def encode_csv(chunks: Iterable[List[Sequence]]) -> Iterator[bytes]:
+    """Encodes rows as CSV with a header line. Nulls are empty fields."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in chunks:
+        writer.writerows((row[0].isoformat(),) + tuple(row[1:]) for row in rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def encode_binary(chunks: Iterable[List[Sequence]]) -> Iterator[bytes]:
+    """Encodes rows as fixed-width records (see BINARY_RECORD)"""
+    names = ",".join(MEMORY_FIELDS).encode()
+    yield (BINARY_MAGIC + struct.pack("<BHH", BINARY_VERSION, len(MEMORY_FIELDS),
+                                      len(names)) + names)
+    pack = BINARY_RECORD.pack
+    for rows in chunks:
+        yield b"".join(pack(to_micros(row[0]),
+                            *[math.nan if value is None else value for value in row[1:]])
+                       for row in rows)
+
+
+def decode_binary(data: bytes) -> List[dict]:
+    """Decodes the binary format (see BINARY_RECORD) to rows of time and the fields. It
+    raises ValueError for invalid data. The columns could be a subset of MEMORY_FIELDS
+    in any order, and the unknown ones are ignored."""
+    header = struct.Struct("<BHH")
+    if data[:4] != BINARY_MAGIC or len(data) < 4 + header.size:
+        raise ValueError("It's not a memory binary")
+    version, count, length = header.unpack_from(data, 4)
+    if version != BINARY_VERSION:
+        raise ValueError(f"Unknown version of memory binary: {version}")
+    pos = 4 + header.size + length
+    names = data[4 + header.size:pos].decode().split(",")
+    if len(names) != count:
+        raise ValueError("Invalid columns of memory binary")
+    record = struct.Struct("<q" + "d" * count)
+    if (len(data) - pos) % record.size:
+        raise ValueError("Invalid length of memory binary")
+    known = [(i, name) for i, name in enumerate(names, 1) if name in MEMORY_FIELDS]
+    return [{"time": from_micros(row[0]),
+             **{name: (None if row[i] != row[i] else row[i]) for i, name in known}}
+            for row in record.iter_unpack(data[pos:])]
+
+
+def compress(data: Iterable[bytes], compression: str) -> Iterator[bytes]:
+    """Compresses a stream of bytes by "gzip" or "zstd". "none" passes it as it is."""
+    if compression == "none":
+        yield from data
+        return
+    if compression == "gzip":
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression is not available")
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        raise ValueError(f"Unknown compression: {compression}")
+    for chunk in data:
+        chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def export(format: str,
+           compression: str = "none",
+           start: Optional[datetime.datetime] = None,
+           end: Optional[datetime.datetime] = None,
+           host: Optional[str] = None
+) -> Iterator[bytes]:
+    """Returns a stream of the memory history of a host (this machine by default) in
+    [start, end) in the format"""
+    encoders = {"ndjson": encode_ndjson, "csv": encode_csv, "binary": encode_binary}
+    if format not in encoders:
+        raise ValueError(f"Unknown format: {format}")
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd compression is not available")
+    rows = iter_rows(host or settings.local_host, start, end)
+    return compress(encoders[format](rows), compression)
@@ -0,0 +1,101 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+from typing import Optional
+
+from .alerts import evaluate_alerts, reload_alert_rule
+from .broadcast import ALERT, RULE, SAMPLE, alert_hub, memory_hub
+from .cache import response_cache
+from .config import settings, worker_settings
+from .mem_info import in_background, log_memory_usage
+from .retention import prune_old_samples
+from .sql import schemas
+from .sql.ring import memory_ring, to_micros
+
+
+class LeaderLease:
+    """An exclusive lease which is held by one process of the machine at a time. It's a
+    `flock` on a file, so it's given back by the kernel when its process exits or
+    crashes, and another process could take it (failover). The file has the pid of the
+    holder."""
+    def __init__(self, path: str):
+        self.path = path
+        self.fd: Optional[int] = None
+
+    @property
+    def held(self) -> bool:
+        return self.fd is not None
+
+    def acquire(self) -> bool:
+        """Tries to take the lease without waiting and returns whether it's held"""
+        if self.fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+# the lease of this worker. It's held when this worker is the leader.
+_lease: Optional[LeaderLease] = None
+
+def is_leader() -> bool:
+    """Checks this worker is the leader, which samples memory and evaluates the alert
+    rules on all the samples"""
+    return _lease is not None and _lease.held
+
+
+def handle_worker_message(kind: bytes, payload: bytes):
+    """Applies a message of another worker (see `app.broadcast.WorkerChannel`) to the
+    in-memory state of this worker: the samples go to the ring of the last samples, the
+    cache of responses and the streams (and the alert rules in the leader, e.g. the
+    samples which are ingested by another worker), the alert events go to the streams
+    and a changed rule is read again."""
+    if kind == SAMPLE:
+        sample = schemas.MemCreate.model_validate_json(payload)
+        if sample.host == settings.local_host:
+            memory_ring.append(sample)
+        response_cache.invalidate(sample.host, to_micros(sample.time))
+        memory_hub.publish(payload.decode(), topic=sample.host)
+        if is_leader():
+            in_background(evaluate_alerts([sample]), "evaluate_alerts")
+    elif kind == ALERT:
+        message = payload.decode()
+        alert_hub.publish(message, topic=json.loads(message)["host"])
+    elif kind == RULE:
+        in_background(reload_alert_rule(int(payload)), "reload_alert_rule")
+    else:
+        logging.warning(f"Unknown kind of a message of another worker: {kind!r}")
+
+
+async def run_sampler():
+    """Runs the memory sampler, the alert rules and the retention in only one worker of
+    the server (the leader). The other workers wait for the lease and one of them takes
+    the lead when the leader stops. They get the samples of the leader through the
+    worker channel (see `handle_worker_message`), so they serve the same fresh samples,
+    and they send the samples which they ingest to the leader. The rolling state of the
+    rules is only kept in the leader, so it starts again after a failover."""
+    global _lease
+    os.makedirs(worker_settings.directory, exist_ok=True)
+    lease = _lease = LeaderLease(os.path.join(worker_settings.directory, "leader.lock"))
+    while not lease.acquire():
+        await asyncio.sleep(worker_settings.lease_poll.total_seconds())
+    logging.info(f"The worker {os.getpid()} is the leader of sampling.")
+    try:
+        await asyncio.gather(log_memory_usage(), prune_old_samples())
+    finally:
+        lease.release()
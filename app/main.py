@@ -3,11 +3,23 @@ from __future__ import annotations
 import asyncio
 
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 
-from .config import settings, info_settings
-from .mem_info import log_memory_usage
+from .alerts import load_alert_rules
+from .broadcast import close_worker_channel, open_worker_channel
+from .cache import response_cache, user_cache
+from .config import settings, info_settings, profiling_settings, worker_settings
+from .leader import handle_worker_message, run_sampler
+from .mem_info import wait_background_tasks
+from .metrics import CallbackMetric, MetricsMiddleware, render
+from .profiling import ProfilingMiddleware
+from .singleflight import memory_flight
+from .sql.ring import memory_ring
+from .sql.writer import memory_writer, process_writer
 import app.routers.user as users_router
 import app.routers.mem as mem_router
+import app.routers.alerts as alerts_router
+import app.routers.profiling as profiling_router
 
 
 tags_metadata = [
@@ -20,6 +32,14 @@ tags_metadata = [
         "name": "memory",
         "description": "Getting memory info.",
     },
+    {
+        "name": "alerts",
+        "description": "Alert rules on the memory samples and their events.",
+    },
+    {
+        "name": "profiling",
+        "description": "The profiles of requests for the admins.",
+    },
 ]
 
 app = FastAPI(
@@ -32,6 +52,41 @@ app = FastAPI(
 # add routers
 app.include_router(router=users_router.router)
 app.include_router(router=mem_router.router)
+app.include_router(router=alerts_router.router)
+app.include_router(router=profiling_router.router)
+
+if settings.metrics:
+    app.add_middleware(MetricsMiddleware)
+# it's not added when it's disabled, so it costs nothing
+if profiling_settings.profile_requests:
+    app.add_middleware(ProfilingMiddleware)
+
+# the statistics of the caches are only read when they are scraped
+_caches = {"memory_ring": memory_ring, "user": user_cache, "response": response_cache}
+
+def _cache_stat(attribute: str):
+    return lambda: {(name,): getattr(cache.stats(), attribute)
+                    for name, cache in _caches.items()}
+
+CallbackMetric("memapi_cache_hits_total", "Hits of the in-memory caches.",
+               "counter", _cache_stat("hits"), ("cache",))
+CallbackMetric("memapi_cache_misses_total", "Misses of the in-memory caches.",
+               "counter", _cache_stat("misses"), ("cache",))
+CallbackMetric("memapi_cache_size", "The number of entries in the in-memory caches.",
+               "gauge", _cache_stat("size"), ("cache",))
+
+CallbackMetric("memapi_singleflight_executed_total",
+               "Queries of /memory/info which are run.",
+               "counter", lambda: {(): memory_flight.executed})
+CallbackMetric("memapi_singleflight_coalesced_total",
+               "Queries of /memory/info which waited for an identical running one.",
+               "counter", lambda: {(): memory_flight.coalesced})
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    """It returns the metrics of the requests, the sampler, database and the caches in
+    the Prometheus text format."""
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
 
 # default page
 @app.get("/")
@@ -43,13 +98,23 @@ task: asyncio.Task = None
 @app.on_event("startup")
 async def shutdown():
     global task
-    # runs tracking memory usage by asynchronous
+    # the rules are evaluated on each sample from the first one
+    await load_alert_rules()
+    # gets the samples and the changes of the other workers (e.g. `uvicorn --workers`)
+    open_worker_channel(worker_settings.directory, handle_worker_message)
+    # runs tracking memory usage and deleting the old samples by asynchronous, only in
+    # the leader worker
     loop = asyncio.get_event_loop()
-    task = loop.create_task(log_memory_usage(), name="log_mem")
+    task = loop.create_task(run_sampler(), name="log_mem")
 
 @app.on_event("shutdown")
 async def shutdown():
-    # cancel the logging memory task
+    # cancel the logging memory and the retention tasks
     task.cancel()
+    close_worker_channel()
+    # write the buffered samples which are not written yet
+    await wait_background_tasks()
+    await memory_writer.flush_async()
+    await process_writer.flush_async()
 
 # TODO: Add runner in main and use setup.py
\ No newline at end of file
@@ -1,53 +1,345 @@
 ﻿import asyncio
 import datetime
 import logging
+import os
 import subprocess
-from typing import Tuple, Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, NamedTuple, Optional, Set
 
-from .config import settings
-from .sql import crud, schemas, get_db
+from .alerts import evaluate_alerts
+from .broadcast import SAMPLE, memory_hub, share
+from .cache import response_cache
+from .config import pressure_settings, process_settings, settings
+from .metrics import (
+    sampler_collect_seconds,
+    sampler_drift_seconds,
+    sampler_failures,
+    sampler_missed_ticks,
+    sampler_pressure_triggers,
+    sampler_tick_seconds
+)
+from .pressure import PressureTrigger, open_pressure_trigger, read_pressure
+from .processes import log_process_usage
+from .scheduler import FixedRateScheduler, skip_missed
+from .sql import schemas
+from .sql.ring import memory_ring, to_micros
+from .sql.writer import memory_writer
 
 
 PIPE = subprocess.PIPE
 
-def get_mem_usage() -> Optional[Tuple[float, float, float]]:
+# the thread in which memory usage is read, so a slow read does not block the event loop
+sampler_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sampler")
+
+
+class MemUsage(NamedTuple):
+    """A memory usage sample. All values are in megabytes.
+
+    `total`, `used` and `free` keep the meaning of the `Total:` row of `free -t`, so they
+    include the swap space. The other fields split them into RAM and swap parts.
+    """
+    total: float
+    used: float
+    free: float
+    available: float
+    buffers: float
+    cached: float
+    swap_total: float
+    swap_used: float
+    swap_free: float
+
+
+class ProcMeminfoCollector:
+    """Reads memory usage from `/proc/meminfo` without spawning any process.
+
+    The file is opened once and every sample re-reads it from the start with `pread`,
+    so a sample costs one system call and a small parse.
+    """
+    # fields which are needed from /proc/meminfo
+    FIELDS = (b"MemTotal", b"MemFree", b"MemAvailable", b"Buffers", b"Cached",
+              b"SReclaimable", b"SwapTotal", b"SwapFree")
+
+    def __init__(self, path: str = "/proc/meminfo", buffer_size: int = 8192):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def read(self) -> bytes:
+        """reads whole of the file from its start"""
+        data = os.pread(self.fd, self.buffer_size, 0)
+        while len(data) == self.buffer_size:
+            # the buffer was too small, so grow it and read again
+            self.buffer_size *= 2
+            data = os.pread(self.fd, self.buffer_size, 0)
+        return data
+
+    def collect(self) -> Optional[MemUsage]:
+        try:
+            data = self.read()
+        except OSError:
+            sampler_failures.inc("error")
+            logging.error(f"Reading {self.path} is failed!", exc_info=True)
+            return None
+        values = {}
+        for line in data.splitlines():
+            key, _, rest = line.partition(b":")
+            if key in self.FIELDS:
+                values[key] = int(rest.split()[0])
+        try:
+            mem_total = values[b"MemTotal"]
+            mem_free = values[b"MemFree"]
+            swap_total = values[b"SwapTotal"]
+            swap_free = values[b"SwapFree"]
+        except KeyError:
+            sampler_failures.inc("format")
+            logging.critical(f"Unknown format of {self.path}!")
+            return None
+        buffers = values.get(b"Buffers", 0)
+        cached = values.get(b"Cached", 0) + values.get(b"SReclaimable", 0)
+        # the same as `free` does for the kernels which do not report MemAvailable
+        available = values.get(b"MemAvailable", mem_free)
+        mem_used = mem_total - available
+        if mem_used < 0:
+            mem_used = mem_total - mem_free
+        swap_used = swap_total - swap_free
+        # /proc/meminfo is in kibibytes and the samples are in megabytes
+        scale = 1024 / 1e6
+        return MemUsage(total=(mem_total + swap_total) * scale,
+                        used=(mem_used + swap_used) * scale,
+                        free=(mem_free + swap_free) * scale,
+                        available=available * scale,
+                        buffers=buffers * scale,
+                        cached=cached * scale,
+                        swap_total=swap_total * scale,
+                        swap_used=swap_used * scale,
+                        swap_free=swap_free * scale)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FreeCommandCollector:
+    """Reads memory usage by running `free -w -t --mega`. It is slower than
+    `ProcMeminfoCollector` but it also works where `/proc` is not available."""
+    def __init__(self, timeout: float = 10):
+        self.timeout = timeout
+
+    def collect(self) -> Optional[MemUsage]:
+        proc = subprocess.Popen(["free", "-w", "-t", "--mega"], stdout=PIPE, stderr=PIPE)
+        try:
+            outs, errs = proc.communicate(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            sampler_failures.inc("timeout")
+            logging.error("Getting memory space is killed because of timeout!")
+            return None
+        if errs != b"":
+            sampler_failures.inc("error")
+            print(errs.decode())
+            logging.critical("Getting memory space is unavailable!", exc_info=True)
+            return None
+        rows = {}
+        for line in outs.decode().splitlines():
+            key, _, rest = line.partition(":")
+            rows[key.strip()] = [float(value) for value in rest.split()]
+        try:
+            # columns of Mem: total used free shared buffers cache available
+            _, _, _, _, buffers, cached, available = rows["Mem"][:7]
+            swap_total, swap_used, swap_free = rows["Swap"][:3]
+            total, used, free = rows["Total"][:3]
+        except (KeyError, ValueError):
+            sampler_failures.inc("format")
+            logging.critical("Unknown output format of `free`!")
+            return None
+        return MemUsage(total=total,
+                        used=used,
+                        free=free,
+                        available=available,
+                        buffers=buffers,
+                        cached=cached,
+                        swap_total=swap_total,
+                        swap_used=swap_used,
+                        swap_free=swap_free)
+
+    def close(self):
+        pass
+
+
+_collector = None
+
+def get_collector():
+    """Returns the collector which is chosen by `settings.mem_collector`. If it is "auto",
+    it uses /proc/meminfo and falls back to `free` when it is not readable."""
+    global _collector
+    if _collector is None:
+        kind = settings.mem_collector
+        if kind in ("auto", "procfs"):
+            try:
+                _collector = ProcMeminfoCollector()
+            except OSError:
+                if kind == "procfs":
+                    raise
+                logging.warning("/proc/meminfo is not available, use `free` instead.")
+                _collector = FreeCommandCollector()
+        elif kind == "free":
+            _collector = FreeCommandCollector()
+        else:
+            raise ValueError(f"Unknown memory collector: {kind}")
+    return _collector
+
+def get_mem_usage() -> Optional[MemUsage]:
     """gets the memory usage in POSIX system
     
     Returns
     -------
-    Optional[Tuple[float, float, float]]
+    Optional[MemUsage]
         If the process is not successful, it will return None. Otherwise, return a tuple with
-        three values:
+        these values:
         - The total memory space
         - The amount of memory used
         - The free space 
+        - The available, buffers, cached and swap spaces (see `MemUsage`)
         All values are in megabytes.
     """
-    proc = subprocess.Popen(["free", "-t", "--mega"], stdout=PIPE, stderr=PIPE)
-    try:
-        outs, errs = proc.communicate(timeout=10)
-    except subprocess.TimeoutExpired:
-        proc.kill()
-        logging.error("Getting memory space is killed because of timeout!")
-        return None
-    if errs != b"":
-        print(errs.decode())
-        logging.critical("Getting memory space is unavailable!", exc_info=True)
+    with sampler_collect_seconds.time():
+        return get_collector().collect()
+
+def collect_sample(pressure_triggered: bool = False) -> Optional[schemas.MemCreate]:
+    """Reads memory usage and the memory pressure (if PSI is available) as a sample of
+    now. It returns None if memory usage could not be read."""
+    usage = get_mem_usage()
+    if not usage:
         return None
-    outs = outs.decode()
-    total, used, free = outs.split()[-3:]
-    return total, used, free
+    psi = read_pressure()
+    return schemas.MemCreate(time=datetime.datetime.now(),
+                             psi_avg10=psi[0] if psi else None,
+                             psi_avg60=psi[1] if psi else None,
+                             pressure_triggered=pressure_triggered,
+                             **(usage._asdict()))
+
+# the tasks which run after a sample. They are kept here, so they are not
+# garbage-collected before they are done.
+_background_tasks: Set[asyncio.Task] = set()
+_process_task: Optional[asyncio.Task] = None
+
+def _done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"{task.get_name()} is failed!", exc_info=task.exception())
+
+def in_background(coroutine: Awaitable, name: str) -> asyncio.Task:
+    """Runs a coroutine in a task which is kept until it's done, and logs its failure"""
+    task = asyncio.get_running_loop().create_task(coroutine, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_done)
+    return task
+
+async def wait_background_tasks():
+    """Waits for the work of the taken samples, e.g. before the last flush"""
+    while _background_tasks:
+        await asyncio.wait(list(_background_tasks))
+
+async def take_sample(pressure_triggered: bool = False):
+    """Takes a sample and gives it to the ring, the streams and the other workers. The
+    alerts, the processes and the writer get it in background tasks, so a slow database
+    or process scan does not delay the next tick of the sampler."""
+    global _process_task
+    loop = asyncio.get_running_loop()
+    memory_info = await loop.run_in_executor(sampler_executor, collect_sample,
+                                             pressure_triggered)
+    if memory_info is None:
+        return
+    logging.debug(f"total: {memory_info.total} - used: {memory_info.used} - "
+                  f"free: {memory_info.free}")
+    memory_ring.append(memory_info)
+    response_cache.invalidate(memory_info.host, to_micros(memory_info.time))
+    # it's serialized once for all the subscribers and the other workers
+    message = memory_info.model_dump_json()
+    memory_hub.publish(message, topic=memory_info.host)
+    share(SAMPLE, message)
+    # the rules are evaluated when the task starts, so the samples are evaluated in
+    # order even if storing the events of the last one is not done yet
+    in_background(evaluate_alerts([memory_info]), "evaluate_alerts")
+    if process_settings.enabled:
+        if _process_task is None or _process_task.done():
+            _process_task = in_background(log_process_usage(memory_info.time),
+                                           "log_process_usage")
+        else:
+            # the scanner is not shared by two scans
+            logging.warning("The processes of the last sample are still being "
+                            "scanned, so they are not sampled now.")
+    # it's written to database when the buffer of writer is due. The samples of a
+    # failed flush are kept by the writer for the next one.
+    if memory_writer.append(memory_info):
+        in_background(memory_writer.flush_async(), "flush_memory_samples")
 
 async def log_memory_usage():
+    """Samples memory usage every `settings.delta_time_check_memory` on fixed deadlines
+    (see `FixedRateScheduler`). The ticks which are missed because a tick took too long
+    are counted and logged.
+
+    If `pressure_sampling` is set and the kernel supports PSI triggers, it's sampled on
+    memory pressure instead (see `log_memory_usage_on_pressure`)."""
+    if pressure_settings.pressure_sampling:
+        trigger = open_pressure_trigger(pressure_settings.psi_path,
+                                        pressure_settings.psi_stall.total_seconds(),
+                                        pressure_settings.psi_window.total_seconds())
+        if trigger is not None:
+            try:
+                await log_memory_usage_on_pressure(trigger)
+            finally:
+                trigger.close()
+            return
+    scheduler = FixedRateScheduler(settings.delta_time_check_memory.total_seconds())
+    async for tick in scheduler.ticks():
+        start = time.perf_counter()
+        _report_tick(tick.lateness, tick.missed)
+        await take_sample()
+        sampler_tick_seconds.observe(time.perf_counter() - start)
+
+def _report_tick(lateness: float, missed: int):
+    sampler_drift_seconds.observe(lateness)
+    if missed:
+        sampler_missed_ticks.inc(amount=missed)
+        logging.warning(f"The sampler missed {missed} ticks.")
+
+async def log_memory_usage_on_pressure(trigger: PressureTrigger,
+                                       clock: Callable[[], float] = time.monotonic):
+    """Samples memory usage adaptively: at once when the PSI trigger fires, then every
+    `pressure_interval` while there is pressure, and every `delta_time_check_memory`
+    after it has been calm for `calm_after`. The short spikes are not missed and an idle
+    host is sampled slowly. The event loop is not blocked while it's waiting.
+
+    Like `FixedRateScheduler`, the deadlines which are passed (e.g. by a slow sample) are
+    skipped and reported as missed. Only a trigger changes the phase of the ticks."""
+    baseline = settings.delta_time_check_memory.total_seconds()
+    fast = pressure_settings.pressure_interval.total_seconds()
+    calm_after = pressure_settings.calm_after.total_seconds()
+    trigger.start()
+    under_pressure = False
+    pressure_until = 0.0
+    step = baseline
+    deadline = clock()
     while True:
-        usage = get_mem_usage()
-        if usage:
-            total, used, free = usage
-            logging.info(f"total: {total} - used: {used} - free: {free}")
-            memory_info = schemas.MemCreate(time = datetime.datetime.now(),
-                                            free=free,
-                                            used=used,
-                                            total=total)
-            crud.create_memory(get_db(), memory_info)
-        # await for some minutes to check memory again
-        await asyncio.sleep(settings.delta_time_check_memory.seconds)
\ No newline at end of file
+        triggered = await trigger.wait(deadline - clock())
+        now = clock()
+        start = time.perf_counter()
+        if triggered:
+            sampler_pressure_triggers.inc()
+            if not under_pressure:
+                logging.info(f"Memory pressure is started, so it's sampled every "
+                             f"{fast} seconds.")
+            under_pressure = True
+            pressure_until = now + calm_after
+        else:
+            deadline, missed = skip_missed(deadline, now, step)
+            _report_tick(max(0.0, now - deadline), missed)
+        await take_sample(pressure_triggered=triggered)
+        sampler_tick_seconds.observe(time.perf_counter() - start)
+        if under_pressure and now >= pressure_until:
+            logging.info("Memory pressure is over.")
+            under_pressure = False
+        step = fast if under_pressure else baseline
+        # a trigger starts the ticks again from its time
+        deadline = (now if triggered else deadline) + step
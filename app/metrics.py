@@ -0,0 +1,269 @@
+import bisect
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+# the metrics which are exposed by /metrics in order
+registry: List["Metric"] = []
+
+# the default buckets of latencies in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(str(value))}"'
+                     for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    """A metric in the Prometheus text format.
+
+    Updates never take a lock: each thread writes to its own shard (a dict of the label
+    values to the value) and the shards are only summed when they are scraped. A lock is
+    only taken once per thread to register its shard.
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def _snapshots(self) -> List[dict]:
+        with self._lock:
+            shards = list(self._shards)
+        # a copy of a dict is made without switching threads
+        return [shard.copy() for shard in shards]
+
+    @abstractmethod
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        """Yields the suffix of the name, the labels and the value of each sample"""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return sum(shard.get(labels, 0) for shard in self._snapshots())
+
+    def samples(self):
+        totals: Dict[tuple, float] = {}
+        for shard in self._snapshots():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        for labels, value in sorted(totals.items()):
+            yield "", _format_labels(self.labelnames, labels), value
+
+
+class Histogram(Metric):
+    """Counts observations in fixed buckets. The count of each bucket is kept (not the
+    cumulative one) plus the sum, so an observation is a bisect and two additions."""
+    type = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # the buckets, the +Inf bucket and the sum
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, *labels) -> "_Timer":
+        """Returns a context manager which observes the time spent in it"""
+        return _Timer(self, labels)
+
+    def count(self, *labels) -> int:
+        return sum(sum(shard[labels][:-1]) for shard in self._snapshots()
+                   if labels in shard)
+
+    def samples(self):
+        totals: Dict[tuple, List[float]] = {}
+        for shard in self._snapshots():
+            for labels, counts in shard.items():
+                total = totals.setdefault(labels, [0] * len(counts))
+                for i, count in enumerate(list(counts)):
+                    total[i] += count
+        bounds = self.buckets + (float("inf"),)
+        for labels, counts in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield ("_bucket",
+                       _format_labels(self.labelnames + ("le",),
+                                      labels + (_format_value(bound),)),
+                       cumulative)
+            yield "_sum", _format_labels(self.labelnames, labels), counts[-1]
+            yield "_count", _format_labels(self.labelnames, labels), cumulative
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+# the phase timings of the request which is profiled in the current context. It's None
+# when the request is not profiled, so `phase` does nothing.
+request_phases: ContextVar[Optional[Dict[str, float]]] = ContextVar("phases", default=None)
+
+
+class phase:
+    """A context manager which adds the time spent in it to a phase of the profiled
+    request, e.g. `with phase("db"): ...`. The time of a phase which is entered more than
+    once is summed, and the phases could nest (e.g. "db" in "auth"). It costs a lookup of
+    a context variable when the request is not profiled."""
+    __slots__ = ("name", "timings", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.timings = request_phases.get()
+        if self.timings is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            elapsed = (time.perf_counter() - self.start) * 1e3
+            self.timings[self.name] = self.timings.get(self.name, 0.0) + elapsed
+
+
+class CallbackMetric(Metric):
+    """A metric whose samples are read from a function when it's scraped, so it costs
+    nothing until then. The function returns a dict of the label values to the value."""
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 type: str,
+                 func: Callable[[], Dict[tuple, float]],
+                 labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.type = type
+        self.func = func
+
+    def samples(self):
+        for labels, value in sorted(self.func().items()):
+            yield "", _format_labels(self.labelnames, labels), value
+
+
+def render() -> str:
+    """Returns all the metrics in the Prometheus text format"""
+    return "".join(metric.render() for metric in registry)
+
+
+class MetricsMiddleware:
+    """An ASGI middleware which observes the latency and status of each HTTP request by
+    its route. The path template of the route is used (not the path), so the number of
+    label values is bounded."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            http_request_seconds.observe(time.perf_counter() - start,
+                                         scope["method"],
+                                         route.path if route is not None else "unmatched",
+                                         str(status))
+
+
+http_request_seconds = Histogram("memapi_http_request_duration_seconds",
+                                 "Latency of HTTP requests by route and status.",
+                                 ("method", "route", "status"))
+sampler_tick_seconds = Histogram("memapi_sampler_tick_duration_seconds",
+                                 "Time spent in each tick of the memory sampler.")
+sampler_collect_seconds = Histogram("memapi_sampler_collect_duration_seconds",
+                                    "Time spent in reading memory usage (get_mem_usage).")
+sampler_drift_seconds = Histogram("memapi_sampler_drift_seconds",
+                                  "Delay of each tick of the sampler from its deadline.")
+sampler_missed_ticks = Counter("memapi_sampler_missed_ticks_total",
+                               "Ticks of the sampler which are skipped because it was late.")
+sampler_pressure_triggers = Counter("memapi_sampler_pressure_triggers_total",
+                                    "Samples which are taken because of memory pressure.")
+sampler_failures = Counter("memapi_sampler_failures_total",
+                           "Failures of reading memory usage by reason.",
+                           ("reason",))
+db_query_seconds = Histogram("memapi_db_query_duration_seconds",
+                             "Latency of database statements by their kind.",
+                             ("statement",))
+db_commit_seconds = Histogram("memapi_db_commit_duration_seconds",
+                              "Latency of database commits.")
+writer_failures = Counter("memapi_writer_failures_total",
+                          "Failed writes of the buffered rows by writer.",
+                          ("writer",))
+writer_dropped_rows = Counter("memapi_writer_dropped_rows_total",
+                              "Buffered rows which are dropped because writing them "
+                              "kept failing by writer.",
+                              ("writer",))
+process_scan_seconds = Histogram("memapi_process_scan_duration_seconds",
+                                 "Time spent in scanning the memory usage of processes.")
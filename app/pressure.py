@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import os
+import select
+from typing import Optional, Tuple
+
+from .config import pressure_settings
+
+
+class PsiReader:
+    """Reads the averages of memory pressure from a PSI file (/proc/pressure/memory).
+
+    The file is opened once and each read is one `pread`. The `some` line is used: the
+    percent of time in which at least one task was stalled on memory.
+    """
+    def __init__(self, path: str = "/proc/pressure/memory"):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def read(self) -> Optional[Tuple[float, float]]:
+        """Returns avg10 and avg60 of the `some` line, or None if it could not be read"""
+        try:
+            data = os.pread(self.fd, 256, 0)
+        except OSError:
+            return None
+        for line in data.splitlines():
+            kind, *fields = line.split()
+            if kind != b"some":
+                continue
+            values = dict(field.split(b"=", 1) for field in fields)
+            try:
+                return float(values[b"avg10"]), float(values[b"avg60"])
+            except (KeyError, ValueError):
+                return None
+        return None
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PressureTrigger:
+    """Waits for the notifications of a PSI trigger in the event loop.
+
+    The kernel notifies a trigger by POLLPRI, which the selector of asyncio does not
+    watch, so the file is registered for EPOLLPRI in its own epoll, whose fd is readable
+    when there is a notification and is watched by `loop.add_reader`. The notification
+    could be consumed by the poll of the event loop itself, so a readable epoll is taken
+    as a notification.
+    """
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.epoll = select.epoll()
+        self.epoll.register(fd, select.EPOLLPRI)
+        self.event = asyncio.Event()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(self.epoll.fileno(), self._on_ready)
+
+    def _on_ready(self):
+        for _, events in self.epoll.poll(0):
+            if events & select.EPOLLERR:
+                # e.g. the cgroup of the file is removed
+                logging.error("The PSI trigger is failed, so it's stopped.")
+                self.loop.remove_reader(self.epoll.fileno())
+                return
+        self.event.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """Waits for a notification up to the timeout in seconds and returns whether one
+        came"""
+        if not self.event.is_set():
+            try:
+                await asyncio.wait_for(self.event.wait(), max(0.0, timeout))
+            except asyncio.TimeoutError:
+                return False
+        self.event.clear()
+        return True
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.epoll.fileno())
+            self.loop = None
+        self.epoll.close()
+        os.close(self.fd)
+
+
+def open_pressure_trigger(path: str,
+                          stall: float,
+                          window: float) -> Optional[PressureTrigger]:
+    """Registers a PSI trigger which fires when some tasks are stalled on memory for
+    `stall` seconds in a `window` of seconds. It returns None if PSI is not supported
+    (e.g. an old kernel or not Linux) or the trigger is not accepted."""
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+    except OSError:
+        logging.warning(f"{path} is not available, so memory pressure is not watched.")
+        return None
+    try:
+        os.write(fd, f"some {round(stall * 1e6)} {round(window * 1e6)}\0".encode())
+    except OSError as e:
+        os.close(fd)
+        logging.warning(f"The PSI trigger is not accepted ({e}), so memory pressure is "
+                        f"not watched.")
+        return None
+    return PressureTrigger(fd)
+
+
+_reader = None
+_reader_failed = False
+
+def read_pressure() -> Optional[Tuple[float, float]]:
+    """Returns avg10 and avg60 of memory pressure of this machine, or None if PSI is not
+    available"""
+    global _reader, _reader_failed
+    if _reader is None:
+        if _reader_failed:
+            return None
+        try:
+            _reader = PsiReader(pressure_settings.psi_path)
+        except OSError:
+            _reader_failed = True
+            return None
+    return _reader.read()
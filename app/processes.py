@@ -0,0 +1,140 @@
+import asyncio
+import datetime
+import heapq
+import logging
+import os
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from .config import process_settings, settings
+from .metrics import process_scan_seconds
+from .sql import schemas
+from .sql.writer import process_writer
+
+
+class ProcessUsage(NamedTuple):
+    """The memory usage of a process. The sizes are in megabytes."""
+    pid: int
+    name: str
+    cmdline: str
+    rss: float
+    vms: float
+
+
+class ProcessScanner:
+    """Finds the processes which use the most memory by scanning procfs.
+
+    The pids are listed by one `os.scandir` and only `/proc/[pid]/statm` (one short line)
+    is read for each of them into a buffer which is reused, while the top ones are kept
+    in a heap of size N. The name and command line are only read for the top processes
+    and they are cached by pid and start time, so a process which stays on the top costs
+    one more small read.
+    """
+    def __init__(self, path: str = "/proc", top_n: int = 10, buffer_size: int = 4096):
+        self.path = path
+        self.top_n = top_n
+        self.buffer = bytearray(buffer_size)
+        try:
+            self.page_size = os.sysconf("SC_PAGE_SIZE")
+        except (AttributeError, ValueError, OSError):
+            self.page_size = 4096
+        # pid -> (start time, name, command line)
+        self._commands: Dict[int, Tuple[bytes, str, str]] = {}
+
+    def _read(self, path: str) -> Optional[bytearray]:
+        """reads the start of a file into the buffer and returns a copy of the read
+        part, or None if the process is gone"""
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            size = os.readv(fd, [self.buffer])
+        except OSError:
+            return None
+        finally:
+            os.close(fd)
+        return self.buffer[:size]
+
+    def _command(self, pid: int) -> Optional[Tuple[str, str]]:
+        """returns the name and command line of a process"""
+        stat = self._read(f"{self.path}/{pid}/stat")
+        if not stat:
+            return None
+        # the name could have spaces and parentheses, so it's the text in the outer ones
+        head, _, rest = stat.rpartition(b")")
+        name = head.partition(b"(")[2].decode(errors="replace")
+        fields = rest.split()
+        # the start time is the 22nd field and the fields after the name start at 3rd
+        start_time = bytes(fields[19]) if len(fields) > 19 else b""
+        cached = self._commands.get(pid)
+        if cached is not None and cached[0] == start_time:
+            return cached[1], cached[2]
+        data = self._read(f"{self.path}/{pid}/cmdline")
+        # a long command line is truncated to the buffer
+        cmdline = (data or b"").rstrip(b"\0").replace(b"\0", b" ").decode(errors="replace")
+        # kernel threads have no command line
+        cmdline = cmdline or f"[{name}]"
+        self._commands[pid] = (start_time, name, cmdline)
+        return name, cmdline
+
+    def scan(self) -> List[ProcessUsage]:
+        """Returns the top processes by RSS from the largest one"""
+        with process_scan_seconds.time():
+            heap: List[Tuple[int, int, int]] = []
+            alive = set()
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    if not entry.name.isdigit():
+                        continue
+                    pid = int(entry.name)
+                    alive.add(pid)
+                    statm = self._read(f"{self.path}/{pid}/statm")
+                    if not statm:
+                        continue
+                    fields = statm.split(None, 2)
+                    if len(fields) < 2:
+                        continue
+                    rss = int(fields[1])
+                    if rss == 0:
+                        continue
+                    item = (rss, pid, int(fields[0]))
+                    if len(heap) < self.top_n:
+                        heapq.heappush(heap, item)
+                    elif item > heap[0]:
+                        heapq.heapreplace(heap, item)
+            for pid in [pid for pid in self._commands if pid not in alive]:
+                del self._commands[pid]
+            scale = self.page_size / 1e6
+            result = []
+            for rss, pid, vms in sorted(heap, reverse=True):
+                command = self._command(pid)
+                if command is None:
+                    continue
+                result.append(ProcessUsage(pid=pid, name=command[0], cmdline=command[1],
+                                           rss=rss * scale, vms=vms * scale))
+            return result
+
+
+_scanner = None
+
+def get_scanner() -> ProcessScanner:
+    global _scanner
+    if _scanner is None:
+        _scanner = ProcessScanner(process_settings.procfs, process_settings.top_n)
+    return _scanner
+
+async def log_process_usage(time: datetime.datetime):
+    """Buffers the top processes by RSS at the time of a sample in `process_writer`,
+    which writes the ones of many ticks together. It's scanned in a thread, so a host
+    with many processes does not block the event loop."""
+    loop = asyncio.get_running_loop()
+    try:
+        usages = await loop.run_in_executor(None, get_scanner().scan)
+        rows = [schemas.ProcessMemory(host=settings.local_host, time=time,
+                                      **usage._asdict())
+                for usage in usages]
+        if process_writer.extend(rows):
+            await process_writer.flush_async()
+    except Exception:
+        # the sampler of the host should not be stopped by the processes
+        logging.exception("Sampling the processes is failed.")
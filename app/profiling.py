@@ -0,0 +1,132 @@
+import cProfile
+import datetime
+import io
+import itertools
+import pstats
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+import jwt
+
+from .config import profiling_settings, token_settings
+from .metrics import request_phases
+from .sql import schemas
+
+
+class ProfileStore:
+    """Keeps the last profiles of requests"""
+    def __init__(self, keep: int):
+        self.profiles: Deque[schemas.RequestProfile] = deque(maxlen=keep)
+        self.ids = itertools.count(1)
+
+    def add(self, profile: schemas.RequestProfile):
+        self.profiles.append(profile)
+
+    def get(self, profile_id: int) -> Optional[schemas.RequestProfile]:
+        for profile in self.profiles:
+            if profile.id == profile_id:
+                return profile
+        return None
+
+    def list(self) -> schemas.ListOfProfiles:
+        """Returns the profiles from the newest one"""
+        return schemas.ListOfProfiles(profiles=list(reversed(self.profiles)))
+
+
+def is_admin_token(authorization: Optional[bytes]) -> bool:
+    """Checks a Bearer authorization header is a valid token of an admin. Only the
+    signature of the token is checked and database is not read."""
+    if not authorization or not profiling_settings.admins:
+        return False
+    scheme, _, token = authorization.decode("latin-1").partition(" ")
+    if scheme.lower() != "bearer":
+        return False
+    try:
+        payload = jwt.decode(token, token_settings.secret_key,
+                             algorithms=[token_settings.algorithm])
+    except jwt.exceptions.PyJWTError:
+        return False
+    return payload.get("username") in profiling_settings.admins
+
+
+class ProfilingMiddleware:
+    """An ASGI middleware which profiles a request when an admin asks for it by the
+    profiling header or one of each `sample_every` requests.
+
+    The phase timings (see `phase`) and a call-stack profile (cProfile) of the event loop
+    thread are kept in `profile_store`. Only one request has a call-stack profile at a
+    time, and it also has the other requests which ran on the loop meanwhile. The
+    functions which run in the database threads are only timed by their phases.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.header = profiling_settings.profile_header.lower().encode()
+        self.sample_every = profiling_settings.sample_every
+        self.count = 0
+        self.profiler: Optional[cProfile.Profile] = None
+
+    def _reason(self, scope) -> Optional[str]:
+        headers = dict(scope["headers"])
+        if self.header in headers and is_admin_token(headers.get(b"authorization")):
+            return "header"
+        if self.sample_every > 0:
+            self.count += 1
+            if self.count % self.sample_every == 0:
+                return "sampled"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        reason = self._reason(scope)
+        if reason is None:
+            await self.app(scope, receive, send)
+            return
+        timings: Dict[str, float] = {}
+        token = request_phases.set(timings)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        profiler = None
+        if self.profiler is None:
+            profiler = self.profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            total = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                self.profiler = None
+            request_phases.reset(token)
+            profile_store.add(schemas.RequestProfile(
+                id=next(profile_store.ids),
+                time=datetime.datetime.now(),
+                method=scope["method"],
+                path=scope["path"],
+                status=status,
+                reason=reason,
+                total_ms=total * 1e3,
+                phases=timings,
+                stack=_format_stats(profiler) if profiler is not None else None))
+
+
+def _format_stats(profiler: cProfile.Profile) -> str:
+    """returns the top functions of a profile by their cumulative time"""
+    output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(
+        profiling_settings.top_functions)
+    return output.getvalue()
+
+
+# the last profiles of requests
+profile_store = ProfileStore(profiling_settings.keep_profiles)
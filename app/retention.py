@@ -0,0 +1,109 @@
+import asyncio
+import datetime
+import logging
+import time
+from typing import List, Optional, Tuple
+
+from .config import retention_settings, sql_settings, storage_settings
+from .sql import SessionLocal, engine, run_write
+from .sql import crud, models, schemas
+from .sql.segments import all_segment_stores
+
+
+# the statistics of all the runs since the start
+retention_stats = schemas.RetentionStats()
+
+def _policies() -> List[Tuple[type, Optional[datetime.timedelta]]]:
+    """Returns the tables and the max ages of their rows"""
+    return [
+        (models.Memory, retention_settings.raw),
+        (models.MemoryRollup1m, retention_settings.rollup_1m),
+        (models.MemoryRollup1h, retention_settings.rollup_1h),
+        (models.MemoryRollup1d, retention_settings.rollup_1d),
+        # the processes are as detailed as the raw samples
+        (models.ProcessMemory, retention_settings.raw),
+    ]
+
+def _delete_chunk(model, cutoff: datetime.datetime, limit: int) -> int:
+    with SessionLocal() as db:
+        return crud.delete_old_rows(db, model, cutoff, limit)
+
+def _drop_segments(cutoff: datetime.datetime) -> int:
+    return sum(store.drop_before(cutoff) for store in all_segment_stores())
+
+async def prune_table(model, cutoff: datetime.datetime) -> int:
+    """Deletes the rows of a table before the cutoff chunk by chunk and returns the
+    number of them. Each chunk is a transaction which takes about `chunk_time`: the chunk
+    is halved when it's slower and doubled (up to `chunk_size`) when it's much faster.
+    The sampler and readers could use database between the chunks."""
+    limit = retention_settings.chunk_size
+    target = retention_settings.chunk_time.total_seconds()
+    pruned = 0
+    while True:
+        start = time.perf_counter()
+        count = await run_write(_delete_chunk, model, cutoff, limit)
+        elapsed = time.perf_counter() - start
+        pruned += count
+        if count < limit:
+            return pruned
+        if elapsed > target:
+            limit = max(1, limit // 2)
+        elif elapsed < target / 2:
+            limit = min(limit * 2, retention_settings.chunk_size)
+        await asyncio.sleep(retention_settings.pause.total_seconds())
+
+def incremental_vacuum(pages: int) -> int:
+    """Gives back at most n free pages of the SQLite file to the file system and returns
+    the number of them. It only works on a file which is created with auto_vacuum set to
+    INCREMENTAL (see `app.sql`)."""
+    connection = engine.raw_connection()
+    try:
+        before = connection.execute("PRAGMA freelist_count").fetchone()[0]
+        # a page is freed by each step of the pragma and only a script is stepped to
+        # the end by sqlite3 (execute stops at the first step)
+        connection.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        after = connection.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        connection.close()
+    return before - after
+
+async def enforce_retention(now: Optional[datetime.datetime] = None
+) -> schemas.RetentionStats:
+    """Deletes the samples and rollups which are older than their retention, reclaims
+    the free space of database and returns the statistics of this run."""
+    now = now or datetime.datetime.now()
+    start = time.perf_counter()
+    rows = 0
+    for model, max_age in _policies():
+        if max_age is None:
+            continue
+        if model is models.Memory and storage_settings.backend == "segments":
+            rows += await run_write(_drop_segments, now - max_age)
+        else:
+            rows += await prune_table(model, now - max_age)
+    pages = 0
+    if (retention_settings.vacuum_pages > 0 and rows
+            and sql_settings.url.startswith("sqlite")):
+        pages = await run_write(incremental_vacuum, retention_settings.vacuum_pages)
+    run = schemas.RetentionStats(runs=1,
+                                 rows_pruned=rows,
+                                 pages_vacuumed=pages,
+                                 seconds=time.perf_counter() - start,
+                                 last_run=now)
+    retention_stats.runs += 1
+    retention_stats.rows_pruned += run.rows_pruned
+    retention_stats.pages_vacuumed += run.pages_vacuumed
+    retention_stats.seconds += run.seconds
+    retention_stats.last_run = now
+    logging.info(f"retention: {rows} rows are pruned and {pages} pages are vacuumed "
+                 f"in {run.seconds:.3f} seconds")
+    return run
+
+async def prune_old_samples():
+    while True:
+        try:
+            await enforce_retention()
+        except Exception:
+            # the next run could be successful, so the task is kept running
+            logging.exception("Enforcing the retention is failed.")
+        await asyncio.sleep(retention_settings.interval.total_seconds())
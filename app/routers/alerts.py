@@ -0,0 +1,125 @@
+from typing import Annotated, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+
+from ..alerts import alert_engine
+from ..broadcast import RULE, alert_hub, share
+from ..dependencies import get_current_active_user
+from ..sql import get_session, in_write_session, run_db, run_write
+from ..sql.schemas import AlertRule, AlertRuleCreate, ListOfAlertEvents, User
+from ..sql.crud import (
+    create_alert_rule,
+    delete_alert_rule,
+    get_alert_events,
+    get_alert_rules,
+    update_alert_rule
+)
+
+
+router = APIRouter(prefix="/alerts", tags=["alerts"])
+
+@router.get("/rules/", response_model=List[AlertRule])
+async def read_alert_rules(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    db: Annotated[Session, Depends(get_session)],
+) -> List[AlertRule]:
+    """It returns all the alert rules. First, you should login and get a token.
+    (see /users/token)
+    """
+    return await run_db(get_alert_rules, db)
+
+@router.post("/rules/", response_model=AlertRule, status_code=status.HTTP_201_CREATED)
+async def add_alert_rule(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    rule: AlertRuleCreate,
+) -> AlertRule:
+    """It adds an alert rule which is evaluated on each new sample from now on. First,
+    you should login and get a token. (see /users/token)
+
+    Return
+    ------
+    AlertRule
+        The stored rule with its id.
+    """
+    db_rule = await run_write(in_write_session, create_alert_rule, rule)
+    db_rule = AlertRule.model_validate(db_rule)
+    alert_engine.set_rule(db_rule)
+    share(RULE, str(db_rule.id))
+    return db_rule
+
+@router.put("/rules/{rule_id}", response_model=AlertRule)
+async def change_alert_rule(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    rule_id: int,
+    rule: AlertRuleCreate,
+) -> AlertRule:
+    """It replaces an alert rule. Its rolling state is reset. First, you should login
+    and get a token. (see /users/token)
+    """
+    db_rule = await run_write(in_write_session, update_alert_rule, rule_id, rule)
+    if db_rule is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="The rule is not found",
+        )
+    db_rule = AlertRule.model_validate(db_rule)
+    alert_engine.set_rule(db_rule)
+    share(RULE, str(db_rule.id))
+    return db_rule
+
+@router.delete("/rules/{rule_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def remove_alert_rule(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    rule_id: int,
+):
+    """It deletes an alert rule. Its events are kept. First, you should login and get a
+    token. (see /users/token)
+    """
+    if not await run_write(in_write_session, delete_alert_rule, rule_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="The rule is not found",
+        )
+    alert_engine.remove_rule(rule_id)
+    share(RULE, str(rule_id))
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+@router.get("/events/", response_model=ListOfAlertEvents)
+async def read_alert_events(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    db: Annotated[Session, Depends(get_session)],
+    rule_id: Optional[int] = None,
+    host: Optional[str] = None,
+    limit: Annotated[int, Query(gt=0, le=1000)] = 100,
+) -> ListOfAlertEvents:
+    """It returns the last firing and resolved events of the alert rules from the newest
+    one. First, you should login and get a token. (see /users/token)
+
+    Parameters
+    ----------
+        rule_id
+            Only the events of the rule are returned.
+        host
+            Only the events of the host are returned.
+        limit
+            The max number of the events.
+    """
+    events = await run_db(get_alert_events, db, rule_id=rule_id, host=host, limit=limit)
+    return ListOfAlertEvents.model_validate({"events": events}, from_attributes=True)
+
+@router.get("/stream/", response_class=StreamingResponse)
+async def stream_alert_events(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    host: Optional[str] = None,
+) -> StreamingResponse:
+    """It streams each new alert event as a Server-Sent Event. The token is only checked
+    when the stream is opened. First, you should login and get a token. (see /users/token)
+
+    Parameters
+    ----------
+        host
+            Only the events of the host are sent. The default is all the hosts.
+    """
+    return StreamingResponse(alert_hub.events(host), media_type="text/event-stream")
@@ -1,21 +1,81 @@
-from typing import Annotated
+import asyncio
+import datetime
+import json
+from typing import Annotated, List, Literal, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    WebSocket,
+    status
+)
+from fastapi.responses import StreamingResponse
+from fastapi.security.utils import get_authorization_scheme_param
+from pydantic import Field, ValidationError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 
-from ..dependencies import get_db, get_current_active_user
-from ..sql.schemas import ListOfMemory, User
-from ..sql.crud import get_mem
+from ..alerts import evaluate_alerts
+from ..broadcast import SAMPLE, memory_hub, share
+from ..cache import etag_matches, response_cache
+from ..config import settings
+from ..dependencies import get_current_active_user, get_user_by_token
+from ..export import BINARY_MAGIC, COMPRESSIONS, FORMATS, decode_binary, export
+from ..leader import is_leader
+from ..metrics import phase
+from ..retention import retention_stats
+from ..singleflight import memory_flight
+from ..stats import BUCKET_STEP, get_mem_stats
+from ..sql import ReadSessionLocal, get_session, in_write_session, run_db, run_write
+from ..sql.schemas import (
+    CacheStats,
+    ListOfMemory,
+    MemCreate,
+    MemoryBatch,
+    MemoryRange,
+    MemoryStats,
+    PageOfMemory,
+    ProcessSnapshot,
+    RetentionStats,
+    User
+)
+from ..sql.crud import (
+    create_memories,
+    get_mem,
+    get_mem_columns,
+    get_mem_page,
+    get_mem_range,
+    get_process_snapshot
+)
+from ..sql.ring import memory_ring, to_micros
 
 
 router = APIRouter(prefix="/memory", tags=["memory"])
 
-@router.get("/info/", response_model=ListOfMemory)
+@router.get("/info/",
+            response_model=ListOfMemory,
+            responses = {
+                304: {"description": "The data has not changed since the passed ETag"}
+            })
 async def read_mem_info(current_user: Annotated[User, Depends(get_current_active_user)],
-                        limit: int
-) -> ListOfMemory:
+                        limit: int,
+                        host: Optional[str] = None,
+                        format: Literal["rows", "columns"] = "rows",
+                        epoch: bool = False,
+                        if_none_match: Annotated[Optional[str], Header()] = None
+) -> Response:
     """It reads the last n memory information from database. First, you should login and
     get a token. (see /users/token)
 
+    The serialized response is cached until the next sample and it has an ETag. If the
+    ETag is passed by If-None-Match and no sample is added, it returns 304. The
+    identical requests which miss the cache at the same time share one query.
+
     Parameters
     ----------
         current_user
@@ -23,6 +83,15 @@ async def read_mem_info(current_user: Annotated[User, Depends(get_current_active
             got from API. See Also: /users/token
         limit:n
             how many gets from db. It should be passed as a param.
+        host
+            The host of the samples. The default is this machine.
+        format
+            "rows" (the default) returns `ListOfMemory`. "columns" returns an object
+            with the host and a list of each field from the newest sample, e.g.
+            {"host": ..., "time": [...], "free": [...], "used": [...], ...}, which is
+            smaller and much faster for a large limit.
+        epoch
+            Times of "columns" are microseconds since epoch instead of ISO strings.
 
     Return
     ------
@@ -30,10 +99,411 @@ async def read_mem_info(current_user: Annotated[User, Depends(get_current_active
         It returns list of memory information that have items: free, used, total, and time.
         See Also: `ListOfMemory`
     """
-    mem = get_mem(get_db(), limit=int(limit))
-    if not mem:
+    host = host or settings.local_host
+    key = ("info", limit, format, epoch)
+    version = response_cache.version(host)
+    etag = response_cache.etag(host, key)
+    headers = {"ETag": etag} if etag else None
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    body = response_cache.get(host, key)
+    if body is None:
+
+        async def fetch() -> Optional[bytes]:
+            body = await run_db(_read_info_body, int(limit), host, format, epoch)
+            # it's not stored if a new sample is added meanwhile
+            if body is not None:
+                response_cache.set(host, key, body, version)
+            return body
+
+        # the requests of another version do not wait for this one
+        body = await memory_flight.do((host, key, version), fetch)
+    if body is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Bad request",
         )
-    return mem
\ No newline at end of file
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def _read_info_body(limit: int, host: str, format: str, epoch: bool) -> Optional[bytes]:
+    """reads the body of /memory/info in its own session, because it's shared by the
+    coalesced requests and it could outlive the request which started it"""
+    with ReadSessionLocal() as db:
+        if format == "columns":
+            with phase("crud"):
+                columns = get_mem_columns(db, limit=limit, host=host, epoch=epoch)
+            with phase("serialize"):
+                return json.dumps(columns, separators=(",", ":")).encode()
+        with phase("crud"):
+            mem = get_mem(db, limit=limit, host=host)
+        with phase("serialize"):
+            return mem.model_dump_json().encode() if mem else None
+
+@router.get("/", response_model=PageOfMemory)
+async def read_mem_page(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    db: Annotated[Session, Depends(get_session)],
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    cursor: Optional[str] = None,
+    limit: Annotated[int, Query(gt=0, le=1000)] = 100,
+    order: Literal["desc", "asc"] = "desc",
+    host: Optional[str] = None,
+) -> PageOfMemory:
+    """It reads memory information page by page in a time window. First, you should
+    login and get a token. (see /users/token)
+
+    Parameters
+    ----------
+        start
+            Start of the window (inclusive). It's optional.
+        end
+            End of the window (exclusive). It's optional.
+        cursor
+            The `next_cursor` of the previous page. It should be passed with the same
+            window and order to get the next page.
+        limit
+            The max number of items in the page.
+        order
+            "desc" to walk from the newest samples and "asc" from the oldest ones.
+        host
+            The host of the samples. The default is this machine.
+
+    Return
+    ------
+    PageOfMemory
+        It returns list of memory information and the cursor of the next page which is
+        null for the last page.
+    """
+    try:
+        return await run_db(get_mem_page, db, limit=limit, start=start, end=end,
+                            cursor=cursor, descending=(order == "desc"), host=host)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor",
+        )
+
+@router.get("/range/", response_model=MemoryRange)
+async def read_mem_range(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    db: Annotated[Session, Depends(get_session)],
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    points: Annotated[int, Query(gt=0)] = 500,
+    resolution: Annotated[Optional[int], Query(gt=0)] = None,
+    host: Optional[str] = None,
+) -> MemoryRange:
+    """It reads memory information in a time range. The data comes from the coarsest
+    rollup tier (1 minute, 1 hour or 1 day) that still meets the requested points or
+    resolution, so long ranges are as cheap as short ones. First, you should login and
+    get a token. (see /users/token)
+
+    Parameters
+    ----------
+        start
+            Start of the range. The default is one day before the end.
+        end
+            End of the range (exclusive). The default is now.
+        points
+            The minimum number of points that is needed in the range.
+        resolution
+            The max length of each point in seconds. If it's passed, points is ignored.
+        host
+            The host of the samples. The default is this machine.
+
+    Return
+    ------
+    MemoryRange
+        It returns the resolution of the points in seconds (0 for raw samples) and list
+        of points which have min, max, avg and last of free, used and total.
+    """
+    if end is None:
+        end = datetime.datetime.now()
+    if start is None:
+        start = end - datetime.timedelta(days=1)
+    if start >= end:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Start of the range should be before its end",
+        )
+    return await run_db(get_mem_range, db, start, end,
+                        points=points, resolution=resolution, host=host)
+
+@router.get("/stats/", response_model=MemoryStats)
+async def read_mem_stats(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    db: Annotated[Session, Depends(get_session)],
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    percentiles: Annotated[List[Annotated[float, Field(ge=0, le=100)]], Query()] = [],
+    bucket: Annotated[Optional[int], Query(gt=0)] = None,
+    host: Optional[str] = None,
+) -> MemoryStats:
+    """It computes min, max, mean, stddev and percentiles of free, used and total in a
+    time window on the server, so clients do not need to download the samples. First,
+    you should login and get a token. (see /users/token)
+
+    Parameters
+    ----------
+        start
+            Start of the window. The default is one day before the end.
+        end
+            End of the window (exclusive). The default is now.
+        percentiles
+            The percentiles (0 to 100) to compute. It could be passed many times, e.g.
+            `percentiles=50&percentiles=95`.
+        bucket
+            The length of buckets in seconds to group the samples. It should be a
+            multiple of 60. The default is the whole window as one bucket.
+        host
+            The host of the samples. The default is this machine.
+
+    Return
+    ------
+    MemoryStats
+        It returns the statistics of each non-empty bucket. The percentiles are
+        estimated from histograms with an error of at most 1% of their values.
+    """
+    if end is None:
+        end = datetime.datetime.now()
+    if start is None:
+        start = end - datetime.timedelta(days=1)
+    if start >= end:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Start of the window should be before its end",
+        )
+    if bucket is not None and bucket % BUCKET_STEP:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"The bucket should be a multiple of {BUCKET_STEP} seconds",
+        )
+    return await run_db(get_mem_stats, db, start, end, percentiles=percentiles,
+                        bucket=bucket, host=host)
+
+@router.get("/stream/", response_class=StreamingResponse)
+async def stream_mem_info(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    host: Optional[str] = None,
+) -> StreamingResponse:
+    """It streams each new memory sample as a Server-Sent Event. The token is only checked
+    when the stream is opened. First, you should login and get a token. (see /users/token)
+
+    Parameters
+    ----------
+        host
+            Only the samples of the host are sent. The default is all the hosts.
+
+    Return
+    ------
+    StreamingResponse
+        A "text/event-stream" whose data of each event is a memory information as JSON.
+        A comment is sent as keep-alive when there is no new sample for a while.
+    """
+    return StreamingResponse(memory_hub.events(host), media_type="text/event-stream")
+
+@router.websocket("/ws/")
+async def stream_mem_info_ws(websocket: WebSocket,
+                             token: Optional[str] = None,
+                             host: Optional[str] = None):
+    """It sends each new memory sample as a JSON text message over a WebSocket. The token
+    is passed as a Bearer authorization header or as `token` param and it's only checked
+    when connecting. (see /users/token) If `host` is passed, only its samples are sent.
+    """
+    if token is None:
+        scheme, token = get_authorization_scheme_param(
+            websocket.headers.get("Authorization"))
+        if scheme.lower() != "bearer":
+            token = None
+    try:
+        if token is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+        with ReadSessionLocal() as db:
+            await get_current_active_user(await get_user_by_token(token, db))
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+
+    async def send(subscriber):
+        while True:
+            await websocket.send_text(await subscriber.get())
+
+    with memory_hub.subscribe(host) as subscriber:
+        sender = asyncio.create_task(send(subscriber))
+        try:
+            # messages of client are ignored and it's only waited for disconnecting
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+        finally:
+            sender.cancel()
+
+@router.get("/export/", response_class=StreamingResponse)
+async def export_mem_info(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    format: Literal["ndjson", "csv", "binary"] = "ndjson",
+    compression: Literal["none", "gzip", "zstd"] = "none",
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    host: Optional[str] = None,
+) -> StreamingResponse:
+    """It streams the whole memory history (or a time window of it) as a file. Rows are
+    read from a server-side cursor, so the memory use does not depend on the number of
+    rows. First, you should login and get a token. (see /users/token)
+
+    Parameters
+    ----------
+        format
+            "ndjson" (a JSON object per line), "csv" or "binary" (see `app.export`).
+        compression
+            "none", "gzip" or "zstd" (if zstandard is installed).
+        start
+            Start of the window (inclusive). It's optional.
+        end
+            End of the window (exclusive). It's optional.
+        host
+            The host of the samples. The default is this machine.
+    """
+    try:
+        data = export(format, compression, start=start, end=end, host=host)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e),
+        )
+    filename = f"memory.{format}"
+    if compression != "none":
+        filename += ".gz" if compression == "gzip" else ".zst"
+    return StreamingResponse(
+        data,
+        media_type=COMPRESSIONS[compression] or FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+@router.post("/ingest/",
+             status_code=status.HTTP_201_CREATED,
+             openapi_extra={
+                 "requestBody": {
+                     "content": {
+                         "application/json": {
+                             "schema": MemoryBatch.model_json_schema()
+                         },
+                         "application/octet-stream": {
+                             "schema": {"type": "string", "format": "binary"}
+                         },
+                     }
+                 }
+             })
+async def ingest_mem_info(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    request: Request,
+    host: Optional[str] = None,
+) -> dict:
+    """It stores a batch of memory samples of another host by one bulk insert, so agents
+    on other machines can push their samples. First, you should login and get a token.
+    (see /users/token)
+
+    The body is a `MemoryBatch` as JSON, or the binary format of /memory/export (with
+    "application/octet-stream" content type) whose host is passed by `host` param.
+
+    Return
+    ------
+    dict
+        The number of the stored samples as "count".
+    """
+    body = await request.body()
+    try:
+        if request.headers.get("Content-Type", "").startswith("application/octet-stream"):
+            if not host:
+                raise ValueError("The host should be passed as a param")
+            if not body.startswith(BINARY_MAGIC):
+                raise ValueError("It's not a memory binary")
+            samples = [MemCreate(host=host, **row) for row in decode_binary(body)]
+        else:
+            batch = MemoryBatch.model_validate_json(body)
+            host = batch.host
+            samples = [sample.model_copy(update={"host": host})
+                       for sample in batch.mem_data]
+    except (ValueError, ValidationError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e),
+        )
+    try:
+        count = await run_write(in_write_session, create_memories, samples)
+    except IntegrityError:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Some samples are already stored",
+        )
+    if samples:
+        response_cache.invalidate(host, max(to_micros(sample.time) for sample in samples))
+        samples = sorted(samples, key=lambda sample: sample.time)
+        for sample in samples:
+            message = sample.model_dump_json()
+            memory_hub.publish(message, topic=host)
+            share(SAMPLE, message)
+        # the rules are only evaluated by the leader, which gets the samples of the
+        # other workers by their messages
+        if is_leader():
+            await evaluate_alerts(samples)
+    return {"count": count}
+
+@router.get("/processes/", response_model=ProcessSnapshot)
+async def read_mem_processes(
+    current_user: Annotated[User, Depends(get_current_active_user)],
+    db: Annotated[Session, Depends(get_session)],
+    time: Optional[datetime.datetime] = None,
+    host: Optional[str] = None,
+) -> ProcessSnapshot:
+    """It returns the processes which used the most memory (by RSS) at a tick of the
+    sampler. They are only sampled when `AppSettings.Processes.enabled` is set, and
+    they are written in batches (see `AppSettings.Writer`), so the last ticks could be
+    seen after `flush_interval`. First, you should login and get a token.
+    (see /users/token)
+
+    Parameters
+    ----------
+        time
+            The last tick at or before it is returned. The default is the last tick.
+        host
+            The host of the processes. The default is this machine.
+
+    Return
+    ------
+    ProcessSnapshot
+        The time of the tick and its top processes from the largest one.
+    """
+    return await run_db(get_process_snapshot, db, host or settings.local_host, time)
+
+@router.get("/cache/", response_model=CacheStats)
+async def read_mem_cache_stats(
+    current_user: Annotated[User, Depends(get_current_active_user)]
+) -> CacheStats:
+    """It returns the statistics of the in-memory cache of the last samples which
+    serves /memory/info. First, you should login and get a token. (see /users/token)
+
+    Return
+    ------
+    CacheStats
+        The number of hits and misses, and the size and capacity of the cache.
+    """
+    return memory_ring.stats()
+
+@router.get("/retention/", response_model=RetentionStats)
+async def read_retention_stats(
+    current_user: Annotated[User, Depends(get_current_active_user)]
+) -> RetentionStats:
+    """It returns the statistics of deleting old samples by the retention policy since
+    the start (see `AppSettings.Retention`). First, you should login and get a token.
+    (see /users/token)
+
+    Return
+    ------
+    RetentionStats
+        The number of runs, pruned rows and vacuumed pages, and time spent in seconds.
+    """
+    return retention_stats
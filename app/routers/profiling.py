@@ -0,0 +1,39 @@
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, HTTPException, status
+
+from ..dependencies import get_current_admin_user
+from ..profiling import profile_store
+from ..sql.schemas import ListOfProfiles, RequestProfile, User
+
+
+router = APIRouter(prefix="/profiles", tags=["profiling"])
+
+@router.get("/", response_model=ListOfProfiles)
+async def read_profiles(
+    current_user: Annotated[User, Depends(get_current_admin_user)]
+) -> ListOfProfiles:
+    """It returns the last profiles of requests from the newest one. Only the admins could
+    read them. (see `AppSettings.Profiling`)
+
+    A request is profiled if profiling is enabled and an admin passes the profiling
+    header (`X-Profile` by default) with it, or one of each `sample_every` requests.
+
+    Return
+    ------
+    ListOfProfiles
+        The phase timings and the call-stack profile of each request.
+    """
+    return profile_store.list()
+
+@router.get("/{profile_id}", response_model=RequestProfile)
+async def read_profile(
+    current_user: Annotated[User, Depends(get_current_admin_user)],
+    profile_id: int
+) -> RequestProfile:
+    """It returns a profile of a request by its id. Only the admins could read it."""
+    profile = profile_store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="The profile is not found")
+    return profile
@@ -1,6 +1,8 @@
 from typing import Annotated
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 
 from ..dependencies import (
     authenticate_user,
@@ -8,8 +10,9 @@ from ..dependencies import (
     get_current_active_user,
     Token
 )
-from ..sql import get_db
-from ..sql.schemas import User, UserCreate
+from ..cache import user_cache
+from ..sql import get_session, in_write_session, run_db, run_write
+from ..sql.schemas import CacheStats, User, UserCreate
 from ..sql.crud import get_user, get_user_by_email, create_user
 
 router = APIRouter(prefix="/users", tags=["users"])
@@ -23,7 +26,8 @@ router = APIRouter(prefix="/users", tags=["users"])
              }
             )
 async def signup(
-    form_data: Annotated[UserCreate, Depends()]
+    form_data: Annotated[UserCreate, Depends()],
+    db: Annotated[Session, Depends(get_session)]
 ):
     """Signing up and creating a new user.
     
@@ -47,7 +51,7 @@ async def signup(
     """
     # TODO: The password should pass from user in hashed.
     # check user or username has already exited or not
-    user = get_user(get_db(), form_data.username)
+    user = await run_db(get_user, db, form_data.username)
     if user is not None:
         if user.email == form_data.email:
             raise HTTPException(
@@ -58,7 +62,7 @@ async def signup(
             status_code=status.HTTP_406_NOT_ACCEPTABLE,
             detail="This username is already exist!",
         )
-    user = get_user_by_email(get_db(), form_data.email)
+    user = await run_db(get_user_by_email, db, form_data.email)
     if user is not None:
         raise HTTPException(
             status_code=status.HTTP_406_NOT_ACCEPTABLE,
@@ -68,7 +72,14 @@ async def signup(
     new_user = UserCreate(username=form_data.username,
                           email=form_data.email,
                           password=form_data.password)
-    create_user(get_db(), new_user)
+    try:
+        await run_write(in_write_session, create_user, new_user)
+    except IntegrityError:
+        # the same user is signed up by another request after the checks
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+            detail="This account is already exist!",
+        )
     return {"message": "Your account has been created successfully!"}
 
 @router.post("/token",
@@ -78,7 +89,8 @@ async def signup(
                 401: {"detail": "Incorrect username or password"}
              })
 async def login_for_access_token(
-    form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+    db: Annotated[Session, Depends(get_session)]
 ):
     """Logging up and creating a new token to work with the API. First, you should register.
     (see /users/register)
@@ -96,7 +108,7 @@ async def login_for_access_token(
         "token_type. If username or email does not exist, it will return a message
         with code HTTP401 and detail.
     """
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await run_db(authenticate_user, db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -123,4 +135,18 @@ async def check_token(current_user: Annotated[User, Depends(get_current_active_u
         This function requires a token. It should be passed a Bearer token type that
         got from API. See Also: /users/token
     """
-    return current_user
\ No newline at end of file
+    return current_user
+
+@router.get("/cache/", response_model=CacheStats)
+async def read_user_cache_stats(
+    current_user: Annotated[User, Depends(get_current_active_user)]
+) -> CacheStats:
+    """It returns the statistics of the cache of token users. First, you should login and
+    get a token. (see /users/token)
+
+    Return
+    ------
+    CacheStats
+        The number of hits and misses, and the size and capacity of the cache.
+    """
+    return user_cache.stats()
\ No newline at end of file
@@ -0,0 +1,52 @@
+import asyncio
+import math
+import time
+from typing import AsyncIterator, Awaitable, Callable, NamedTuple, Tuple
+
+
+class Tick(NamedTuple):
+    # the deadline of the tick in seconds of the clock
+    deadline: float
+    # how long after the deadline the tick started
+    lateness: float
+    # the number of deadlines which were skipped before this tick
+    missed: int
+
+
+def skip_missed(deadline: float, now: float, interval: float) -> Tuple[float, int]:
+    """Returns the last deadline of the schedule which is not after now (or the deadline
+    if it's not passed), and the number of the skipped deadlines before it"""
+    missed = max(0, math.floor((now - deadline) / interval))
+    return deadline + missed * interval, missed
+
+
+class FixedRateScheduler:
+    """Gives ticks at a fixed rate on absolute deadlines of a monotonic clock.
+
+    The n-th deadline is `start + n * interval`, so the time spent in a tick or a late
+    wake-up does not shift the next ones (no drift). When a tick takes longer than the
+    interval, the passed deadlines are skipped and reported as missed, and the next tick
+    keeps the phase of the schedule. Intervals down to about 10 ms work; below that the
+    resolution of the timers of the event loop is too coarse.
+    """
+    def __init__(self,
+                 interval: float,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], Awaitable] = asyncio.sleep):
+        if not interval > 0:
+            raise ValueError(f"The interval should be positive, not {interval}")
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+
+    async def ticks(self) -> AsyncIterator[Tick]:
+        """Yields a tick on each deadline from now on"""
+        deadline = self.clock()
+        while True:
+            now = self.clock()
+            if now < deadline:
+                await self.sleep(deadline - now)
+                now = self.clock()
+            deadline, missed = skip_missed(deadline, now, self.interval)
+            yield Tick(deadline=deadline, lateness=now - deadline, missed=missed)
+            deadline += self.interval
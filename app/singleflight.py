@@ -0,0 +1,52 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from .sql import schemas
+
+
+class SingleFlight:
+    """Coalesces the identical calls which run at the same time.
+
+    The first call of a key starts the call and the ones which come while it's running
+    wait for the same result (or exception) instead of starting their own, e.g. a herd
+    of dashboards which refresh at the same moment makes one database query. The call
+    runs as its own task, so a caller which is cancelled (e.g. its client is gone) does
+    not cancel it for the others. Nothing is kept after the call is done; caching the
+    result is up to the caller.
+    """
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+        # the calls which are run and the ones which waited for another one
+        self.executed = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """Returns the result of `func()`, or of the running call of the same key"""
+        future = self.calls.get(key)
+        if future is None:
+            self.executed += 1
+            future = asyncio.ensure_future(func())
+            self.calls[key] = future
+            future.add_done_callback(lambda _: self._done(key, future))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+    def _done(self, key: Hashable, future: asyncio.Future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
+        # the exception is retrieved here, so it's not logged if all callers are gone
+        if not future.cancelled():
+            future.exception()
+
+    def stats(self) -> schemas.FlightStats:
+        return schemas.FlightStats(executed=self.executed,
+                                   coalesced=self.coalesced,
+                                   in_flight=len(self.calls))
+
+
+# the database reads of /memory/info
+memory_flight = SingleFlight()
@@ -1,22 +1,140 @@
-from sqlalchemy import create_engine
+import asyncio
+import contextvars
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, TypeVar
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 
 from ..config import sql_settings, sql_session_settings
+from ..metrics import db_commit_seconds, db_query_seconds, phase
+
+T = TypeVar("T")
+
+_is_sqlite = sql_settings.url.startswith("sqlite")
+# a database in memory is only seen by its own connection
+_is_sqlite_file = _is_sqlite and sql_settings.url not in ("sqlite://", "sqlite:///:memory:")
+
+def _create_engine(**kwargs):
+    return create_engine(
+        sql_settings.url,
+        # the sessions are used by the threads of `db_executor` and `write_executor`
+        connect_args={"check_same_thread": False} if _is_sqlite else {},
+        pool_timeout=sql_settings.pool_timeout,
+        **kwargs,
+    )
+
+def _set_sqlite_pragmas(dbapi_connection, writer: bool):
+    cursor = dbapi_connection.cursor()
+    if writer:
+        # the free pages of a new database file could be given back by incremental
+        # vacuum (see `app.retention`). It has no effect on an existing file, and it
+        # should be set before the journal mode which writes the file.
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute(f"PRAGMA journal_mode = {sql_settings.journal_mode}")
+    else:
+        # a reader never takes the write lock
+        cursor.execute("PRAGMA query_only = ON")
+    cursor.execute(f"PRAGMA synchronous = {sql_settings.synchronous}")
+    cursor.execute(f"PRAGMA cache_size = {int(sql_settings.cache_size)}")
+    cursor.execute(f"PRAGMA mmap_size = {int(sql_settings.mmap_size)}")
+    cursor.execute("PRAGMA busy_timeout = "
+                   f"{int(sql_settings.busy_timeout.total_seconds() * 1000)}")
+    cursor.close()
+
+if _is_sqlite_file:
+    # the writer thread keeps one connection. The overflow is only for the sessions of
+    # scripts and tests (see `get_db`).
+    engine = _create_engine(pool_size=1, max_overflow=sql_settings.max_overflow)
+    # the read-only connections of the requests
+    read_engine = _create_engine(pool_size=sql_settings.pool_size,
+                                 max_overflow=sql_settings.max_overflow)
+
+    @event.listens_for(engine, "connect")
+    def _set_writer_pragmas(dbapi_connection, connection_record):
+        _set_sqlite_pragmas(dbapi_connection, writer=True)
+
+    @event.listens_for(read_engine, "connect")
+    def _set_reader_pragmas(dbapi_connection, connection_record):
+        _set_sqlite_pragmas(dbapi_connection, writer=False)
+else:
+    engine = read_engine = _create_engine(pool_size=sql_settings.pool_size,
+                                          max_overflow=sql_settings.max_overflow)
+
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
 
-engine = create_engine(
-    sql_settings.url,
-    # NOTE: If we use multithread, we could use this args too:
-    # connect_args={"check_same_thread": False}
-)
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    # the kind of the statement (SELECT, INSERT, ...) is the label
+    db_query_seconds.observe(elapsed, statement.lstrip().split(None, 1)[0].upper())
 
-SessionLocal = sessionmaker(bind=engine, **(sql_session_settings.model_dump()))
+for _engine in {engine, read_engine}:
+    event.listen(_engine, "before_cursor_execute", _start_query)
+    event.listen(_engine, "after_cursor_execute", _end_query)
+
+
+class TimedSession(Session):
+    """A session which measures the latency of its commits"""
+    def commit(self):
+        with db_commit_seconds.time():
+            super().commit()
+
+
+SessionLocal = sessionmaker(bind=engine,
+                            class_=TimedSession,
+                            **(sql_session_settings.model_dump()))
+# the sessions of the requests which only read
+ReadSessionLocal = sessionmaker(bind=read_engine,
+                                class_=TimedSession,
+                                **(sql_session_settings.model_dump()))
 
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
+# the threads in which the blocking database calls run
+db_executor = ThreadPoolExecutor(max_workers=sql_settings.threads,
+                                 thread_name_prefix="db")
+# the only thread which writes to database, so the writes never wait for each other's
+# locks and a write never waits behind the reads for a thread
+write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+
+def get_db() -> Session:
+    """Returns a new session. The caller owns it and should close it, e.g. by
+    `with get_db() as db:` (the tests use the `db` fixture)."""
+    return SessionLocal()
+
+def get_session() -> Iterator[Session]:
+    """A dependency which gives a read-only session to a request and closes it at the
+    end. The writes of a request run by `run_write` and `in_write_session`."""
+    db = ReadSessionLocal()
     try:
-        return db
+        yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def run_db(func: Callable[..., T], *args, **kwargs) -> T:
+    """Runs a blocking database function in `db_executor`, so the event loop could
+    serve other requests while it's waiting for database. The function runs in a copy of
+    the context of the caller (like `asyncio.to_thread`), so it could add to the phases
+    of a profiled request (see `app.profiling`)."""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    with phase("db"):
+        return await loop.run_in_executor(db_executor, call)
+
+async def run_write(func: Callable[..., T], *args, **kwargs) -> T:
+    """Like `run_db` but for a function which writes to database. It runs in
+    `write_executor`, so the writes are done one by one by a single writer."""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    with phase("db_write"):
+        return await loop.run_in_executor(write_executor, call)
+
+def in_write_session(func: Callable[..., T], *args, **kwargs) -> T:
+    """Calls a function with a new session as its first argument and closes the session
+    at the end, e.g. `await run_write(in_write_session, crud.create_user, user)`"""
+    with SessionLocal() as db:
+        return func(db, *args, **kwargs)
@@ -1,9 +1,19 @@
+import base64
+import binascii
 import datetime
+import itertools
 from hashlib import sha256
+from typing import Dict, List, Optional, Sequence
 
+from sqlalchemy import func, insert, select
 from sqlalchemy.orm import Session
 
+from ..cache import invalidate_user
+from ..config import settings, storage_settings
 from . import models, schemas
+from .ring import FLAG_FIELDS, MEMORY_FIELDS, memory_ring, to_iso, to_micros, from_micros
+from .segments import get_segment_store
+from .sketch import LogHistogram
 
 
 def get_user(db: Session, username: str) -> schemas.User:
@@ -25,20 +35,441 @@ def create_user(db: Session, user: schemas.UserCreate):
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    invalidate_user(user.username)
     return db_user
 
+def update_user(db: Session,
+                username: str,
+                email: Optional[str] = None,
+                password: Optional[str] = None):
+    """change email or password of a user"""
+    db_user = get_user(db, username)
+    if db_user is None:
+        return None
+    if email is not None:
+        db_user.email = email
+    if password is not None:
+        db_user.password = sha256(password.encode()).digest()
+    db.commit()
+    db.refresh(db_user)
+    invalidate_user(username)
+    return db_user
+
+def set_user_activated(db: Session, username: str, activated: bool):
+    """activate or deactivate a user"""
+    db_user = get_user(db, username)
+    if db_user is None:
+        return None
+    db_user.activated = activated
+    db.commit()
+    db.refresh(db_user)
+    invalidate_user(username)
+    return db_user
+
+
+def _is_local(host: str) -> bool:
+    """Checks the samples of the host are the ones in `memory_ring` or not"""
+    return host == settings.local_host
+
+def get_mem(db: Session,
+            limit: int = 5,
+            host: Optional[str] = None
+) -> schemas.ListOfMemory:
+    """Returns last n memory usage of a host (this machine by default) that were logged.
+    The recent local samples are read from `memory_ring` and database is only queried
+    for the older ones."""
+    host = host or settings.local_host
+    cached = memory_ring.latest(limit) if _is_local(host) else []
+    if len(cached) == limit:
+        memory_ring.hits += 1
+        return schemas.ListOfMemory(mem_data=cached)
+    memory_ring.misses += 1
+    # the cached ones could be not written to database yet
+    end = cached[-1].time if cached else None
+    mem_data = read_raw(db, host, end=end, descending=True, limit=limit - len(cached))
+    return schemas.ListOfMemory(mem_data=cached + mem_data)
+
+def get_mem_columns(db: Session,
+                    limit: int = 5,
+                    host: Optional[str] = None,
+                    epoch: bool = False
+) -> Dict[str, list]:
+    """Returns last n memory usage of a host like `get_mem`, but column by column: the
+    times (as ISO strings, or microseconds since epoch if `epoch` is set) and a list of
+    each field from the newest sample. The rows are read as tuples and no sample object
+    is made, so it's much cheaper for a large n."""
+    host = host or settings.local_host
+    micros: List[int] = []
+    columns: Dict[str, list] = {name: [] for name in MEMORY_FIELDS}
+    if _is_local(host):
+        micros, columns = memory_ring.latest_columns(limit)
+    if epoch:
+        times = micros
+    else:
+        times = [to_iso(from_micros(value)) for value in micros]
+    if len(micros) == limit:
+        memory_ring.hits += 1
+    else:
+        memory_ring.misses += 1
+        # the cached ones could be not written to database yet
+        end = from_micros(micros[-1]) if micros else None
+        rows = read_raw_rows(db, host, end=end, descending=True, limit=limit - len(micros))
+        if rows:
+            transposed = list(zip(*rows))
+            if epoch:
+                times += map(to_micros, transposed[0])
+            else:
+                times += map(to_iso, transposed[0])
+            for name, values in zip(MEMORY_FIELDS, transposed[1:]):
+                columns[name] += values
+    for name in FLAG_FIELDS:
+        columns[name] = [None if value is None else bool(value) for value in columns[name]]
+    return {"host": host, "time": times, **columns}
+
+def read_raw_rows(db: Session,
+                  host: str,
+                  start: Optional[datetime.datetime] = None,
+                  end: Optional[datetime.datetime] = None,
+                  descending: bool = False,
+                  limit: Optional[int] = None
+) -> List[tuple]:
+    """Reads raw samples of a host like `read_raw`, but as tuples of time and
+    MEMORY_FIELDS"""
+    if storage_settings.backend == "segments":
+        rows = get_segment_store(host).scan(start, end, reverse=descending)
+        return list(itertools.islice(rows, limit))
+    q = select(models.Memory.time,
+               *[getattr(models.Memory, name) for name in MEMORY_FIELDS]).where(
+        models.Memory.host == host)
+    if start is not None:
+        q = q.where(models.Memory.time >= start)
+    if end is not None:
+        q = q.where(models.Memory.time < end)
+    order = models.Memory.time.desc() if descending else models.Memory.time.asc()
+    q = q.order_by(order)
+    if limit is not None:
+        q = q.limit(limit)
+    # it's executed by the connection to not make ORM results
+    return [tuple(row) for row in db.connection().execute(q)]
+
+def read_raw(db: Session,
+             host: str,
+             start: Optional[datetime.datetime] = None,
+             end: Optional[datetime.datetime] = None,
+             descending: bool = False,
+             limit: Optional[int] = None
+) -> List[schemas.Memory]:
+    """Reads raw samples of a host in [start, end) from the storage backend (see
+    `storage_settings.backend`). Both bounds and limit are optional."""
+    if storage_settings.backend == "segments":
+        rows = get_segment_store(host).scan(start, end, reverse=descending)
+        fields = ("time",) + MEMORY_FIELDS
+        return [schemas.Memory(host=host, **dict(zip(fields, row)))
+                for row in itertools.islice(rows, limit)]
+    q = db.query(models.Memory).filter(models.Memory.host == host)
+    if start is not None:
+        q = q.filter(models.Memory.time >= start)
+    if end is not None:
+        q = q.filter(models.Memory.time < end)
+    order = models.Memory.time.desc() if descending else models.Memory.time.asc()
+    q = q.order_by(order)
+    if limit is not None:
+        q = q.limit(limit)
+    return [schemas.Memory(**(mem.__dict__)) for mem in q]
+
+def encode_cursor(time: datetime.datetime) -> str:
+    """makes an opaque cursor token from time of the last returned sample"""
+    return base64.urlsafe_b64encode(str(to_micros(time)).encode()).decode()
+
+def decode_cursor(cursor: str) -> datetime.datetime:
+    """returns time of a cursor token. It raises ValueError for invalid tokens."""
+    try:
+        return from_micros(int(base64.urlsafe_b64decode(cursor.encode())))
+    except (binascii.Error, OverflowError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def get_mem_page(db: Session,
+                 limit: int = 100,
+                 start: Optional[datetime.datetime] = None,
+                 end: Optional[datetime.datetime] = None,
+                 cursor: Optional[str] = None,
+                 descending: bool = True,
+                 host: Optional[str] = None
+) -> schemas.PageOfMemory:
+    """Returns a page of memory usage of a host in [start, end) after the cursor. It uses
+    keyset pagination on the (host, time) primary key, so the cost of a page does not
+    depend on how deep it is."""
+    host = host or settings.local_host
+    low, high = start, end
+    if cursor is not None:
+        after = decode_cursor(cursor)
+        if descending:
+            high = after if high is None else min(high, after)
+        else:
+            after += datetime.timedelta(microseconds=1)
+            low = after if low is None else max(low, after)
+    # one more row shows there is a next page or not
+    mem_data = read_raw(db, host, low, high, descending=descending, limit=limit + 1)
+    if len(mem_data) > limit:
+        # the cached samples behind the extra row are not needed for this page
+        boundary = mem_data[-1].time
+        if descending:
+            low = boundary if low is None else max(low, boundary)
+        else:
+            boundary += datetime.timedelta(microseconds=1)
+            high = boundary if high is None else min(high, boundary)
+    # the recent samples in the ring could be not written to database yet
+    if _is_local(host) and (low is None or high is None or low < high):
+        seen = {mem.time for mem in mem_data}
+        mem_data += [mem for mem in memory_ring.between(low, high) if mem.time not in seen]
+        mem_data.sort(key=lambda mem: mem.time, reverse=descending)
+    next_cursor = None
+    if len(mem_data) > limit:
+        mem_data = mem_data[:limit]
+        next_cursor = encode_cursor(mem_data[-1].time)
+    return schemas.PageOfMemory(mem_data=mem_data, next_cursor=next_cursor)
+
+def get_mem_range(db: Session,
+                  start: datetime.datetime,
+                  end: datetime.datetime,
+                  points: int = 500,
+                  resolution: Optional[int] = None,
+                  host: Optional[str] = None
+) -> schemas.MemoryRange:
+    """Returns memory usage of a host between start and end from the coarsest rollup tier
+    which still has at least `points` points in the range, or whose resolution is not
+    more than `resolution` seconds if it's given. If no tier is fine enough, raw samples
+    are used."""
+    host = host or settings.local_host
+    if resolution:
+        step = resolution
+    else:
+        step = (end - start).total_seconds() / points
+    tier = None
+    for candidate in models.ROLLUP_TIERS:
+        if candidate.resolution <= step:
+            tier = candidate
+    if tier is None:
+        return schemas.MemoryRange(resolution=0,
+                                   mem_data=_get_raw_range(db, host, start, end))
+    q = db.query(tier).filter(tier.host == host,
+                              tier.time >= _bucket_start(start, tier.resolution),
+                              tier.time < end)
+    mem_data = [schemas.MemoryPoint.model_validate(row) for row in q.order_by(tier.time)]
+    return schemas.MemoryRange(resolution=tier.resolution, mem_data=mem_data)
+
+def _get_raw_range(db: Session,
+                   host: str,
+                   start: datetime.datetime,
+                   end: datetime.datetime
+) -> List[schemas.MemoryPoint]:
+    """Returns raw samples between start and end as points of one sample"""
+    mem_data = read_raw(db, host, start, end)
+    # the recent samples in the ring could be not written to database yet
+    if mem_data:
+        start = max(start, mem_data[-1].time + datetime.timedelta(microseconds=1))
+    cached = memory_ring.between(start, end)[::-1] if _is_local(host) else []
+    points = []
+    for mem in mem_data + cached:
+        point = {"host": host, "time": mem.time, "count": 1}
+        for name in models.ROLLUP_FIELDS:
+            value = getattr(mem, name)
+            point.update({f"{name}_min": value, f"{name}_max": value,
+                          f"{name}_avg": value, f"{name}_last": value})
+        points.append(schemas.MemoryPoint(**point))
+    return points
+
+def _bucket_start(time: datetime.datetime, resolution: int) -> datetime.datetime:
+    """Returns start of the bucket of `resolution` seconds which contains the time"""
+    micros = to_micros(time)
+    return from_micros(micros - micros % (resolution * 1_000_000))
 
-def get_mem(db: Session, limit: int = 5) -> schemas.ListOfMemory:
-    """Returns last n memory usage that were logged"""
-    q = db.query(models.Memory).order_by(models.Memory.time.desc())
-    mem_data = q.limit(limit).all()
-    mem_data = [schemas.Memory(**(mem.__dict__)) for mem in mem_data]
-    return schemas.ListOfMemory(mem_data=mem_data)
+def _merge_rollup(row: models.MemoryRollup, memories: List[schemas.MemCreate]):
+    """Merges the samples of a bucket into its rollup row"""
+    count = row.count or 0
+    last = max(memories, key=lambda memory: memory.time)
+    is_last = row.last_time is None or last.time >= row.last_time
+    for name in models.ROLLUP_FIELDS:
+        values = [getattr(memory, name) for memory in memories]
+        low, high, total = min(values), max(values), sum(values)
+        squares = sum(value * value for value in values)
+        if count:
+            low = min(low, getattr(row, f"{name}_min"))
+            high = max(high, getattr(row, f"{name}_max"))
+            total += getattr(row, f"{name}_avg") * count
+            # a rollup of an older version has no sum of squares, so it stays unknown
+            old_squares = getattr(row, f"{name}_sumsq")
+            squares = None if old_squares is None else squares + old_squares
+        setattr(row, f"{name}_min", low)
+        setattr(row, f"{name}_max", high)
+        setattr(row, f"{name}_avg", total / (count + len(values)))
+        setattr(row, f"{name}_sumsq", squares)
+        # a rollup of an older version has no histogram, so it's not made for a part
+        # of its samples
+        hist = getattr(row, f"{name}_hist")
+        if not count or hist is not None:
+            histogram = LogHistogram() if not count else LogHistogram.decode(hist)
+            histogram.extend(values)
+            setattr(row, f"{name}_hist", histogram.encode())
+        if is_last:
+            setattr(row, f"{name}_last", getattr(last, name))
+    row.count = count + len(memories)
+    if is_last:
+        row.last_time = last.time
+
+def update_rollups(db: Session, memories: Sequence[schemas.MemCreate]):
+    """Merges new samples into all the rollup tiers incrementally. It does not commit."""
+    hosts: Dict[str, List[schemas.MemCreate]] = {}
+    for memory in memories:
+        hosts.setdefault(memory.host, []).append(memory)
+    for tier in models.ROLLUP_TIERS:
+        for host, host_memories in hosts.items():
+            buckets: Dict[datetime.datetime, List[schemas.MemCreate]] = {}
+            for memory in host_memories:
+                start = _bucket_start(memory.time, tier.resolution)
+                buckets.setdefault(start, []).append(memory)
+            q = db.query(tier).filter(tier.host == host, tier.time.in_(list(buckets)))
+            rows = {row.time: row for row in q}
+            for start, bucket in buckets.items():
+                row = rows.get(start)
+                if row is None:
+                    row = tier(host=host, time=start)
+                    db.add(row)
+                _merge_rollup(row, bucket)
 
 def create_memory(db: Session, memory: schemas.MemCreate):
     """create memory and insert to database"""
+    if storage_settings.backend == "segments":
+        get_segment_store(memory.host).append([memory])
+        update_rollups(db, [memory])
+        db.commit()
+        return memory
     db_mem = models.Memory(**(memory.dict()))
     db.add(db_mem)
+    update_rollups(db, [memory])
     db.commit()
     db.refresh(db_mem)
     return db_mem
+
+def create_memories(db: Session, memories: Sequence[schemas.MemCreate]) -> int:
+    """insert a batch of memories to database by one bulk insert and one commit"""
+    if not memories:
+        return 0
+    if storage_settings.backend == "segments":
+        count = 0
+        hosts: Dict[str, List[schemas.MemCreate]] = {}
+        for memory in memories:
+            hosts.setdefault(memory.host, []).append(memory)
+        for host, host_memories in hosts.items():
+            count += get_segment_store(host).append(host_memories)
+    else:
+        count = len(memories)
+        db.execute(insert(models.Memory), [memory.model_dump() for memory in memories])
+    update_rollups(db, memories)
+    db.commit()
+    return count
+
+def delete_old_rows(db: Session,
+                    model,
+                    cutoff: datetime.datetime,
+                    limit: int
+) -> int:
+    """Deletes about `limit` of the oldest rows of a table (Memory or a rollup tier) which
+    are before the cutoff in one short transaction and returns the number of them. The
+    rows are bounded by the time of the limit-th oldest one, so it only walks the index
+    of time."""
+    bound = (db.query(model.time).filter(model.time < cutoff).order_by(model.time)
+             .offset(limit - 1).limit(1).scalar())
+    condition = model.time < cutoff if bound is None else model.time <= bound
+    count = db.query(model).filter(condition).delete(synchronize_session=False)
+    db.commit()
+    return count
+
+def create_process_memories(db: Session, rows: Sequence[schemas.ProcessMemory]) -> int:
+    """insert the top processes of a tick to database by one bulk insert"""
+    if not rows:
+        return 0
+    db.execute(insert(models.ProcessMemory), [row.model_dump() for row in rows])
+    db.commit()
+    return len(rows)
+
+def get_process_snapshot(db: Session,
+                         host: str,
+                         time: Optional[datetime.datetime] = None
+) -> schemas.ProcessSnapshot:
+    """get the top processes of a host at the last tick at or before the time (the last
+    one by default) from the largest one"""
+    q = db.query(func.max(models.ProcessMemory.time)).filter(
+        models.ProcessMemory.host == host)
+    if time is not None:
+        q = q.filter(models.ProcessMemory.time <= time)
+    last_time = q.scalar()
+    if last_time is None:
+        return schemas.ProcessSnapshot(host=host, processes=[])
+    rows = (db.query(models.ProcessMemory)
+            .filter(models.ProcessMemory.host == host,
+                    models.ProcessMemory.time == last_time)
+            .order_by(models.ProcessMemory.rss.desc())
+            .all())
+    return schemas.ProcessSnapshot(
+        host=host, time=last_time,
+        processes=[schemas.ProcessMemory.model_validate(row) for row in rows])
+
+def get_alert_rules(db: Session) -> List[models.AlertRule]:
+    """get all the alert rules from database"""
+    return db.query(models.AlertRule).order_by(models.AlertRule.id).all()
+
+def get_alert_rule(db: Session, rule_id: int) -> Optional[models.AlertRule]:
+    """get an alert rule from database by its id"""
+    return db.get(models.AlertRule, rule_id)
+
+def create_alert_rule(db: Session, rule: schemas.AlertRuleCreate) -> models.AlertRule:
+    """create an alert rule and insert to database"""
+    db_rule = models.AlertRule(**rule.model_dump())
+    db.add(db_rule)
+    db.commit()
+    db.refresh(db_rule)
+    return db_rule
+
+def update_alert_rule(db: Session, rule_id: int, rule: schemas.AlertRuleCreate
+) -> Optional[models.AlertRule]:
+    """replace an alert rule by its id"""
+    db_rule = get_alert_rule(db, rule_id)
+    if db_rule is None:
+        return None
+    for name, value in rule.model_dump().items():
+        setattr(db_rule, name, value)
+    db.commit()
+    db.refresh(db_rule)
+    return db_rule
+
+def delete_alert_rule(db: Session, rule_id: int) -> bool:
+    """delete an alert rule by its id. Its events are kept."""
+    count = (db.query(models.AlertRule).filter(models.AlertRule.id == rule_id)
+             .delete(synchronize_session=False))
+    db.commit()
+    return count > 0
+
+def create_alert_events(db: Session, events: Sequence[schemas.AlertEventCreate]
+) -> List[models.AlertEvent]:
+    """insert alert events to database by one commit"""
+    db_events = [models.AlertEvent(**event.model_dump()) for event in events]
+    db.add_all(db_events)
+    db.commit()
+    for db_event in db_events:
+        db.refresh(db_event)
+    return db_events
+
+def get_alert_events(db: Session,
+                     rule_id: Optional[int] = None,
+                     host: Optional[str] = None,
+                     limit: int = 100
+) -> List[models.AlertEvent]:
+    """get the last alert events (of a rule or a host) from the newest one"""
+    q = db.query(models.AlertEvent)
+    if rule_id is not None:
+        q = q.filter(models.AlertEvent.rule_id == rule_id)
+    if host is not None:
+        q = q.filter(models.AlertEvent.host == host)
+    q = q.order_by(models.AlertEvent.time.desc(), models.AlertEvent.id.desc())
+    return q.limit(limit).all()
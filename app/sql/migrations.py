@@ -0,0 +1,83 @@
+import logging
+from typing import Dict
+
+from sqlalchemy import Connection, Table, inspect, text
+
+from ..config import settings
+from . import Base
+
+# the values of the new columns of the old rows which could not be null, e.g. the
+# samples before adding hosts are the samples of this host
+FILL_VALUES: Dict[str, object] = {"host": settings.local_host}
+
+
+class SchemaError(RuntimeError):
+    """The tables of the database could not be upgraded to the models"""
+
+
+def _quote(connection: Connection, name: str) -> str:
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+def _add_columns(connection: Connection, table: Table, names):
+    for name in names:
+        column = table.columns[name]
+        column_type = column.type.compile(dialect=connection.dialect)
+        connection.execute(text(f"ALTER TABLE {_quote(connection, table.name)} "
+                                f"ADD COLUMN {_quote(connection, name)} {column_type}"))
+        if name in FILL_VALUES:
+            connection.execute(text(f"UPDATE {_quote(connection, table.name)} "
+                                    f"SET {_quote(connection, name)} = :value"),
+                               {"value": FILL_VALUES[name]})
+        logging.info(f"The column {name} is added to {table.name}.")
+
+
+def _rebuild(connection: Connection, table: Table, old_columns):
+    """Creates the table again by the model and copies the old rows to it. The new
+    columns are null or their `FILL_VALUES`."""
+    old_name = f"{table.name}_old"
+    for index in inspect(connection).get_indexes(table.name):
+        connection.execute(text(f"DROP INDEX {_quote(connection, index['name'])}"))
+    connection.execute(text(f"ALTER TABLE {_quote(connection, table.name)} "
+                            f"RENAME TO {_quote(connection, old_name)}"))
+    table.create(connection)
+    names = [column.name for column in table.columns
+             if column.name in old_columns or column.name in FILL_VALUES]
+    values = [_quote(connection, name) if name in old_columns else f":{name}"
+              for name in names]
+    connection.execute(
+        text(f"INSERT INTO {_quote(connection, table.name)} "
+             f"({', '.join(_quote(connection, name) for name in names)}) "
+             f"SELECT {', '.join(values)} FROM {_quote(connection, old_name)}"),
+        {name: value for name, value in FILL_VALUES.items() if name not in old_columns})
+    connection.execute(text(f"DROP TABLE {_quote(connection, old_name)}"))
+    logging.info(f"{table.name} is rebuilt for its new primary key.")
+
+
+def upgrade(connection: Connection):
+    """Upgrades the existing tables of a database which is made by an older version to
+    the models. The missing nullable columns are added, and a table whose primary key is
+    changed (e.g. `host` of `Memory`) is rebuilt. It raises `SchemaError` if a missing
+    column could not be null and has no fill value, so the app does not start and drop
+    the samples. The missing tables are not made here (see `create_all`)."""
+    inspector = inspect(connection)
+    existing = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+        old_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        missing = [column for column in table.columns if column.name not in old_columns]
+        if not missing:
+            continue
+        required = [column.name for column in missing
+                    if (column.primary_key or not column.nullable)
+                    and column.name not in FILL_VALUES]
+        if required:
+            raise SchemaError(f"The table {table.name} of the database has no "
+                              f"{', '.join(required)} and it could not be added. "
+                              f"Upgrade the database or use a new one.")
+        old_primary_key = inspector.get_pk_constraint(table.name)["constrained_columns"]
+        if set(old_primary_key) != {column.name for column in table.primary_key}:
+            _rebuild(connection, table, old_columns)
+        else:
+            _add_columns(connection, table, [column.name for column in missing])
@@ -2,6 +2,8 @@ from sqlalchemy import (
     Boolean,
     Column,
     Float,
+    Integer,
+    LargeBinary,
     String,
     TIMESTAMP,
     VARCHAR
@@ -19,7 +21,117 @@ class User(Base):
 
 class Memory(Base):
     __tablename__ = "Memory"
-    time = Column(TIMESTAMP, primary_key=True)
+    # the primary key (host, time) is also the index of the reads of a host and the
+    # index of time is used by the retention of all the hosts
+    host = Column(String, primary_key=True)
+    time = Column(TIMESTAMP, primary_key=True, index=True)
     free = Column(Float)
     used = Column(Float)
-    total = Column(Float)
\ No newline at end of file
+    total = Column(Float)
+    available = Column(Float, nullable=True)
+    buffers = Column(Float, nullable=True)
+    cached = Column(Float, nullable=True)
+    swap_total = Column(Float, nullable=True)
+    swap_used = Column(Float, nullable=True)
+    swap_free = Column(Float, nullable=True)
+    psi_avg10 = Column(Float, nullable=True)
+    psi_avg60 = Column(Float, nullable=True)
+    pressure_triggered = Column(Boolean, nullable=True)
+
+
+class MemoryRollup:
+    """Aggregates of the memory samples in a time bucket. `time` is the start of the
+    bucket and the bucket length is `resolution` seconds. The sum of squares of each
+    field is kept to compute its standard deviation, and a histogram of it
+    (`LogHistogram`) to estimate its percentiles (see `app.stats`). The histograms are
+    null for the rollups of an older version."""
+    host = Column(String, primary_key=True)
+    time = Column(TIMESTAMP, primary_key=True, index=True)
+    # time of the last sample in the bucket
+    last_time = Column(TIMESTAMP)
+    count = Column(Integer)
+    free_min = Column(Float)
+    free_max = Column(Float)
+    free_avg = Column(Float)
+    free_last = Column(Float)
+    free_sumsq = Column(Float)
+    free_hist = Column(LargeBinary, nullable=True)
+    used_min = Column(Float)
+    used_max = Column(Float)
+    used_avg = Column(Float)
+    used_last = Column(Float)
+    used_sumsq = Column(Float)
+    used_hist = Column(LargeBinary, nullable=True)
+    total_min = Column(Float)
+    total_max = Column(Float)
+    total_avg = Column(Float)
+    total_last = Column(Float)
+    total_sumsq = Column(Float)
+    total_hist = Column(LargeBinary, nullable=True)
+
+
+class MemoryRollup1m(MemoryRollup, Base):
+    __tablename__ = "MemoryRollup1m"
+    resolution = 60
+
+
+class MemoryRollup1h(MemoryRollup, Base):
+    __tablename__ = "MemoryRollup1h"
+    resolution = 60 * 60
+
+
+class MemoryRollup1d(MemoryRollup, Base):
+    __tablename__ = "MemoryRollup1d"
+    resolution = 24 * 60 * 60
+
+
+# the rollup tiers from the finest to the coarsest
+ROLLUP_TIERS = (MemoryRollup1m, MemoryRollup1h, MemoryRollup1d)
+# the fields of samples which are rolled up
+ROLLUP_FIELDS = ("free", "used", "total")
+
+
+class ProcessMemory(Base):
+    """The memory usage of a top process by RSS at the time of a sample"""
+    __tablename__ = "ProcessMemory"
+    host = Column(String, primary_key=True)
+    time = Column(TIMESTAMP, primary_key=True, index=True)
+    pid = Column(Integer, primary_key=True)
+    name = Column(String)
+    cmdline = Column(String)
+    rss = Column(Float)
+    vms = Column(Float)
+
+
+class AlertRule(Base):
+    """A rule which is evaluated on each new sample (see `app.alerts`)"""
+    __tablename__ = "AlertRule"
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    # None for all the hosts
+    host = Column(String, nullable=True)
+    field = Column(String)
+    # "threshold", "zscore" or "rate"
+    kind = Column(String)
+    operator = Column(String)
+    threshold = Column(Float)
+    # the weight of a new sample in the moving mean and variance of "zscore"
+    alpha = Column(Float)
+    # the number of samples before "zscore" is evaluated
+    min_samples = Column(Integer)
+    # the window of "rate" in seconds
+    window = Column(Integer)
+    enabled = Column(Boolean, default=True)
+
+
+class AlertEvent(Base):
+    """A change of the state of a rule for a host"""
+    __tablename__ = "AlertEvent"
+    id = Column(Integer, primary_key=True)
+    rule_id = Column(Integer, index=True)
+    host = Column(String)
+    time = Column(TIMESTAMP, index=True)
+    # "firing" or "resolved"
+    state = Column(String)
+    # the evaluated value: the field, its z-score or its rate of change
+    value = Column(Float)
@@ -0,0 +1,134 @@
+import datetime
+import math
+import threading
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from ..config import cache_settings
+from . import schemas
+
+
+# the fields of a sample except its time
+MEMORY_FIELDS = tuple(schemas.MemBase.model_fields)
+# the flags of MEMORY_FIELDS. They are kept as 1 and 0 like the other fields.
+FLAG_FIELDS = tuple(name for name, field in schemas.MemBase.model_fields.items()
+                    if field.annotation == Optional[bool])
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def to_micros(time: datetime.datetime) -> int:
+    """converts a (naive) datetime to microseconds since epoch without any timezone
+    conversion, so it could be converted back exactly"""
+    return (time - _EPOCH) // _MICROSECOND
+
+def from_micros(micros: int) -> datetime.datetime:
+    """converts microseconds since epoch back to the datetime (see `to_micros`)"""
+    return _EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def to_iso(time: datetime.datetime) -> str:
+    """formats a time in ISO 8601 like the JSON of the samples (pydantic drops the
+    trailing zeros of the fraction of second)"""
+    text = time.isoformat()
+    return text.rstrip("0") if time.microsecond else text
+
+
+class MemoryRing:
+    """A fixed-capacity ring buffer of the last memory samples.
+
+    Samples are stored column by column in flat arrays (times as microseconds and the
+    other fields as doubles, NaN for None), so it does not keep any object per sample.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = array("q", [0]) * capacity
+        self.columns = {name: array("d", [math.nan]) * capacity for name in MEMORY_FIELDS}
+        # the index of the next slot to write and the number of the stored samples
+        self.head = 0
+        self.count = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, memory: schemas.MemCreate):
+        """Adds a new sample and overwrites the oldest one if it's full"""
+        if self.capacity == 0:
+            return
+        with self.lock:
+            i = self.head
+            self.times[i] = to_micros(memory.time)
+            for name, column in self.columns.items():
+                value = getattr(memory, name)
+                column[i] = math.nan if value is None else value
+            self.head = (i + 1) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+
+    def clear(self):
+        with self.lock:
+            self.head = 0
+            self.count = 0
+
+    def oldest_time(self) -> Optional[datetime.datetime]:
+        """Returns time of the oldest stored sample"""
+        with self.lock:
+            if self.count == 0:
+                return None
+            return from_micros(self.times[(self.head - self.count) % self.capacity])
+
+    def _rows(self, indices: List[int]) -> List[schemas.Memory]:
+        """Makes samples of the slots. The lock should be held."""
+        rows = [(self.times[i], [(name, column[i])
+                                 for name, column in self.columns.items()])
+                for i in indices]
+        return [schemas.Memory(time=from_micros(micros),
+                               **{name: (None if math.isnan(value) else value)
+                                  for name, value in values})
+                for micros, values in rows]
+
+    def latest(self, n: int) -> List[schemas.Memory]:
+        """Returns the last n samples (or less if there are not) from the newest one"""
+        with self.lock:
+            n = min(n, self.count)
+            return self._rows([(self.head - 1 - k) % self.capacity for k in range(n)])
+
+    def latest_columns(self, n: int) -> Tuple[List[int], Dict[str, List[Optional[float]]]]:
+        """Returns the times (in microseconds) and the other columns of the last n
+        samples from the newest one without making any sample"""
+        with self.lock:
+            n = min(n, self.count)
+            indices = [(self.head - 1 - k) % self.capacity for k in range(n)]
+            times = [self.times[i] for i in indices]
+            columns = {}
+            for name, column in self.columns.items():
+                values = [column[i] for i in indices]
+                columns[name] = [None if math.isnan(value) else value for value in values]
+            return times, columns
+
+    def between(self,
+                start: Optional[datetime.datetime] = None,
+                end: Optional[datetime.datetime] = None
+    ) -> List[schemas.Memory]:
+        """Returns the samples whose time is in [start, end) from the newest one. Only
+        the matched slots are converted to samples."""
+        low = -1 if start is None else to_micros(start) - 1
+        high = None if end is None else to_micros(end)
+        with self.lock:
+            indices = [(self.head - 1 - k) % self.capacity for k in range(self.count)]
+            return self._rows([i for i in indices
+                               if low < self.times[i] and (high is None or
+                                                           self.times[i] < high)])
+
+    def stats(self) -> schemas.CacheStats:
+        return schemas.CacheStats(hits=self.hits,
+                                  misses=self.misses,
+                                  size=self.count,
+                                  capacity=self.capacity)
+
+
+memory_ring = MemoryRing(cache_settings.memory_ring_size)
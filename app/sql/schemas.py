@@ -1,17 +1,34 @@
 from datetime import datetime
-from typing import List
+from typing import Dict, List, Literal, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+from ..config import settings
 
 
 class MemBase(BaseModel):
     free: float
     used: float
     total: float
+    # these fields are not stored for the old records
+    available: Optional[float] = None
+    buffers: Optional[float] = None
+    cached: Optional[float] = None
+    swap_total: Optional[float] = None
+    swap_used: Optional[float] = None
+    swap_free: Optional[float] = None
+    # the percent of time in which some tasks were stalled on memory in the last 10 and
+    # 60 seconds (Linux PSI)
+    psi_avg10: Optional[float] = None
+    psi_avg60: Optional[float] = None
+    # whether the sample is taken because of memory pressure (a PSI trigger) or by the
+    # periodic ticks
+    pressure_triggered: Optional[bool] = None
 
 
 class MemCreate(MemBase):
     time: datetime
+    host: str = settings.local_host
 
 
 class Memory(MemCreate):
@@ -24,6 +41,204 @@ class ListOfMemory(BaseModel):
     mem_data: List[Memory]
 
 
+class PageOfMemory(ListOfMemory):
+    """contains a page of memory for query and the cursor of the next page"""
+    # it's None when there is no more page
+    next_cursor: Optional[str] = None
+
+
+class MemoryPoint(BaseModel):
+    """contains the aggregates of memory samples in a time bucket"""
+    host: str
+    time: datetime
+    count: int
+    free_min: float
+    free_max: float
+    free_avg: float
+    free_last: float
+    used_min: float
+    used_max: float
+    used_avg: float
+    used_last: float
+    total_min: float
+    total_max: float
+    total_avg: float
+    total_last: float
+
+    class Config:
+        from_attributes = True
+
+
+class MemoryRange(BaseModel):
+    """contains the memory usage in a time range"""
+    # the length of each point in seconds. It is 0 for the raw samples.
+    resolution: int
+    mem_data: List[MemoryPoint]
+
+
+class FieldStats(BaseModel):
+    """contains the statistics of a field in a time bucket"""
+    min: float
+    max: float
+    mean: float
+    # the population standard deviation. It's None if some rollups of the bucket are
+    # written by an older version, which did not keep the sums of squares.
+    stddev: Optional[float]
+    # the requested percentiles by their names, e.g. "p95"
+    percentiles: Dict[str, float] = {}
+
+
+class MemoryStatsBucket(BaseModel):
+    """contains the statistics of the samples in a time bucket"""
+    # start of the bucket
+    time: datetime
+    count: int
+    free: FieldStats
+    used: FieldStats
+    total: FieldStats
+
+
+class MemoryStats(BaseModel):
+    """contains the statistics of memory usage of a host in a time window"""
+    host: str
+    start: datetime
+    end: datetime
+    # the length of each bucket in seconds. It is null for the whole window.
+    bucket: Optional[int]
+    mem_data: List[MemoryStatsBucket]
+
+
+class MemoryBatch(BaseModel):
+    """contains a batch of samples of a host to ingest"""
+    host: str
+    # the host of the items is ignored and it's the host of the batch
+    mem_data: List[MemCreate]
+
+
+class RetentionStats(BaseModel):
+    """contains the statistics of enforcing the retention policy"""
+    runs: int = 0
+    rows_pruned: int = 0
+    pages_vacuumed: int = 0
+    # time spent in all the runs in seconds
+    seconds: float = 0.0
+    last_run: Optional[datetime] = None
+
+
+class ProcessMemory(BaseModel):
+    """contains the memory usage of a process in megabytes"""
+    host: str
+    time: datetime
+    pid: int
+    name: str
+    cmdline: str
+    # resident set size
+    rss: float
+    # virtual memory size
+    vms: float
+
+    class Config:
+        from_attributes = True
+
+
+class ProcessSnapshot(BaseModel):
+    """contains the top processes by RSS of a host at the time of a sample"""
+    host: str
+    # it's None when there is no sample of the processes
+    time: Optional[datetime] = None
+    processes: List[ProcessMemory]
+
+
+class AlertRuleCreate(BaseModel):
+    """contains a rule of alerting on a field of the samples. `kind` is what is compared
+    with the threshold by the operator:
+    - "threshold": the value of the field
+    - "zscore": the deviation of the value from the moving mean (EWMA) in moving
+      standard deviations
+    - "rate": the change of the value per second over the last `window` seconds
+    """
+    name: str
+    # None for all the hosts
+    host: Optional[str] = None
+    field: Literal["free", "used", "total", "available", "buffers", "cached",
+                   "swap_total", "swap_used", "swap_free", "psi_avg10", "psi_avg60"]
+    kind: Literal["threshold", "zscore", "rate"] = "threshold"
+    operator: Literal[">", ">=", "<", "<="] = ">"
+    threshold: float
+    alpha: float = Field(0.1, gt=0, le=1)
+    min_samples: int = Field(30, ge=1)
+    window: int = Field(300, gt=0)
+    enabled: bool = True
+
+
+class AlertRule(AlertRuleCreate):
+    id: int
+
+    class Config:
+        from_attributes = True
+
+
+class AlertEventCreate(BaseModel):
+    rule_id: int
+    host: str
+    time: datetime
+    state: Literal["firing", "resolved"]
+    # the evaluated value: the field, its z-score or its rate of change
+    value: float
+
+
+class AlertEvent(AlertEventCreate):
+    id: int
+
+    class Config:
+        from_attributes = True
+
+
+class ListOfAlertEvents(BaseModel):
+    """contains a list of alert events for query"""
+    events: List[AlertEvent]
+
+
+class CacheStats(BaseModel):
+    """contains the statistics of an in-memory cache"""
+    hits: int
+    misses: int
+    size: int
+    capacity: int
+
+
+class FlightStats(BaseModel):
+    """contains the statistics of coalescing the identical concurrent queries"""
+    # the queries which are run
+    executed: int
+    # the queries which waited for an identical running one instead of running
+    coalesced: int
+    in_flight: int
+
+
+class RequestProfile(BaseModel):
+    """contains the profile of a request"""
+    id: int
+    # when the request is done
+    time: datetime
+    method: str
+    path: str
+    status: int
+    # "header" if an admin asked for it, or "sampled"
+    reason: Literal["header", "sampled"]
+    total_ms: float
+    # the milliseconds spent in each phase, e.g. auth, jwt, db, crud and serialize
+    phases: Dict[str, float]
+    # the top functions of the call-stack profile by their cumulative time. It's None
+    # if another request was being profiled.
+    stack: Optional[str] = None
+
+
+class ListOfProfiles(BaseModel):
+    """contains the last profiles of requests from the newest one"""
+    profiles: List[RequestProfile]
+
+
 class UserBase(BaseModel):
     username: str
     email: str
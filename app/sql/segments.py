@@ -0,0 +1,550 @@
+import bisect
+import contextlib
+import datetime
+import fcntl
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import urllib.parse
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from ..config import storage_settings
+from . import schemas
+from .ring import MEMORY_FIELDS, to_micros, from_micros
+
+
+# A segment is a pair of append-only files:
+# - "<first time>.seg" holds blocks of samples. A block is a header (the number of
+#   samples and the payload length as uint32) and a payload: the times (the first one
+#   as int64 microseconds, then the delta and the delta-of-deltas as zigzag varints)
+#   and then each column (the first value as float64, then each value XORed with the
+#   previous one, see `_encode_column`).
+# - "<first time>.idx" is the sparse index of the blocks: an `IndexEntry` per block.
+# - "tail" of the store holds the samples which are not in a block yet: a header (b"TAIL"
+#   and the number of the fields as uint16) and a record per sample (int64 microseconds
+#   and each field as float64).
+# The samples are added to the tail, and a block is only encoded and sealed when the
+# tail has `block_size` samples, so the blocks are full whatever the size of a write is.
+# Only the segment file is synced when a block is sealed. The index entries of the
+# blocks after the last synced entry are rebuilt from the segment file when it's opened,
+# and a partly written block at its end is cut. The tail file is not synced, so a crash
+# of the machine (not of the process) could lose the samples of the tail.
+# The processes which use a store (e.g. the workers of the app) take the file lock "lock"
+# of its directory, and load the changes of the others under it (see `_refresh`). The
+# tail file is only appended to or replaced by a new file, so it's changed if its inode
+# or size is changed.
+
+_BLOCK_HEADER = struct.Struct("<II")
+_INDEX_ENTRY = struct.Struct("<qqQII")
+_INT64 = struct.Struct("<q")
+_DOUBLE = struct.Struct("<d")
+_UINT64 = struct.Struct("<Q")
+_TAIL_HEADER = struct.Struct("<4sH")
+_TAIL_MAGIC = b"TAIL"
+
+
+def _file_key(stat: os.stat_result) -> Tuple[int, int, int]:
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class IndexEntry(NamedTuple):
+    first_time: int
+    last_time: int
+    offset: int
+    length: int
+    count: int
+
+
+def _write_varint(value: int, out: bytearray):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+def _unzigzag(value: int) -> int:
+    return (value >> 1) ^ -(value & 1)
+
+def _encode_times(times: Sequence[int], out: bytearray):
+    out += _INT64.pack(times[0])
+    prev_delta = 0
+    for prev, time in zip(times, times[1:]):
+        delta = time - prev
+        _write_varint(_zigzag(delta - prev_delta), out)
+        prev_delta = delta
+
+def _decode_times(data: bytes, pos: int, count: int) -> Tuple[List[int], int]:
+    time = _INT64.unpack_from(data, pos)[0]
+    pos += 8
+    times = [time]
+    delta = 0
+    for _ in range(count - 1):
+        value, pos = _read_varint(data, pos)
+        delta += _unzigzag(value)
+        time += delta
+        times.append(time)
+    return times, pos
+
+def _encode_column(values: Sequence[float], out: bytearray):
+    """Each value is XORed with the previous one. A header byte has the number of its
+    trailing zero bytes (high nibble) and the number of the other bytes after leading
+    zero bytes (low nibble), which are written after it. 0 means the same value."""
+    out += _DOUBLE.pack(values[0])
+    prev = _UINT64.unpack(_DOUBLE.pack(values[0]))[0]
+    for value in values[1:]:
+        bits = _UINT64.unpack(_DOUBLE.pack(value))[0]
+        xor = bits ^ prev
+        prev = bits
+        if xor == 0:
+            out.append(0)
+            continue
+        trailing = ((xor & -xor).bit_length() - 1) // 8
+        length = (xor.bit_length() + 7) // 8 - trailing
+        out.append((trailing << 4) | length)
+        out += (xor >> (trailing * 8)).to_bytes(length, "little")
+
+def _decode_column(data: bytes, pos: int, count: int) -> Tuple[List[float], int]:
+    bits = _UINT64.unpack_from(data, pos)[0]
+    pos += 8
+    values = [bits]
+    for _ in range(count - 1):
+        header = data[pos]
+        pos += 1
+        if header:
+            length = header & 0x0f
+            xor = int.from_bytes(data[pos:pos + length], "little")
+            bits ^= xor << ((header >> 4) * 8)
+            pos += length
+        values.append(bits)
+    # the bits are converted to doubles all together
+    return list(struct.unpack(f"<{count}d", struct.pack(f"<{count}Q", *values))), pos
+
+def encode_block(times: Sequence[int], columns: Sequence[Sequence[float]]) -> bytes:
+    """Encodes samples to a block (see the format at the top of the module)"""
+    payload = bytearray()
+    _encode_times(times, payload)
+    for values in columns:
+        _encode_column(values, payload)
+    return _BLOCK_HEADER.pack(len(times), len(payload)) + bytes(payload)
+
+def decode_block(data: bytes) -> Tuple[List[int], List[List[float]]]:
+    """Decodes a block to the times and the columns"""
+    count, length = _BLOCK_HEADER.unpack_from(data, 0)
+    times, pos = _decode_times(data, _BLOCK_HEADER.size, count)
+    columns = []
+    while pos < _BLOCK_HEADER.size + length:
+        values, pos = _decode_column(data, pos, count)
+        columns.append(values)
+    return times, columns
+
+
+class _Segment:
+    def __init__(self, path: str):
+        self.path = path
+        self.index: List[IndexEntry] = []
+        self.map: Optional[mmap.mmap] = None
+        self.count = 0
+        # it's set when the files are deleted by the retention
+        self.dropped = False
+        self.refresh()
+
+    def refresh(self):
+        """Reads the index entries which are added after the read ones, e.g. by another
+        process"""
+        try:
+            with open(self.path + ".idx", "rb") as f:
+                f.seek(len(self.index) * _INDEX_ENTRY.size)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        usable = len(data) - len(data) % _INDEX_ENTRY.size
+        entries = [IndexEntry(*entry) for entry in _INDEX_ENTRY.iter_unpack(data[:usable])]
+        self.index += entries
+        self.count += sum(entry.count for entry in entries)
+
+    def _end(self) -> int:
+        """returns the offset after the last indexed block"""
+        return self.index[-1].offset + self.index[-1].length if self.index else 0
+
+    def _write_index(self, entries: List[IndexEntry]):
+        with open(self.path + ".idx", "ab") as f:
+            # a partly written entry is cut
+            f.truncate(len(self.index) * _INDEX_ENTRY.size)
+            f.write(b"".join(_INDEX_ENTRY.pack(*entry) for entry in entries))
+        self.index += entries
+        self.count += sum(entry.count for entry in entries)
+
+    def recover(self):
+        """Adds the index entries of the blocks which are synced but whose entries are
+        not written, and cuts a partly written block at the end of the segment"""
+        seg_path = self.path + ".seg"
+        if not os.path.exists(seg_path):
+            return
+        with open(seg_path, "rb") as f:
+            data = f.read()
+        offset = self._end()
+        entries = []
+        while offset + _BLOCK_HEADER.size <= len(data):
+            count, length = _BLOCK_HEADER.unpack_from(data, offset)
+            end = offset + _BLOCK_HEADER.size + length
+            if count == 0 or end > len(data):
+                break
+            try:
+                times, _ = decode_block(data[offset:end])
+            except (IndexError, struct.error):
+                break
+            entries.append(IndexEntry(times[0], times[-1], offset, end - offset, count))
+            offset = end
+        if entries:
+            self._write_index(entries)
+        if offset < len(data):
+            os.truncate(seg_path, offset)
+
+    def append(self, block: bytes, first_time: int, last_time: int, count: int):
+        """Appends a block. Only the block is synced, see the top of the module."""
+        seg_path = self.path + ".seg"
+        if os.path.exists(seg_path) and os.path.getsize(seg_path) != self._end():
+            # a process is stopped while it's writing a block
+            self.recover()
+        with open(seg_path, "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        self._write_index([IndexEntry(first_time, last_time, offset, len(block), count)])
+
+    def read(self, entry: IndexEntry) -> bytes:
+        """Reads a block through a memory map of the segment which is remapped when the
+        block is after its end"""
+        end = entry.offset + entry.length
+        if self.map is None or len(self.map) < end:
+            if self.map is not None:
+                self.map.close()
+            with open(self.path + ".seg", "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[entry.offset:end]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class SegmentStore:
+    """An append-only store of memory samples in compressed segment files.
+
+    Samples are added to the tail and written in blocks of `block_size` samples, and a
+    segment is closed after `segment_size` samples. Reads find the blocks of a time range
+    by the sparse index and decode them from memory-mapped files, and then read the tail.
+    """
+    def __init__(self,
+                 path: str,
+                 fields: Sequence[str] = MEMORY_FIELDS,
+                 segment_size: int = 1 << 16,
+                 block_size: int = 1024):
+        self.path = path
+        self.fields = tuple(fields)
+        self.segment_size = segment_size
+        self.block_size = block_size
+        self.record = struct.Struct("<q" + "d" * len(self.fields))
+        self.segments: List[_Segment] = []
+        self.tail: List[Tuple[int, List[float]]] = []
+        self.tail_fd: Optional[int] = None
+        # the inode, the size and the modification time of the loaded tail file
+        self.tail_key: Optional[Tuple[int, int, int]] = None
+        # it's False if the tail file should be written again before appending to it,
+        # e.g. it has a partly written sample
+        self.tail_clean = False
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.lock_fd = os.open(os.path.join(path, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        with self._locked():
+            for segment in self.segments:
+                segment.recover()
+            # the samples of the recovered blocks are still in the tail
+            self.tail_key = None
+            self._refresh()
+
+    @contextlib.contextmanager
+    def _locked(self, shared: bool = False):
+        """Takes the lock of the threads and the file lock of the processes, and loads
+        the changes of the other processes. The readers take a shared file lock."""
+        with self.lock:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """loads the segments and the index entries which are added, drops the segments
+        which are deleted by the retention and loads the tail if it's changed"""
+        # the names are the first times, which could be negative (before 1970)
+        names = sorted((name[:-4] for name in os.listdir(self.path)
+                        if name.endswith(".idx")), key=int)
+        paths = [os.path.join(self.path, name) for name in names]
+        known = {segment.path: segment for segment in self.segments}
+        for segment in self.segments:
+            if segment.path not in paths:
+                segment.dropped = True
+                segment.close()
+        # only the last segment could have new blocks, the others are full
+        if self.segments and not self.segments[-1].dropped:
+            self.segments[-1].refresh()
+        self.segments = [known.get(path) or _Segment(path) for path in paths]
+        tail_path = os.path.join(self.path, "tail")
+        try:
+            key = _file_key(os.stat(tail_path))
+        except FileNotFoundError:
+            key = None
+        if key == self.tail_key:
+            return
+        if self.tail_fd is not None and (key is None or key[0] != self.tail_key[0]):
+            # the file is replaced by another process
+            os.close(self.tail_fd)
+            self.tail_fd = None
+        self.tail, self.tail_clean = self._load_tail()
+        self.tail_key = key
+
+    def _load_tail(self) -> Tuple[List[Tuple[int, List[float]]], bool]:
+        """reads the samples of the tail file which are not in a block, and whether the
+        file has only them"""
+        try:
+            with open(os.path.join(self.path, "tail"), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return [], False
+        if len(data) < _TAIL_HEADER.size:
+            return [], False
+        magic, count = _TAIL_HEADER.unpack_from(data, 0)
+        if magic != _TAIL_MAGIC:
+            logging.warning(f"The tail of {self.path} is unknown and it's ignored.")
+            return [], False
+        record = struct.Struct("<q" + "d" * count)
+        body = data[_TAIL_HEADER.size:]
+        clean = count == len(self.fields) and len(body) % record.size == 0
+        body = body[:len(body) - len(body) % record.size]
+        last_time = self._sealed_last_time()
+        rows = []
+        for time, *values in record.iter_unpack(body):
+            # the samples which are sealed before a crash are still in the tail
+            if last_time is not None and time <= last_time:
+                clean = False
+                continue
+            # a tail which is written before adding a field does not have it
+            values = (values + [math.nan] * len(self.fields))[:len(self.fields)]
+            rows.append((time, values))
+        return rows, clean
+
+    def _write_tail(self, rows, rewrite: bool = False):
+        """adds the samples to the tail file, or replaces it by a file with only them"""
+        tail_path = os.path.join(self.path, "tail")
+        data = b"".join(self.record.pack(time, *values) for time, values in rows)
+        if rewrite:
+            temp_path = tail_path + ".tmp"
+            with open(temp_path, "wb") as f:
+                f.write(_TAIL_HEADER.pack(_TAIL_MAGIC, len(self.fields)) + data)
+            os.replace(temp_path, tail_path)
+            if self.tail_fd is not None:
+                os.close(self.tail_fd)
+                self.tail_fd = None
+            self.tail_clean = True
+        if self.tail_fd is None:
+            self.tail_fd = os.open(tail_path, os.O_WRONLY | os.O_APPEND)
+        if not rewrite:
+            os.write(self.tail_fd, data)
+        self.tail_key = _file_key(os.fstat(self.tail_fd))
+
+    def _sealed_last_time(self) -> Optional[int]:
+        for segment in reversed(self.segments):
+            if segment.index:
+                return segment.index[-1].last_time
+        return None
+
+    @property
+    def last_time(self) -> Optional[int]:
+        if self.tail:
+            return self.tail[-1][0]
+        return self._sealed_last_time()
+
+    def __len__(self) -> int:
+        with self._locked(shared=True):
+            return sum(segment.count for segment in self.segments) + len(self.tail)
+
+    def append(self, memories: Sequence[schemas.MemCreate]) -> int:
+        """Appends the samples and returns the number of the written ones. The samples
+        which are not newer than the stored ones are dropped."""
+        rows = sorted(((to_micros(memory.time),
+                        [math.nan if value is None else value
+                         for value in (getattr(memory, name) for name in self.fields)])
+                       for memory in memories), key=lambda row: row[0])
+        with self._locked():
+            last_time = self.last_time
+            if last_time is not None:
+                newer = [row for row in rows if row[0] > last_time]
+                if len(newer) < len(rows):
+                    logging.warning(f"{len(rows) - len(newer)} samples are older than "
+                                    f"the stored ones and they are dropped.")
+                rows = newer
+            if not rows:
+                return 0
+            if not self.tail_clean:
+                self._write_tail(self.tail, rewrite=True)
+            self._write_tail(rows)
+            self.tail += rows
+            if len(self.tail) >= self.block_size:
+                while len(self.tail) >= self.block_size:
+                    self._append_block(self.tail[:self.block_size])
+                    self.tail = self.tail[self.block_size:]
+                self._write_tail(self.tail, rewrite=True)
+        return len(rows)
+
+    def _append_block(self, rows):
+        times = [time for time, _ in rows]
+        columns = list(zip(*(values for _, values in rows)))
+        if not self.segments or self.segments[-1].count >= self.segment_size:
+            self.segments.append(_Segment(os.path.join(self.path, f"{times[0]:020d}")))
+        block = encode_block(times, columns)
+        self.segments[-1].append(block, times[0], times[-1], len(times))
+
+    def _blocks(self, start: Optional[int], end: Optional[int], reverse: bool = False
+    ) -> Tuple[Iterator[Tuple[_Segment, IndexEntry]], List[Tuple[int, List[float]]]]:
+        """Returns the blocks which could have samples in [start, end) and a copy of the
+        tail. Both are taken at the same time, so a block which is sealed meanwhile is
+        not read twice."""
+        with self._locked(shared=True):
+            blocks = [(segment, entry) for segment in self.segments
+                      for entry in list(segment.index)]
+            tail = list(self.tail)
+        if start is not None:
+            i = bisect.bisect_left([entry.last_time for _, entry in blocks], start)
+            blocks = blocks[i:]
+        if end is not None:
+            i = bisect.bisect_left([entry.first_time for _, entry in blocks], end)
+            blocks = blocks[:i]
+        return (reversed(blocks) if reverse else iter(blocks)), tail
+
+    def _columns(self, start: Optional[int], end: Optional[int], reverse: bool
+    ) -> Iterator[Tuple[List[int], List[List[float]]]]:
+        """yields the times and the columns of each block and of the tail in order"""
+        blocks, tail = self._blocks(start, end, reverse)
+        tail_columns = ([time for time, _ in tail],
+                        [list(values) for values in zip(*(values for _, values in tail))])
+        if reverse and tail:
+            yield tail_columns
+        for segment, entry in blocks:
+            with self.lock:
+                if segment.dropped:
+                    continue
+                try:
+                    data = segment.read(entry)
+                except FileNotFoundError:
+                    # it's deleted by the retention of another process
+                    continue
+            yield decode_block(data)
+        if not reverse and tail:
+            yield tail_columns
+
+    def scan(self,
+             start: Optional[datetime.datetime] = None,
+             end: Optional[datetime.datetime] = None,
+             reverse: bool = False
+    ) -> Iterator[Tuple]:
+        """Yields rows (time and the fields, None for null) in [start, end) from the
+        oldest one, or from the newest one if `reverse` is True"""
+        low = None if start is None else to_micros(start)
+        high = None if end is None else to_micros(end)
+        for times, columns in self._columns(low, high, reverse):
+            # the blocks which are written before adding a field do not have it
+            for _ in range(len(columns), len(self.fields)):
+                columns.append([math.nan] * len(times))
+            rows = zip(times, *columns)
+            if reverse:
+                rows = reversed(list(rows))
+            for time, *values in rows:
+                if ((low is not None and time < low)
+                        or (high is not None and time >= high)):
+                    continue
+                yield (from_micros(time),
+                       *[None if value != value else value for value in values])
+
+    def latest(self, n: int, before: Optional[datetime.datetime] = None
+    ) -> List[schemas.Memory]:
+        """Returns the last n samples before a time from the newest one"""
+        mem_data = []
+        if n <= 0:
+            return mem_data
+        for time, *values in self.scan(end=before, reverse=True):
+            mem_data.append(schemas.Memory(time=time, **dict(zip(self.fields, values))))
+            if len(mem_data) == n:
+                break
+        return mem_data
+
+    def drop_before(self, time: datetime.datetime) -> int:
+        """Deletes the segments whose samples are all before the time and returns the
+        number of the deleted samples. Segments are deleted as a whole, so some older
+        samples could be kept in the segment which has the first newer one."""
+        cutoff = to_micros(time)
+        count = 0
+        with self._locked():
+            old = [segment for segment in self.segments
+                   if segment.index and segment.index[-1].last_time < cutoff]
+            self.segments = [segment for segment in self.segments if segment not in old]
+            for segment in old:
+                count += segment.count
+                segment.dropped = True
+                segment.close()
+                for ext in (".idx", ".seg"):
+                    if os.path.exists(segment.path + ext):
+                        os.remove(segment.path + ext)
+        return count
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            if self.tail_fd is not None:
+                os.close(self.tail_fd)
+                self.tail_fd = None
+            if self.lock_fd is not None:
+                os.close(self.lock_fd)
+                self.lock_fd = None
+
+
+_segment_stores: Dict[str, SegmentStore] = {}
+
+def get_segment_store(host: str) -> SegmentStore:
+    """Returns the store of a host which is configured by `storage_settings`. Each host
+    has its own directory."""
+    store = _segment_stores.get(host)
+    if store is None:
+        path = os.path.join(storage_settings.directory, urllib.parse.quote(host, safe=""))
+        store = _segment_stores.setdefault(
+            host, SegmentStore(path,
+                               segment_size=storage_settings.segment_size,
+                               block_size=storage_settings.block_size))
+    return store
+
+def all_segment_stores() -> List[SegmentStore]:
+    """Returns the stores of all the hosts which have a directory in the storage path"""
+    if os.path.isdir(storage_settings.directory):
+        for name in os.listdir(storage_settings.directory):
+            if os.path.isdir(os.path.join(storage_settings.directory, name)):
+                get_segment_store(urllib.parse.unquote(name))
+    return list(_segment_stores.values())
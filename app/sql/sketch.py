@@ -0,0 +1,89 @@
+import math
+import struct
+from typing import Dict, Iterable, Optional
+
+# the max relative error of the values of the quantiles
+RELATIVE_ACCURACY = 0.01
+
+_GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+# the values which are not more than it are counted as zero
+_MIN_VALUE = 1e-9
+
+_HEADER = struct.Struct("<I")
+_BIN = struct.Struct("<iI")
+
+
+class LogHistogram:
+    """A histogram of values in buckets whose bounds grow by a constant ratio (like
+    DDSketch), so a quantile is found with a relative error of at most
+    `RELATIVE_ACCURACY` whatever the number of the values is. Histograms could be merged,
+    e.g. the ones of the minutes of an hour. The values should not be negative (they
+    are counted as zero).
+
+    The value of bin `i` is in (gamma ** (i - 1), gamma ** i]. A histogram of memory
+    values of a day has a few hundreds of bins at most.
+    """
+    __slots__ = ("bins", "zeros", "count")
+
+    def __init__(self):
+        self.bins: Dict[int, int] = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value: float, count: int = 1):
+        if value <= _MIN_VALUE:
+            self.zeros += count
+        else:
+            key = math.ceil(math.log(value) / _LOG_GAMMA)
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.count += count
+
+    def extend(self, values: Iterable[float]):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other: "LogHistogram"):
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def _value_at(self, rank: int) -> float:
+        """returns the estimated value of the rank-th smallest value (from 0)"""
+        if rank < self.zeros:
+            return 0.0
+        seen = self.zeros
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if rank < seen:
+                # the middle of the bin by the relative error
+                return 2 * _GAMMA ** key / (_GAMMA + 1)
+        raise IndexError(rank)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Returns the q-th percentile (0 to 100) by linear interpolation between the
+        closest ranks, or None if it's empty"""
+        if not self.count:
+            return None
+        position = (self.count - 1) * q / 100
+        low = math.floor(position)
+        value = self._value_at(low)
+        if position > low:
+            value += (self._value_at(low + 1) - value) * (position - low)
+        return value
+
+    def encode(self) -> bytes:
+        """Encodes it as the number of zeros (uint32) and the bins (int32 key and uint32
+        count) in order of their keys"""
+        return _HEADER.pack(self.zeros) + b"".join(
+            _BIN.pack(key, self.bins[key]) for key in sorted(self.bins))
+
+    @classmethod
+    def decode(cls, data: bytes) -> "LogHistogram":
+        histogram = cls()
+        histogram.zeros = histogram.count = _HEADER.unpack_from(data, 0)[0]
+        for key, count in _BIN.iter_unpack(data[_HEADER.size:]):
+            histogram.bins[key] = count
+            histogram.count += count
+        return histogram
@@ -0,0 +1,128 @@
+import logging
+import time
+from abc import ABC, abstractmethod
+from typing import List
+
+from ..config import writer_settings
+from ..metrics import writer_dropped_rows, writer_failures
+from . import crud, schemas, SessionLocal, run_write
+
+
+class BatchWriter(ABC):
+    """Buffers rows and writes them to database by one bulk insert. The subclasses
+    write their own rows by `write`.
+
+    The buffer is flushed when it has `flush_size` rows or when its oldest write is
+    older than `flush_interval` seconds, whichever comes first. When a flush fails, its
+    rows are put back to be written by the next one and the error is raised; only the
+    ones over `max_buffer` are dropped.
+    """
+    # the name of the rows in the logs and the label of the metrics
+    name = "rows"
+
+    def __init__(self, flush_size: int, flush_interval: float,
+                 max_buffer: int = writer_settings.max_buffer):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.buffer: list = []
+        self.last_flush = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.buffer)
+
+    def is_due(self) -> bool:
+        """Checks the buffer should be flushed or not"""
+        if len(self.buffer) >= self.flush_size:
+            return True
+        return time.monotonic() - self.last_flush >= self.flush_interval
+
+    def append(self, row) -> bool:
+        """Adds a row to the buffer and returns the buffer should be flushed or not"""
+        self.buffer.append(row)
+        return self.is_due()
+
+    def extend(self, rows: list) -> bool:
+        """Adds the rows to the buffer and returns the buffer should be flushed or not"""
+        self.buffer += rows
+        return self.is_due()
+
+    def add(self, row) -> int:
+        """Adds a row to the buffer and flushes it if it is due. It returns the number
+        of the written rows."""
+        if self.append(row):
+            return self.flush()
+        return 0
+
+    def take(self) -> list:
+        """Empties the buffer and returns its rows"""
+        self.last_flush = time.monotonic()
+        rows, self.buffer = self.buffer, []
+        return rows
+
+    @abstractmethod
+    def write(self, rows: list) -> int:
+        """Writes the rows to database and returns the number of them"""
+
+    def put_back(self, rows: list):
+        """Puts the rows of a failed write back before the buffered ones"""
+        writer_failures.inc(self.name)
+        self.buffer = rows + self.buffer
+        dropped = len(self.buffer) - self.max_buffer
+        if dropped > 0:
+            writer_dropped_rows.inc(self.name, amount=dropped)
+            logging.error(f"Writing {self.name} keeps failing, so the oldest {dropped} "
+                          f"of them are dropped!")
+            del self.buffer[:dropped]
+
+    def flush(self) -> int:
+        """Writes all the buffered rows to database and returns the number of them"""
+        rows = self.take()
+        try:
+            return self.write(rows)
+        except Exception:
+            self.put_back(rows)
+            raise
+
+    async def flush_async(self) -> int:
+        """Like `flush` but the rows are written in the writer thread of database. The
+        buffer is taken and put back in the caller's thread, so it's safe to add rows
+        meanwhile."""
+        rows = self.take()
+        try:
+            return await run_write(self.write, rows)
+        except Exception:
+            self.put_back(rows)
+            raise
+
+
+class MemoryWriter(BatchWriter):
+    """Buffers memory samples and writes them with their rollups by one commit"""
+    name = "memory"
+
+    def write(self, samples: List[schemas.MemCreate]) -> int:
+        """Writes the samples to database and returns the number of them"""
+        if not samples:
+            return 0
+        with SessionLocal() as db:
+            return crud.create_memories(db, samples)
+
+
+class ProcessWriter(BatchWriter):
+    """Buffers the top processes of the ticks and writes them by one bulk insert"""
+    name = "processes"
+
+    def write(self, rows: List[schemas.ProcessMemory]) -> int:
+        """Writes the rows to database and returns the number of them"""
+        if not rows:
+            return 0
+        with SessionLocal() as db:
+            return crud.create_process_memories(db, rows)
+
+
+memory_writer = MemoryWriter(writer_settings.flush_size,
+                             writer_settings.flush_interval.total_seconds())
+# the rows of the processes are flushed by the same size and interval, so the processes
+# of about `flush_size / top_n` ticks are written together
+process_writer = ProcessWriter(writer_settings.flush_size,
+                               writer_settings.flush_interval.total_seconds())
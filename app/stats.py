@@ -0,0 +1,220 @@
+import datetime
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .config import settings
+from .sql import crud, models, schemas
+from .sql.ring import MEMORY_FIELDS, memory_ring, from_micros, to_micros
+from .sql.sketch import LogHistogram
+
+
+# the fields whose statistics are computed
+STAT_FIELDS = models.ROLLUP_FIELDS
+# the buckets should be a multiple of it, so they are made of whole rollups of the finest
+# tier
+BUCKET_STEP = models.ROLLUP_TIERS[0].resolution
+
+# the partial aggregates of a field which could be merged: min, max, sum and sum of
+# squares (None if it's not known)
+Partial = Tuple[float, float, float, Optional[float]]
+
+
+class _Aggregate:
+    """The merged aggregates of a bucket: the count, and the partial and the histogram
+    (if the percentiles are asked) of each field"""
+    __slots__ = ("count", "partials", "histograms")
+
+    def __init__(self, with_histograms: bool):
+        self.count = 0
+        self.partials: List[Optional[Partial]] = [None] * len(STAT_FIELDS)
+        self.histograms = ([LogHistogram() for _ in STAT_FIELDS]
+                           if with_histograms else None)
+
+    def add(self, count: int, partials: Sequence[Partial]):
+        self.count += count
+        self.partials = [b if a is None else (
+                            min(a[0], b[0]), max(a[1], b[1]), a[2] + b[2],
+                            None if a[3] is None or b[3] is None else a[3] + b[3])
+                         for a, b in zip(self.partials, partials)]
+
+    def add_values(self, values: Sequence[float]):
+        self.add(1, [(value, value, value, value * value) for value in values])
+        if self.histograms is not None:
+            for histogram, value in zip(self.histograms, values):
+                histogram.add(value)
+
+
+# the aggregates of the buckets by their start (in seconds since epoch, 0 for the whole
+# window)
+Buckets = Dict[int, _Aggregate]
+
+
+def percentile_name(q: float) -> str:
+    """Returns the name of a percentile, e.g. "p95" or "p99.9" """
+    return f"p{q:g}"
+
+def _field_stats(count: int,
+                 partial: Partial,
+                 percentiles: Optional[Dict[str, float]] = None
+) -> schemas.FieldStats:
+    low, high, total, squares = partial
+    mean = total / count
+    stddev = None
+    if squares is not None:
+        # it could be a bit negative by rounding errors
+        stddev = math.sqrt(max(squares / count - mean * mean, 0.0))
+    return schemas.FieldStats(min=low, max=high, mean=mean, stddev=stddev,
+                              percentiles=percentiles or {})
+
+def _bucket_start(time: datetime.datetime, bucket: Optional[int]) -> int:
+    """Returns start of the bucket of the time in seconds since epoch (0 if there is no
+    bucket)"""
+    if not bucket:
+        return 0
+    seconds = to_micros(time) // 1_000_000
+    return seconds - seconds % bucket
+
+def _get(buckets: Buckets, key: int, with_histograms: bool) -> _Aggregate:
+    aggregate = buckets.get(key)
+    if aggregate is None:
+        aggregate = buckets[key] = _Aggregate(with_histograms)
+    return aggregate
+
+def _later(a: Optional[datetime.datetime], b: Optional[datetime.datetime]):
+    return a if b is None else b if a is None else max(a, b)
+
+
+def _rollup_tiers(bucket: Optional[int]) -> List[type]:
+    """Returns the rollup tiers whose rollups are not split by the buckets from the
+    finest one. The daily tier is not used, because the edges of the window would be
+    too long."""
+    return [tier for tier in models.ROLLUP_TIERS
+            if tier.resolution <= 60 * 60
+            and (not bucket or bucket % tier.resolution == 0)]
+
+def _add_raw(db: Session,
+             buckets: Buckets,
+             host: str,
+             start: datetime.datetime,
+             end: datetime.datetime,
+             bucket: Optional[int],
+             with_histograms: bool
+) -> Optional[datetime.datetime]:
+    """Adds the raw samples to the buckets and returns the time of the last one. It's
+    only used for the edges of the window which are shorter than a minute."""
+    indexes = [1 + MEMORY_FIELDS.index(name) for name in STAT_FIELDS]
+    last_time = None
+    for row in crud.read_raw_rows(db, host, start, end):
+        last_time = row[0]
+        _get(buckets, _bucket_start(row[0], bucket), with_histograms).add_values(
+            [row[i] for i in indexes])
+    return last_time
+
+def _add_rollups(db: Session,
+                 buckets: Buckets,
+                 tiers: Sequence[type],
+                 host: str,
+                 start: datetime.datetime,
+                 end: datetime.datetime,
+                 bucket: Optional[int],
+                 with_histograms: bool
+) -> Optional[datetime.datetime]:
+    """Adds the rollups of the coarsest tier which are in the window to the buckets, and
+    the edges of the window which are not a whole rollup by the finer tiers and then
+    the raw samples. It returns the time of the last sample."""
+    if not tiers:
+        return _add_raw(db, buckets, host, start, end, bucket, with_histograms)
+    tier = tiers[-1]
+    step = tier.resolution * 1_000_000
+    first = from_micros(-(-to_micros(start) // step) * step)
+    last = from_micros(to_micros(end) // step * step)
+    if first >= last:
+        return _add_rollups(db, buckets, tiers[:-1], host, start, end, bucket,
+                            with_histograms)
+    columns = [tier.time, tier.last_time, tier.count]
+    for name in STAT_FIELDS:
+        columns += [getattr(tier, f"{name}_{kind}")
+                    for kind in ("min", "max", "avg", "sumsq")]
+    if with_histograms:
+        columns += [getattr(tier, f"{name}_hist") for name in STAT_FIELDS]
+    q = select(*columns).where(tier.host == host, tier.time >= first, tier.time < last)
+    last_time = None
+    for row in db.execute(q):
+        time, row_last_time, count = row[:3]
+        last_time = _later(last_time, row_last_time)
+        values = row[3:3 + 4 * len(STAT_FIELDS)]
+        partials = []
+        for i in range(0, len(values), 4):
+            low, high, mean, squares = values[i:i + 4]
+            partials.append((low, high, mean * count, squares))
+        aggregate = _get(buckets, _bucket_start(time, bucket), with_histograms)
+        aggregate.add(count, partials)
+        if with_histograms:
+            for histogram, data in zip(aggregate.histograms, row[3 + len(values):]):
+                # the rollups of an older version have no histogram
+                if data is not None:
+                    histogram.merge(LogHistogram.decode(data))
+    for edge_start, edge_end in ((start, first), (last, end)):
+        if edge_start < edge_end:
+            last_time = _later(last_time, _add_rollups(
+                db, buckets, tiers[:-1], host, edge_start, edge_end, bucket,
+                with_histograms))
+    return last_time
+
+
+def get_mem_stats(db: Session,
+                  start: datetime.datetime,
+                  end: datetime.datetime,
+                  percentiles: Sequence[float] = (),
+                  bucket: Optional[int] = None,
+                  host: Optional[str] = None
+) -> schemas.MemoryStats:
+    """Returns min, max, mean, stddev and the percentiles of free, used and total of a
+    host in [start, end), in buckets of `bucket` seconds or over the whole window.
+
+    They are merged from the rollups (the 1 hour ones if the buckets are whole hours,
+    then the 1 minute ones for the edges, see `_add_rollups`), the raw samples of the
+    edges of the window which are shorter than a minute and the recent samples in the
+    ring, so the cost does not grow with the number of samples. So `bucket` should be a
+    multiple of `BUCKET_STEP` (60) seconds, and it raises ValueError otherwise.
+
+    The percentiles are estimated from the histograms of the rollups with a relative
+    error of at most `RELATIVE_ACCURACY` (1%), and they are in [min, max] of the bucket.
+    The samples of the rollups which are written by an older version (without
+    histograms) are not in the percentiles, and the stddev of their buckets is None
+    (they have no sums of squares).
+    """
+    if bucket and bucket % BUCKET_STEP:
+        raise ValueError(f"The bucket should be a multiple of {BUCKET_STEP} seconds.")
+    host = host or settings.local_host
+    with_histograms = bool(percentiles)
+    buckets: Buckets = {}
+    last_time = _add_rollups(db, buckets, _rollup_tiers(bucket), host, start, end, bucket,
+                             with_histograms)
+    if host == settings.local_host:
+        # the recent samples could be only in the ring (not written yet)
+        after = start if last_time is None else max(
+            start, last_time + datetime.timedelta(microseconds=1))
+        for sample in memory_ring.between(after, end):
+            _get(buckets, _bucket_start(sample.time, bucket), with_histograms).add_values(
+                [getattr(sample, name) for name in STAT_FIELDS])
+    result = []
+    for key in sorted(buckets):
+        aggregate = buckets[key]
+        fields = {}
+        for i, name in enumerate(STAT_FIELDS):
+            partial = aggregate.partials[i]
+            found = {}
+            if with_histograms and aggregate.histograms[i].count:
+                for q in percentiles:
+                    value = aggregate.histograms[i].quantile(q)
+                    found[percentile_name(q)] = min(max(value, partial[0]), partial[1])
+            fields[name] = _field_stats(aggregate.count, partial, found)
+        result.append(schemas.MemoryStatsBucket(
+            time=from_micros(key * 1_000_000) if bucket else start,
+            count=aggregate.count, **fields))
+    return schemas.MemoryStats(host=host, start=start, end=end, bucket=bucket,
+                               mem_data=result)
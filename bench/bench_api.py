@@ -0,0 +1,253 @@
+"""Benchmark of the hot paths of the API against an in-process app and a temp database.
+
+It measures the sampler tick (`get_mem_usage`), the insert throughput of
+`crud.create_memory`, the latency and size of /memory/info at some limits and table
+sizes (in rows and columns), and the throughput of /users/token and token validation
+(/users/me) under concurrent clients, and a herd of clients which read /memory/info at
+the same time (with the number of queries they make). The results are written as JSON,
+and a previous result could be passed by --compare to print the change of each number.
+
+Run it from the root of the repository:
+
+    python -m bench.bench_api [--output bench-api.json] [--compare old.json]
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+# the app should use the temp database, so it's set before importing app
+_directory = tempfile.TemporaryDirectory()
+os.environ["URL"] = f"sqlite:///{_directory.name}/bench.sqlite"
+
+import httpx
+
+from app.cache import response_cache, user_cache
+from app.config import settings
+from app.main import app
+from app.mem_info import get_mem_usage
+from app.sql import crud, get_db, schemas
+from app.singleflight import memory_flight
+from app.sql.ring import memory_ring
+
+# the app logs each request in debug mode
+logging.disable(logging.INFO)
+
+USERNAME = "bench"
+PASSWORD = "bench"
+
+
+def latency(seconds: List[float]) -> Dict[str, float]:
+    """Summarizes latencies in milliseconds"""
+    quantiles = statistics.quantiles(seconds, n=100)
+    return {"mean_ms": statistics.fmean(seconds) * 1e3,
+            "p50_ms": quantiles[49] * 1e3,
+            "p95_ms": quantiles[94] * 1e3,
+            "p99_ms": quantiles[98] * 1e3}
+
+
+def fake_memories(n: int, start: datetime.datetime):
+    return [schemas.MemCreate(time=start + datetime.timedelta(seconds=i),
+                              free=1000.0 + i % 100, used=3000.0 - i % 100, total=4000.0)
+            for i in range(n)]
+
+
+def bench_sampler(n: int) -> Dict[str, float]:
+    get_mem_usage()
+    seconds = []
+    for _ in range(n):
+        start = time.perf_counter()
+        get_mem_usage()
+        seconds.append(time.perf_counter() - start)
+    return latency(seconds)
+
+
+def bench_insert(n: int) -> Dict[str, float]:
+    memories = fake_memories(n, datetime.datetime(2000, 1, 1))
+    with get_db() as db:
+        start = time.perf_counter()
+        for memory in memories:
+            crud.create_memory(db, memory)
+        seconds = time.perf_counter() - start
+    return {"per_second": n / seconds}
+
+
+async def bench_info(client: httpx.AsyncClient,
+                     headers: Dict[str, str],
+                     limit: int,
+                     requests: int,
+                     cached: bool,
+                     format: str = "rows"
+) -> Dict[str, float]:
+    seconds = []
+    for i in range(requests):
+        if not cached:
+            # a new version drops the cached response like a new sample
+            response_cache.invalidate(settings.local_host, i + 1)
+        start = time.perf_counter()
+        response = await client.get(f"/memory/info/?limit={limit}&format={format}",
+                                    headers=headers)
+        seconds.append(time.perf_counter() - start)
+        response.raise_for_status()
+    return {**latency(seconds), "bytes": len(response.content)}
+
+
+async def bench_concurrent(request: Callable, clients: int, requests: int
+) -> Dict[str, float]:
+    """Runs the request by concurrent clients and returns the throughput and latency"""
+    seconds = []
+
+    async def worker():
+        for _ in range(requests):
+            start = time.perf_counter()
+            response = await request()
+            seconds.append(time.perf_counter() - start)
+            response.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(clients)))
+    total = time.perf_counter() - start
+    return {"per_second": clients * requests / total, **latency(seconds)}
+
+
+async def bench_herd(client, headers, clients: int, rounds: int) -> Dict[str, float]:
+    """Runs a herd of clients which read /memory/info at the same time after each new
+    sample, and returns the latency and the number of queries of each round"""
+    seconds = []
+    executed = memory_flight.executed
+
+    async def request():
+        start = time.perf_counter()
+        response = await client.get("/memory/info/?limit=100", headers=headers)
+        seconds.append(time.perf_counter() - start)
+        response.raise_for_status()
+
+    for i in range(rounds):
+        response_cache.invalidate(settings.local_host, -i - 1)
+        await asyncio.gather(*(request() for _ in range(clients)))
+    return {**latency(seconds),
+            "queries_per_round": (memory_flight.executed - executed) / rounds}
+
+
+async def bench_http(args) -> Dict[str, Dict[str, float]]:
+    results = {}
+    with get_db() as db:
+        crud.create_user(db, schemas.UserCreate(username=USERNAME,
+                                                email="bench@example.com",
+                                                password=PASSWORD))
+    form = {"username": USERNAME, "password": PASSWORD}
+    # the startup events are not run, so the sampler does not write to the database
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        token = (await client.post("/users/token", data=form)).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        memory_ring.clear()
+        stored = 0
+        for rows in args.rows:
+            with get_db() as db:
+                crud.create_memories(db, fake_memories(
+                    rows - stored, datetime.datetime(2010, 1, 1) + datetime.timedelta(
+                        seconds=stored)))
+            stored = rows
+            for limit in args.limits:
+                for format, cached in itertools.product(("rows", "columns"),
+                                                        (False, True)):
+                    name = f"info rows={rows} limit={limit}"
+                    name += (" columns" if format == "columns" else "") + (
+                        " cached" if cached else "")
+                    results[name] = await bench_info(client, headers, limit,
+                                                     args.requests, cached, format)
+                    print(f"{name:>48}: p50 {results[name]['p50_ms']:8.3f} ms, "
+                          f"p99 {results[name]['p99_ms']:8.3f} ms, "
+                          f"{results[name]['bytes']:8d} bytes")
+        for clients in args.clients:
+            requests = max(1, args.requests // clients)
+            benches = {
+                "token": lambda: client.post("/users/token", data=form),
+                "me": lambda: client.get("/users/me", headers=headers),
+            }
+            for name, request in benches.items():
+                name = f"{name} clients={clients}"
+                results[name] = await bench_concurrent(request, clients, requests)
+                print(f"{name:>40}: {results[name]['per_second']:8.0f} requests/s")
+            # the validation of a token without the cache of its user
+            capacity, user_cache.capacity = user_cache.capacity, 0
+            user_cache.clear()
+            try:
+                name = f"me uncached clients={clients}"
+                results[name] = await bench_concurrent(benches["me"], clients, requests)
+                print(f"{name:>40}: {results[name]['per_second']:8.0f} requests/s")
+            finally:
+                user_cache.capacity = capacity
+            name = f"info herd clients={clients}"
+            results[name] = await bench_herd(client, headers, clients, requests)
+            print(f"{name:>40}: p50 {results[name]['p50_ms']:8.3f} ms, "
+                  f"{results[name]['queries_per_round']:6.2f} queries/round")
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def compare(results: Dict[str, Dict[str, float]], path: str):
+    """Prints the change of each number from a previous result"""
+    with open(path) as f:
+        old = json.load(f)["results"]
+    for name, values in results.items():
+        for key, value in values.items():
+            previous = old.get(name, {}).get(key)
+            if previous:
+                print(f"{name:>40} {key:>10}: {previous:12.3f} -> {value:12.3f} "
+                      f"({(value - previous) / previous:+7.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=1000,
+                        help="the number of sampler ticks and inserts")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="the number of requests of each HTTP benchmark")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10_000, 100_000],
+                        help="the table sizes of /memory/info")
+    parser.add_argument("--limits", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--output", default="bench-api.json")
+    parser.add_argument("--compare", help="a previous output to compare with")
+    args = parser.parse_args()
+
+    results = {"sampler": bench_sampler(args.samples)}
+    print(f"{'sampler':>40}: p50 {results['sampler']['p50_ms']:8.3f} ms")
+    results["insert"] = bench_insert(args.samples)
+    print(f"{'insert':>40}: {results['insert']['per_second']:8.0f} rows/s")
+    results.update(asyncio.run(bench_http(args)))
+
+    output = {
+        "meta": {"time": datetime.datetime.now().isoformat(),
+                 "revision": git_revision(),
+                 "python": sys.version.split()[0],
+                 "platform": platform.platform(),
+                 "args": vars(args)},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
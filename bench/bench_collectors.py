@@ -0,0 +1,35 @@
+"""Micro-benchmark of the memory collectors (cost of one sample).
+
+Run it from the root of the repository:
+
+    python -m bench.bench_collectors [--samples N]
+"""
+import argparse
+import timeit
+
+from app.mem_info import FreeCommandCollector, ProcMeminfoCollector
+
+
+def bench(collector, samples: int) -> float:
+    """Returns the mean time of one sample in microseconds"""
+    collector.collect()  # warm up
+    seconds = timeit.timeit(collector.collect, number=samples)
+    return seconds / samples * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+
+    for name, factory in (("procfs", ProcMeminfoCollector),
+                          ("free", FreeCommandCollector)):
+        collector = factory()
+        try:
+            print(f"{name:>8}: {bench(collector, args.samples):10.1f} us/sample")
+        finally:
+            collector.close()
+
+
+if __name__ == "__main__":
+    main()
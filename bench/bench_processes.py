@@ -0,0 +1,69 @@
+"""Benchmark of the scan time of the top processes (`app.processes.ProcessScanner`)
+versus the number of processes.
+
+A fake procfs with the files which are read (statm, stat and cmdline) is made for each
+count, so it's measured beyond the processes of this machine. The first scan reads the
+command lines of the top ones and the next ones use the cache. The real /proc is also
+scanned if it exists.
+
+Run it from the root of the repository:
+
+    python -m bench.bench_processes [--counts 100 1000 5000 10000] [--top 10]
+"""
+import argparse
+import os
+import pathlib
+import statistics
+import tempfile
+import time
+
+from app.processes import ProcessScanner
+
+
+def make_fake_proc(root: pathlib.Path, count: int):
+    for pid in range(1, count + 1):
+        directory = root / str(pid)
+        directory.mkdir()
+        rss = pid * 7919 % 100_000
+        (directory / "statm").write_text(f"{rss * 3} {rss} {rss // 2} 1 0 {rss} 0\n")
+        fields = ["S"] + ["0"] * 18 + [str(pid)] + ["0"] * 30
+        (directory / "stat").write_text(f"{pid} (proc{pid}) {' '.join(fields)}\n")
+        (directory / "cmdline").write_bytes(f"/usr/bin/proc{pid}\0--flag\0".encode())
+    # the other entries of procfs are skipped
+    (root / "meminfo").write_text("")
+    (root / "self").mkdir()
+
+
+def bench(path: str, top: int, repeat: int) -> str:
+    scanner = ProcessScanner(path, top_n=top)
+    start = time.perf_counter()
+    scanner.scan()
+    first = time.perf_counter() - start
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        scanner.scan()
+        seconds.append(time.perf_counter() - start)
+    return (f"first {first * 1e3:8.3f} ms, "
+            f"next p50 {statistics.median(seconds) * 1e3:8.3f} ms, "
+            f"max {max(seconds) * 1e3:8.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--counts", type=int, nargs="+", default=[100, 1000, 5000, 10000])
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    for count in args.counts:
+        with tempfile.TemporaryDirectory() as directory:
+            make_fake_proc(pathlib.Path(directory), count)
+            print(f"{count:>8} processes: {bench(directory, args.top, args.repeat)}")
+    if os.path.isdir("/proc"):
+        count = sum(name.isdigit() for name in os.listdir("/proc"))
+        print(f"{count:>8} processes of /proc: {bench('/proc', args.top, args.repeat)}")
+
+
+if __name__ == "__main__":
+    main()
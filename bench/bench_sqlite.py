@@ -0,0 +1,122 @@
+"""Benchmark of the read latency of SQLite under concurrent writes by each profile of
+pragmas (see `AppSettings.Sql`).
+
+Some reader threads read the last samples of a host (like /memory/info) through the
+read-only sessions while one writer thread inserts batches of samples like the sampler
+and /memory/ingest. Each profile runs in a new process, because the pragmas are read when
+`app.sql` is imported:
+
+- rollback: the rollback journal and a full sync on each commit (the SQLite defaults)
+- wal: the defaults of `AppSettings.Sql` (WAL and synchronous NORMAL)
+
+Run it from the root of the repository:
+
+    python -m bench.bench_sqlite [--seconds 5] [--readers 4]
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PROFILES = {
+    "rollback": {"JOURNAL_MODE": "DELETE", "SYNCHRONOUS": "FULL"},
+    "wal": {},
+}
+
+
+def run_profile(args):
+    """Runs the benchmark of the current pragmas and prints the result as JSON"""
+    from app.sql import ReadSessionLocal, in_write_session
+    from app.sql import crud, schemas
+
+    host = "bench"
+    start = datetime.datetime(2000, 1, 1)
+
+    def batch(offset: int, size: int):
+        return [schemas.MemCreate(host=host, time=start + datetime.timedelta(seconds=i),
+                                  free=1.0, used=2.0, total=3.0)
+                for i in range(offset, offset + size)]
+
+    in_write_session(crud.create_memories, batch(0, args.rows))
+    stop = threading.Event()
+    writes = [0]
+
+    def writer():
+        offset = args.rows
+        while not stop.is_set():
+            in_write_session(crud.create_memories, batch(offset, args.batch))
+            offset += args.batch
+            writes[0] += 1
+            time.sleep(args.pause / 1000)
+
+    def reader(seconds):
+        while not stop.is_set():
+            begin = time.perf_counter()
+            with ReadSessionLocal() as db:
+                crud.get_mem(db, limit=args.limit, host=host)
+            seconds.append(time.perf_counter() - begin)
+
+    def measure(with_writer: bool):
+        seconds = []
+        threads = [threading.Thread(target=reader, args=(seconds,))
+                   for _ in range(args.readers)]
+        if with_writer:
+            threads.append(threading.Thread(target=writer))
+        stop.clear()
+        for thread in threads:
+            thread.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        quantiles = statistics.quantiles(seconds, n=100)
+        return {"reads_per_second": len(seconds) / args.seconds,
+                "p50_ms": quantiles[49] * 1e3,
+                "p99_ms": quantiles[98] * 1e3,
+                "max_ms": max(seconds) * 1e3}
+
+    result = {"idle": measure(False), "writing": measure(True)}
+    result["writing"]["commits_per_second"] = writes[0] / args.seconds
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=100_000,
+                        help="the number of samples which are stored at first")
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--batch", type=int, default=100,
+                        help="the number of samples of each commit of the writer")
+    parser.add_argument("--pause", type=float, default=1,
+                        help="milliseconds between the commits of the writer")
+    parser.add_argument("--profile", choices=PROFILES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.profile:
+        run_profile(args)
+        return
+    for profile, environment in PROFILES.items():
+        with tempfile.TemporaryDirectory() as directory:
+            env = {**os.environ, **environment,
+                   "URL": f"sqlite:///{directory}/bench.sqlite",
+                   "DIRECTORY": directory}
+            output = subprocess.run(
+                [sys.executable, "-m", "bench.bench_sqlite", "--profile", profile,
+                 *sys.argv[1:]],
+                env=env, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        for name, values in result.items():
+            print(f"{profile:>8} {name:>7}: " + ", ".join(
+                f"{key} {value:9.2f}" for key, value in values.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Benchmark of the window statistics (`app.stats.get_mem_stats`) on per-second data.
+
+Run it from the root of the repository:
+
+    python -m bench.bench_stats [--days 30]
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+# the app should use the temp database, so it's set before importing app
+_directory = tempfile.TemporaryDirectory()
+os.environ["URL"] = f"sqlite:///{_directory.name}/bench.sqlite"
+
+from app.sql import crud, get_db
+from app.stats import get_mem_stats
+
+from .bench_storage import fake_memories
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=float, default=30)
+    parser.add_argument("--batch", type=int, default=100_000)
+    args = parser.parse_args()
+
+    samples = int(args.days * 24 * 60 * 60)
+    with get_db() as db:
+        for i in range(0, samples, args.batch):
+            shift = datetime.timedelta(seconds=i)
+            memories = [memory.model_copy(update={"time": memory.time + shift})
+                        for memory in fake_memories(min(args.batch, samples - i))]
+            # the rollups are also written
+            crud.create_memories(db, memories)
+        start = datetime.datetime(2023, 1, 1)
+        end = start + datetime.timedelta(days=args.days)
+        cases = {
+            "min/max/mean/stddev": {},
+            "min/max/mean/stddev by day": {"bucket": 24 * 60 * 60},
+            "min/max/mean/stddev by 5m": {"bucket": 5 * 60},
+            "p50/p95/p99": {"percentiles": [50, 95, 99]},
+            "p50/p95/p99 by day": {"percentiles": [50, 95, 99], "bucket": 24 * 60 * 60},
+            "p50/p95/p99 by 5m": {"percentiles": [50, 95, 99], "bucket": 5 * 60},
+        }
+        for name, kwargs in cases.items():
+            begin = time.perf_counter()
+            result = get_mem_stats(db, start, end, **kwargs)
+            seconds = time.perf_counter() - begin
+            print(f"{name:>28}: {seconds:8.3f} s for {samples} samples "
+                  f"in {len(result.mem_data)} buckets")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Benchmark of the storage backends: bytes per sample and range-scan throughput.
+
+Run it from the root of the repository:
+
+    python -m bench.bench_storage [--samples N] [--batch N ...]
+
+By default, the samples are written in batches of 1000 and of the flush size of the
+writer, which is what the app writes in each flush.
+"""
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, insert, select
+
+from app.config import writer_settings
+from app.sql import models, schemas
+from app.sql.segments import SegmentStore
+
+
+def fake_memories(n: int):
+    """Makes n samples of a second interval whose values walk like a real host"""
+    start = datetime.datetime(2023, 1, 1)
+    total_kb = 16_000_000
+    free_kb = 8_000_000
+    memories = []
+    for i in range(n):
+        free_kb = min(max(free_kb + random.randint(-2048, 2048), 0), total_kb)
+        memories.append(schemas.MemCreate(time=start + datetime.timedelta(seconds=i),
+                                          free=free_kb * 1024 / 1e6,
+                                          used=(total_kb - free_kb) * 1024 / 1e6,
+                                          total=total_kb * 1024 / 1e6))
+    return memories
+
+
+def directory_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def bench_sql(memories, path: str, batch: int):
+    engine = create_engine(f"sqlite:///{path}/bench.sqlite")
+    models.Base.metadata.create_all(engine, tables=[models.Memory.__table__])
+    with engine.begin() as connection:
+        for i in range(0, len(memories), batch):
+            connection.execute(insert(models.Memory),
+                               [memory.model_dump() for memory in memories[i:i + batch]])
+    size = directory_size(path)
+    start = time.perf_counter()
+    with engine.connect() as connection:
+        count = sum(1 for _ in connection.execute(select(models.Memory.__table__)
+                                                  .order_by(models.Memory.time)))
+    seconds = time.perf_counter() - start
+    engine.dispose()
+    return size, count, seconds
+
+
+def bench_segments(memories, path: str, batch: int):
+    store = SegmentStore(path)
+    for i in range(0, len(memories), batch):
+        store.append(memories[i:i + batch])
+    size = directory_size(path)
+    start = time.perf_counter()
+    count = sum(1 for _ in store.scan())
+    seconds = time.perf_counter() - start
+    store.close()
+    return size, count, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=100_000)
+    parser.add_argument("--batch", type=int, nargs="+",
+                        default=[1000, writer_settings.flush_size],
+                        help="the numbers of samples written together")
+    args = parser.parse_args()
+
+    memories = fake_memories(args.samples)
+    for batch in args.batch:
+        for name, bench in (("sql", bench_sql), ("segments", bench_segments)):
+            with tempfile.TemporaryDirectory() as path:
+                size, count, seconds = bench(memories, path, batch)
+            print(f"{name:>8} (batch {batch:>5}): "
+                  f"{size / args.samples:8.2f} bytes/sample, "
+                  f"scan {count / seconds:12.0f} samples/s")
+
+if __name__ == "__main__":
+    main()
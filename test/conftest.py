@@ -0,0 +1,10 @@
+import pytest
+
+from app.sql import get_db
+
+
+@pytest.fixture()
+def db():
+    """A session of the database which is closed after the test"""
+    with get_db() as session:
+        yield session
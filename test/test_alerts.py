@@ -0,0 +1,72 @@
+import datetime
+
+from app.alerts import AlertEngine
+from app.sql import schemas
+
+
+START = datetime.datetime(2023, 1, 1)
+
+
+def make_rule(rule_id: int = 1, **kwargs) -> schemas.AlertRule:
+    fields = {"name": "rule", "field": "used", "threshold": 10.0, **kwargs}
+    return schemas.AlertRule(id=rule_id, **fields)
+
+def make_sample(second: float, used: float, host: str = "a") -> schemas.MemCreate:
+    return schemas.MemCreate(time=START + datetime.timedelta(seconds=second), host=host,
+                             free=0.0, used=used, total=100.0)
+
+def run(engine: AlertEngine, values, host: str = "a"):
+    """Evaluates a sample each second and returns the states of the events by second"""
+    events = {}
+    for second, value in enumerate(values):
+        for event in engine.evaluate(make_sample(second, value, host)):
+            events[second] = event.state
+    return events
+
+
+class TestAlerts:
+    def test_threshold(self):
+        """It tests a threshold rule fires and resolves only on the changes"""
+        engine = AlertEngine()
+        engine.load([make_rule()])
+        assert run(engine, [5, 11, 12, 9, 8, 20]) == {1: "firing", 3: "resolved",
+                                                      5: "firing"}
+
+    def test_hosts(self):
+        """It tests the state of a rule is kept for each host and a rule of a host
+        ignores the others"""
+        engine = AlertEngine()
+        engine.load([make_rule(1), make_rule(2, host="b")])
+        events = engine.evaluate(make_sample(0, 20, "a"))
+        assert [(e.rule_id, e.host) for e in events] == [(1, "a")]
+        events = engine.evaluate(make_sample(0, 20, "b"))
+        assert [(e.rule_id, e.host) for e in events] == [(1, "b"), (2, "b")]
+        # an older sample is ignored
+        assert engine.evaluate(make_sample(-1, 0, "a")) == []
+
+    def test_zscore(self):
+        """It tests a z-score rule fires on a spike after its warm-up"""
+        engine = AlertEngine()
+        engine.load([make_rule(kind="zscore", threshold=3.0, min_samples=10)])
+        values = [50.0 + (i % 2) for i in range(20)] + [80.0, 50.0, 51.0]
+        events = run(engine, values)
+        assert events == {20: "firing", 21: "resolved"}
+
+    def test_rate(self):
+        """It tests a rate rule over a window of seconds"""
+        engine = AlertEngine()
+        engine.load([make_rule(kind="rate", threshold=1.0, window=3)])
+        # +2/s for 3 seconds then flat
+        values = [0, 0, 2, 4, 6, 6, 6, 6, 6]
+        assert run(engine, values) == {3: "firing", 6: "resolved"}
+
+    def test_set_rule(self):
+        """It tests changing and removing a rule resets its state"""
+        engine = AlertEngine()
+        engine.load([make_rule()])
+        assert run(engine, [20]) == {0: "firing"}
+        engine.set_rule(make_rule(threshold=30.0))
+        assert engine.evaluate(make_sample(1, 20)) == []
+        engine.set_rule(make_rule(enabled=False))
+        engine.remove_rule(1)
+        assert engine.evaluate(make_sample(2, 40)) == []
@@ -0,0 +1,90 @@
+import asyncio
+import datetime
+import os
+import socket
+
+from app.broadcast import SAMPLE, BroadcastHub, WorkerChannel
+from app.config import stream_settings
+
+
+class TestBroadcast:
+    async def test_fan_out(self):
+        """It tests each published message reaches all the subscribers"""
+        hub = BroadcastHub(queue_size=4)
+        with hub.subscribe() as first, hub.subscribe() as second:
+            assert len(hub) == 2
+            hub.publish("a")
+            assert await first.get() == "a"
+            assert await second.get() == "a"
+        assert len(hub) == 0
+
+    async def test_slow_subscriber(self):
+        """It tests a full queue drops its oldest messages instead of blocking"""
+        hub = BroadcastHub(queue_size=2)
+        with hub.subscribe() as subscriber:
+            for message in range(5):
+                hub.publish(message)
+            assert subscriber.dropped == 3
+            assert [await subscriber.get(), await subscriber.get()] == [3, 4]
+
+    async def test_wait_for_message(self):
+        """It tests a subscriber waits for the next message"""
+        hub = BroadcastHub(queue_size=2)
+        with hub.subscribe() as subscriber:
+            getter = asyncio.create_task(subscriber.get())
+            await asyncio.sleep(0)
+            assert not getter.done()
+            hub.publish("a")
+            assert await asyncio.wait_for(getter, 1) == "a"
+
+    async def test_topic(self):
+        """It tests a subscriber of a topic only gets its messages"""
+        hub = BroadcastHub(queue_size=4)
+        with hub.subscribe("a") as subscriber, hub.subscribe() as everything:
+            hub.publish(1, topic="b")
+            hub.publish(2, topic="a")
+            assert await subscriber.get() == 2
+            assert [await everything.get(), await everything.get()] == [1, 2]
+
+    async def test_events(self, monkeypatch):
+        """It tests the Server-Sent Events of a topic and the keep-alive comments, and
+        the subscriber is removed when the stream is closed"""
+        monkeypatch.setattr(stream_settings, "keepalive", datetime.timedelta(seconds=0.01))
+        hub = BroadcastHub(queue_size=4)
+        events = hub.events("a")
+        assert await events.__anext__() == ": keepalive\n\n"
+        hub.publish("x", topic="b")
+        hub.publish("y", topic="a")
+        assert await events.__anext__() == "data: y\n\n"
+        assert len(hub) == 1
+        await events.aclose()
+        assert len(hub) == 0
+
+    async def test_worker_channel(self, tmp_path):
+        """It tests a message of a worker reaches the other workers"""
+        first = WorkerChannel(str(tmp_path), "first")
+        second = WorkerChannel(str(tmp_path), "second")
+        received = asyncio.Queue()
+        second.start(lambda kind, payload: received.put_nowait((kind, payload)))
+        try:
+            first.send(SAMPLE, b"{}")
+            assert await asyncio.wait_for(received.get(), 1) == (SAMPLE, b"{}")
+            # the message is not sent back to its sender
+            assert first.peers() == [second.address]
+        finally:
+            first.close()
+            second.close()
+        assert os.listdir(tmp_path) == []
+
+    async def test_worker_gone(self, tmp_path):
+        """It tests the socket of a worker which is gone is removed"""
+        gone = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        gone.bind(str(tmp_path / "gone.sock"))
+        gone.close()
+        channel = WorkerChannel(str(tmp_path), "alive")
+        try:
+            channel.send(SAMPLE, b"{}")
+            assert not (tmp_path / "gone.sock").exists()
+            assert channel.peers() == []
+        finally:
+            channel.close()
@@ -0,0 +1,58 @@
+import asyncio
+import datetime
+
+from app.broadcast import SAMPLE, memory_hub
+from app.config import settings
+from app import leader
+from app.leader import LeaderLease, handle_worker_message
+from app.sql import schemas
+from app.sql.ring import memory_ring
+
+
+class TestLeader:
+    def test_lease(self, tmp_path):
+        """It tests only one holder of the lease at a time and the failover"""
+        path = str(tmp_path / "leader.lock")
+        first, second = LeaderLease(path), LeaderLease(path)
+        assert first.acquire()
+        assert not second.acquire()
+        assert first.acquire()
+        first.release()
+        assert second.acquire()
+        assert second.held and not first.held
+        second.release()
+
+    async def test_sample_of_leader(self):
+        """It tests a sample of the leader is served by a follower"""
+        sample = schemas.MemCreate(time=datetime.datetime(2100, 1, 1),
+                                   host=settings.local_host, free=1.0, used=2.0, total=3.0)
+        message = sample.model_dump_json()
+        with memory_hub.subscribe(settings.local_host) as subscriber:
+            handle_worker_message(SAMPLE, message.encode())
+            assert await asyncio.wait_for(subscriber.get(), 1) == message
+        try:
+            latest = memory_ring.latest(1)[0]
+            assert (latest.time, latest.used) == (sample.time, sample.used)
+        finally:
+            memory_ring.clear()
+
+    async def test_alerts_of_leader(self, tmp_path, monkeypatch):
+        """It tests the samples of the other workers are only evaluated by the leader"""
+        evaluated = []
+
+        async def evaluate_alerts(samples):
+            evaluated.extend(samples)
+
+        monkeypatch.setattr(leader, "evaluate_alerts", evaluate_alerts)
+        sample = schemas.MemCreate(time=datetime.datetime(2100, 1, 1), host="other",
+                                   free=1.0, used=2.0, total=3.0)
+        handle_worker_message(SAMPLE, sample.model_dump_json().encode())
+        await asyncio.sleep(0)
+        assert evaluated == []
+        lease = LeaderLease(str(tmp_path / "leader.lock"))
+        assert lease.acquire()
+        monkeypatch.setattr(leader, "_lease", lease)
+        handle_worker_message(SAMPLE, sample.model_dump_json().encode())
+        await asyncio.sleep(0)
+        assert evaluated == [sample]
+        lease.release()
@@ -1,11 +1,25 @@
+import csv
+import datetime
+import gzip
+import io
 import json
 import random
+import struct
+import time
 
 import pytest
 from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
 
+from app import leader
+from app.broadcast import memory_hub
+from app.cache import response_cache, user_cache
+from app.config import profiling_settings, settings
+from app.export import encode_binary
 from app.main import app
-from app.sql import crud, schemas, get_db
+from app.routers import user
+from app.sql import crud, schemas
+from app.sql.ring import MEMORY_FIELDS
 
 client = TestClient(app)
 
@@ -22,7 +36,7 @@ class TestAPI:
     @classmethod
     def _create_fake_user(cls):
         """A function to create a fake user to work with it"""
-        rand_name = f"fake{random.randint(0, 10000)}"
+        rand_name = f"fake{random.randint(0, 10 ** 9)}"
         fake_user = schemas.UserCreate(username=rand_name,
                                        email=f"{rand_name}@example.com",
                                        password="1234")
@@ -45,10 +59,10 @@ class TestAPI:
         assert response.json()["message"] == "Your account has been created successfully!"
 
     @pytest.fixture()
-    def create_fake_accounts(self):
+    def create_fake_accounts(self, db):
         """A test fixture to create a fake account and add it to the database"""
         self.__class__.test_user = self._create_fake_user()
-        crud.create_user(get_db(), self.test_user)
+        crud.create_user(db, self.test_user)
         # TODO: delete fake users from database after test
 
     def test_try_create_duplicate_username(self, create_fake_accounts):
@@ -99,6 +113,25 @@ class TestAPI:
         assert response.status_code == 406
         assert response.json()["detail"] == "This account is already exist!"
 
+    def test_create_account_race(self, create_fake_accounts, monkeypatch):
+        """It tests a user which is created after the checks of a request (by another
+        request) is rejected"""
+        monkeypatch.setattr(user, "get_user", lambda db, username: None)
+        monkeypatch.setattr(user, "get_user_by_email", lambda db, email: None)
+        fake_user = self.test_user
+        form_data = {
+            "username": fake_user.username,
+            "email": fake_user.email,
+            "password": fake_user.password
+        }
+        response = client.post(
+            "/users/register",
+            params=form_data,
+            headers={ 'Content-Type': 'application/x-www-form-urlencoded'}
+        )
+        assert response.status_code == 406
+        assert response.json()["detail"] == "This account is already exist!"
+
     @pytest.fixture()
     def create_fake_token(self, create_fake_accounts):
         """A test fixture to get a token from API for a fake account. Also, it returns
@@ -156,7 +189,7 @@ class TestAPI:
         response = client.get("/users/me", headers={"Authorization": f'Bearer 0'})
         assert response.status_code == 401
 
-    def test_getting_memory(self, create_fake_token):
+    def test_getting_memory(self, create_fake_token, db):
         """It tests getting memory information from database."""
         response = create_fake_token()
         assert response.status_code == 201
@@ -164,5 +197,298 @@ class TestAPI:
         response = client.get("/memory/info?limit=1",
                               headers={"Authorization": f'Bearer {token}'})
         assert response.status_code == 200
-        list_mem = crud.get_mem(get_db(), 1)
-        assert response.json() == json.loads(list_mem.json())
\ No newline at end of file
+        list_mem = crud.get_mem(db, 1)
+        assert response.json() == json.loads(list_mem.json())
+
+    def test_getting_memory_cache_stats(self, create_fake_token):
+        """It tests getting statistics of the memory cache."""
+        response = create_fake_token()
+        token = response.json()["access_token"]
+        response = client.get("/memory/cache/",
+                              headers={"Authorization": f'Bearer {token}'})
+        assert response.status_code == 200
+        assert set(response.json()) == {"hits", "misses", "size", "capacity"}
+
+
+    def test_getting_memory_range(self, create_fake_token):
+        """It tests getting memory information in a time range."""
+        response = create_fake_token()
+        token = response.json()["access_token"]
+        response = client.get("/memory/range/?points=10",
+                              headers={"Authorization": f'Bearer {token}'})
+        assert response.status_code == 200
+        assert response.json()["resolution"] == 3600
+        response = client.get("/memory/range/?start=2023-01-02T00:00:00&end=2023-01-01T00:00:00",
+                              headers={"Authorization": f'Bearer {token}'})
+        assert response.status_code == 400
+
+
+    def test_getting_memory_page(self, create_fake_token):
+        """It tests getting memory information page by page."""
+        response = create_fake_token()
+        token = response.json()["access_token"]
+        response = client.get("/memory/?limit=1",
+                              headers={"Authorization": f'Bearer {token}'})
+        assert response.status_code == 200
+        assert "next_cursor" in response.json()
+        response = client.get("/memory/?cursor=0",
+                              headers={"Authorization": f'Bearer {token}'})
+        assert response.status_code == 400
+
+
+    def test_streaming_memory_ws(self, create_fake_token):
+        """It tests getting new memory samples over a WebSocket."""
+        response = create_fake_token()
+        token = response.json()["access_token"]
+        with client.websocket_connect(f"/memory/ws/?token={token}") as websocket:
+            # waits to be subscribed
+            for _ in range(100):
+                if memory_hub:
+                    break
+                time.sleep(0.01)
+            websocket.portal.call(memory_hub.publish, '{"free": 1.0}')
+            assert websocket.receive_json() == {"free": 1.0}
+
+    def test_bad_streaming_memory_ws(self):
+        """It tests a WebSocket with a non-valid token is closed."""
+        with pytest.raises(WebSocketDisconnect):
+            with client.websocket_connect("/memory/ws/?token=0"):
+                pass
+
+
+    def test_cached_token_user(self, create_fake_token, db):
+        """It tests the user of a token is cached and invalidated when it's changed."""
+        response = create_fake_token()
+        token = response.json()["access_token"]
+        headers = {"Authorization": f'Bearer {token}'}
+        assert client.get("/users/me", headers=headers).status_code == 200
+        hits = user_cache.hits
+        assert client.get("/users/me", headers=headers).status_code == 200
+        assert user_cache.hits == hits + 1
+        crud.set_user_activated(db, self.test_user.username, False)
+        assert user_cache.get(token) is None
+        assert client.get("/users/me", headers=headers).status_code == 400
+        response = client.get("/users/cache/", headers=headers)
+        assert response.status_code == 400
+
+
+    def test_getting_memory_etag(self, create_fake_token):
+        """It tests the cached memory response and its ETag."""
+        response = create_fake_token()
+        token = response.json()["access_token"]
+        headers = {"Authorization": f'Bearer {token}'}
+        host = settings.local_host
+        response_cache.invalidate(host, random.randint(0, 2 ** 60))
+        response = client.get("/memory/info?limit=2", headers=headers)
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        hits = response_cache.hits
+        response = client.get("/memory/info?limit=2", headers=headers)
+        assert response.status_code == 200
+        assert response_cache.hits == hits + 1
+        response = client.get("/memory/info?limit=2",
+                              headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+        # a new sample changes the ETag
+        response_cache.invalidate(host, response_cache.version(host) + 1)
+        response = client.get("/memory/info?limit=2",
+                              headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
+
+    def test_exporting_memory(self, create_fake_token, db):
+        """It tests exporting memory history in all formats."""
+        response = create_fake_token()
+        token = response.json()["access_token"]
+        headers = {"Authorization": f'Bearer {token}'}
+        now = datetime.datetime.now()
+        memories = [schemas.MemCreate(time=now + datetime.timedelta(microseconds=i),
+                                      free=1.0, used=2.0, total=3.0) for i in range(3)]
+        crud.create_memories(db, memories)
+        window = {"start": memories[0].time.isoformat(),
+                  "end": (now + datetime.timedelta(seconds=1)).isoformat()}
+        response = client.get("/memory/export/", params=window, headers=headers)
+        assert response.status_code == 200
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert [row["time"] for row in rows[:3]] == [m.time.isoformat() for m in memories]
+        assert rows[0]["available"] is None
+        response = client.get("/memory/export/",
+                              params={**window, "format": "csv", "compression": "gzip"},
+                              headers=headers)
+        assert response.status_code == 200
+        rows = list(csv.reader(io.StringIO(gzip.decompress(response.content).decode())))
+        assert rows[0][:4] == ["time", "free", "used", "total"]
+        assert rows[1][1] == "1.0"
+        response = client.get("/memory/export/", params={**window, "format": "binary"},
+                              headers=headers)
+        assert response.content[:4] == b"MEMX"
+        _, columns, length = struct.unpack("<BHH", response.content[4:9])
+        record = struct.Struct("<q" + "d" * columns)
+        body = response.content[9 + length:]
+        assert len(body) % record.size == 0
+        assert record.unpack(body[:record.size])[1:4] == (1.0, 2.0, 3.0)
+
+
+    def test_ingesting_memory(self, create_fake_token):
+        """It tests ingesting batches of another host as JSON and binary."""
+        response = create_fake_token()
+        token = response.json()["access_token"]
+        headers = {"Authorization": f'Bearer {token}'}
+        host = f"host-{random.randint(0, 10 ** 9)}"
+        now = datetime.datetime.now()
+        batch = {"host": host,
+                 "mem_data": [{"time": (now + datetime.timedelta(seconds=i)).isoformat(),
+                               "free": 1.0, "used": 2.0, "total": 3.0}
+                              for i in range(2)]}
+        response = client.post("/memory/ingest/", json=batch, headers=headers)
+        assert response.status_code == 201
+        assert response.json() == {"count": 2}
+        rows = [(now + datetime.timedelta(seconds=2),
+                 *[4.0 if name == "free" else 0.0 for name in MEMORY_FIELDS])]
+        response = client.post(f"/memory/ingest/?host={host}",
+                               content=b"".join(encode_binary([rows])),
+                               headers={**headers,
+                                        "Content-Type": "application/octet-stream"})
+        assert response.status_code == 201
+        assert response.json() == {"count": 1}
+        response = client.get(f"/memory/info?limit=5&host={host}", headers=headers)
+        assert response.status_code == 200
+        assert [m["free"] for m in response.json()["mem_data"]] == [4.0, 1.0, 1.0]
+        # the samples of the host are not the samples of this machine
+        response = client.get(f"/memory/?host={host}-other", headers=headers)
+        assert response.json()["mem_data"] == []
+        response = client.post("/memory/ingest/", content=b"MEMX",
+                               headers={**headers,
+                                        "Content-Type": "application/octet-stream"})
+        assert response.status_code == 400
+
+
+    def test_metrics(self, create_fake_token):
+        """It tests the metrics of requests and database are exposed."""
+        response = create_fake_token()
+        token = response.json()["access_token"]
+        client.get("/memory/info?limit=1", headers={"Authorization": f'Bearer {token}'})
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("text/plain")
+        text = response.text
+        assert ('memapi_http_request_duration_seconds_count{method="POST",'
+                'route="/users/token",status="201"}') in text
+        assert 'memapi_db_query_duration_seconds_count{statement="SELECT"}' in text
+        assert "memapi_db_commit_duration_seconds_count" in text
+        assert 'memapi_cache_hits_total{cache="user"}' in text
+        assert "memapi_singleflight_executed_total" in text
+
+    def test_getting_profiles(self, create_fake_token, monkeypatch):
+        """It tests only the admins could read the profiles of requests."""
+        response = create_fake_token()
+        token = response.json()["access_token"]
+        headers = {"Authorization": f'Bearer {token}'}
+        monkeypatch.setattr(profiling_settings, "admins", [])
+        assert client.get("/profiles/", headers=headers).status_code == 403
+        monkeypatch.setattr(profiling_settings, "admins", [self.test_user.username])
+        response = client.get("/profiles/", headers=headers)
+        assert response.status_code == 200
+        assert "profiles" in response.json()
+        assert client.get("/profiles/0", headers=headers).status_code == 404
+
+    def test_getting_memory_stats(self, create_fake_token):
+        """It tests getting statistics of memory in a window."""
+        response = create_fake_token()
+        token = response.json()["access_token"]
+        headers = {"Authorization": f'Bearer {token}'}
+        response = client.get("/memory/stats/?percentiles=50&percentiles=99&bucket=3600",
+                              headers=headers)
+        assert response.status_code == 200
+        assert response.json()["bucket"] == 3600
+        for item in response.json()["mem_data"]:
+            assert set(item["used"]["percentiles"]) == {"p50", "p99"}
+        response = client.get("/memory/stats/?percentiles=101", headers=headers)
+        assert response.status_code == 422
+        response = client.get("/memory/stats/?bucket=90", headers=headers)
+        assert response.status_code == 400
+
+    def test_alerts(self, create_fake_token, monkeypatch, tmp_path):
+        """It tests managing alert rules and the events of the ingested samples."""
+        # the rules are evaluated by the leader
+        lease = leader.LeaderLease(str(tmp_path / "leader.lock"))
+        assert lease.acquire()
+        monkeypatch.setattr(leader, "_lease", lease)
+        response = create_fake_token()
+        token = response.json()["access_token"]
+        headers = {"Authorization": f'Bearer {token}'}
+        host = f"host-{random.randint(0, 10 ** 9)}"
+        rule = {"name": "high used", "host": host, "field": "used", "threshold": 5.0}
+        response = client.post("/alerts/rules/", json=rule, headers=headers)
+        assert response.status_code == 201
+        rule_id = response.json()["id"]
+        response = client.get("/alerts/rules/", headers=headers)
+        assert rule_id in [item["id"] for item in response.json()]
+        now = datetime.datetime.now()
+        batch = {"host": host,
+                 "mem_data": [{"time": (now + datetime.timedelta(seconds=i)).isoformat(),
+                               "free": 1.0, "used": used, "total": 10.0}
+                              for i, used in enumerate([1.0, 6.0, 7.0, 2.0])]}
+        response = client.post("/memory/ingest/", json=batch, headers=headers)
+        assert response.status_code == 201
+        response = client.get(f"/alerts/events/?host={host}", headers=headers)
+        assert response.status_code == 200
+        events = response.json()["events"]
+        assert [(e["state"], e["value"]) for e in events] == [("resolved", 2.0),
+                                                              ("firing", 6.0)]
+        assert all(e["rule_id"] == rule_id for e in events)
+        rule["kind"] = "bad"
+        response = client.put(f"/alerts/rules/{rule_id}", json=rule, headers=headers)
+        assert response.status_code == 422
+        response = client.delete(f"/alerts/rules/{rule_id}", headers=headers)
+        assert response.status_code == 204
+        response = client.delete(f"/alerts/rules/{rule_id}", headers=headers)
+        assert response.status_code == 404
+
+    def test_getting_memory_processes(self, create_fake_token, db):
+        """It tests getting the top processes of the last tick."""
+        response = create_fake_token()
+        token = response.json()["access_token"]
+        headers = {"Authorization": f'Bearer {token}'}
+        host = f"host-{random.randint(0, 10 ** 9)}"
+        response = client.get(f"/memory/processes/?host={host}", headers=headers)
+        assert response.json() == {"host": host, "time": None, "processes": []}
+        now = datetime.datetime.now()
+        crud.create_process_memories(db, [
+            schemas.ProcessMemory(host=host, time=now + datetime.timedelta(seconds=i),
+                                  pid=pid, name="p", cmdline="p", rss=rss, vms=rss)
+            for i in range(2) for pid, rss in ((1, 10.0 + i), (2, 20.0))])
+        response = client.get(f"/memory/processes/?host={host}", headers=headers)
+        assert response.status_code == 200
+        assert [p["rss"] for p in response.json()["processes"]] == [20.0, 11.0]
+        response = client.get(f"/memory/processes/?host={host}&time={now.isoformat()}",
+                              headers=headers)
+        assert [p["rss"] for p in response.json()["processes"]] == [20.0, 10.0]
+
+    def test_getting_memory_columns(self, create_fake_token):
+        """It tests the columnar format of the last samples is the same as the rows."""
+        response = create_fake_token()
+        token = response.json()["access_token"]
+        headers = {"Authorization": f'Bearer {token}'}
+        host = f"host-{random.randint(0, 10 ** 9)}"
+        now = datetime.datetime(2022, 1, 1, 0, 0, 0, 500)
+        batch = {"host": host,
+                 "mem_data": [{"time": (now + datetime.timedelta(seconds=i)).isoformat(),
+                               "free": float(i), "used": 2.0, "total": 3.0}
+                              for i in range(3)]}
+        client.post("/memory/ingest/", json=batch, headers=headers)
+        rows = client.get(f"/memory/info?limit=5&host={host}",
+                          headers=headers).json()["mem_data"]
+        response = client.get(f"/memory/info?limit=5&host={host}&format=columns",
+                              headers=headers)
+        assert response.status_code == 200
+        columns = response.json()
+        assert columns["host"] == host
+        for name in ("time",) + MEMORY_FIELDS:
+            assert columns[name] == [row[name] for row in rows]
+        columns = client.get(f"/memory/info?limit=5&host={host}&format=columns&epoch=true",
+                             headers=headers).json()
+        last = now + datetime.timedelta(seconds=2) - datetime.datetime(1970, 1, 1)
+        assert columns["time"][0] == last // datetime.timedelta(microseconds=1)
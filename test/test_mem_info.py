@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from app import mem_info
+from app.config import process_settings
+from app.mem_info import ProcMeminfoCollector, get_mem_usage
+from app.processes import ProcessScanner
+
+
+FAKE_MEMINFO = """MemTotal:        8000000 kB
+MemFree:         1000000 kB
+MemAvailable:    3000000 kB
+Buffers:          100000 kB
+Cached:           900000 kB
+SwapCached:            0 kB
+SReclaimable:     100000 kB
+SwapTotal:       2000000 kB
+SwapFree:        1500000 kB
+HugePages_Total:       0
+"""
+
+
+def write_fake_process(root, pid: int, rss: int, name: str, cmdline: bytes, start=1):
+    """Creates the files of a fake process in a fake /proc"""
+    directory = root / str(pid)
+    directory.mkdir(exist_ok=True)
+    (directory / "statm").write_text(f"{rss * 2} {rss} 0 0 0 0 0\n")
+    fields = ["S"] + ["0"] * 18 + [str(start)] + ["0"] * 10
+    (directory / "stat").write_text(f"{pid} ({name}) {' '.join(fields)}\n")
+    (directory / "cmdline").write_bytes(cmdline)
+
+
+class TestMemInfo:
+    @pytest.fixture()
+    def fake_meminfo(self, tmp_path):
+        """A test fixture to create a fake /proc/meminfo file"""
+        path = tmp_path / "meminfo"
+        path.write_text(FAKE_MEMINFO)
+        return str(path)
+
+    def test_proc_meminfo_collector(self, fake_meminfo):
+        """It tests parsing memory usage from a meminfo file"""
+        collector = ProcMeminfoCollector(fake_meminfo)
+        usage = collector.collect()
+        collector.close()
+        scale = 1024 / 1e6
+        assert usage.total == pytest.approx(10000000 * scale)
+        assert usage.used == pytest.approx((5000000 + 500000) * scale)
+        assert usage.free == pytest.approx(2500000 * scale)
+        assert usage.available == pytest.approx(3000000 * scale)
+        assert usage.buffers == pytest.approx(100000 * scale)
+        assert usage.cached == pytest.approx(1000000 * scale)
+        assert usage.swap_used == pytest.approx(500000 * scale)
+
+    def test_proc_meminfo_rereads(self, fake_meminfo):
+        """It tests the collector sees the new content of the file on each sample"""
+        collector = ProcMeminfoCollector(fake_meminfo, buffer_size=16)
+        first = collector.collect()
+        with open(fake_meminfo, "r+") as f:
+            f.write(FAKE_MEMINFO.replace("MemFree:         1000000",
+                                         "MemFree:         2000000"))
+        second = collector.collect()
+        collector.close()
+        assert second.free > first.free
+
+    def test_get_mem_usage(self):
+        """It tests getting memory usage of the current system"""
+        usage = get_mem_usage()
+        assert usage is not None
+        assert usage.total >= usage.used > 0
+
+    def test_process_scanner(self, tmp_path):
+        """It tests scanning the top processes by RSS from a fake /proc"""
+        write_fake_process(tmp_path, 1, 100, "init", b"/sbin/init\0")
+        write_fake_process(tmp_path, 20, 300, "my (app)", b"python\0-m\0app\0")
+        write_fake_process(tmp_path, 31, 200, "db", b"db\0")
+        write_fake_process(tmp_path, 40, 0, "kthread", b"")
+        (tmp_path / "meminfo").write_text(FAKE_MEMINFO)
+        scanner = ProcessScanner(str(tmp_path), top_n=2)
+        top = scanner.scan()
+        assert [(p.pid, p.name, p.cmdline) for p in top] == [
+            (20, "my (app)", "python -m app"), (31, "db", "db")]
+        assert top[0].rss == pytest.approx(300 * scanner.page_size / 1e6)
+        assert top[0].vms == pytest.approx(2 * top[0].rss)
+        # the command line is cached until the pid is reused by another process
+        write_fake_process(tmp_path, 20, 300, "my (app)", b"changed\0")
+        assert scanner.scan()[0].cmdline == "python -m app"
+        write_fake_process(tmp_path, 20, 300, "new", b"new\0", start=2)
+        assert scanner.scan()[0].cmdline == "new"
+
+    async def test_take_sample_in_background(self, monkeypatch):
+        """It tests a sample is taken without waiting for the alerts, the processes and
+        the writer, and a scan of the processes is not started while one is running"""
+        done = asyncio.Event()
+        calls = []
+
+        async def slow(name, *args):
+            calls.append(name)
+            await done.wait()
+
+        monkeypatch.setattr(mem_info, "evaluate_alerts",
+                            lambda samples: slow("alerts"))
+        monkeypatch.setattr(mem_info, "log_process_usage",
+                            lambda time: slow("processes"))
+        monkeypatch.setattr(mem_info.memory_writer, "flush_async",
+                            lambda: slow("flush"))
+        monkeypatch.setattr(mem_info.memory_writer, "append", lambda sample: True)
+        monkeypatch.setattr(process_settings, "enabled", True)
+        await asyncio.wait_for(mem_info.take_sample(), 1)
+        await asyncio.wait_for(mem_info.take_sample(), 1)
+        await asyncio.sleep(0)
+        assert sorted(calls) == ["alerts", "alerts", "flush", "flush", "processes"]
+        done.set()
+        await asyncio.wait_for(mem_info.wait_background_tasks(), 1)
+        assert not mem_info._background_tasks
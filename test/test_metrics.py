@@ -0,0 +1,49 @@
+import threading
+
+from app.metrics import CallbackMetric, Counter, Histogram, registry
+
+
+class TestMetrics:
+    def test_counter_threads(self):
+        """It tests the counts of all the threads are summed"""
+        counter = Counter("test_counter_total", "A test counter.", ("kind",))
+        registry.remove(counter)
+        threads = [threading.Thread(target=lambda: [counter.inc("a") for _ in range(1000)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc("b", amount=2)
+        assert counter.value("a") == 4000
+        assert counter.render().splitlines() == [
+            "# HELP test_counter_total A test counter.",
+            "# TYPE test_counter_total counter",
+            'test_counter_total{kind="a"} 4000',
+            'test_counter_total{kind="b"} 2',
+        ]
+
+    def test_histogram(self):
+        """It tests the buckets of a histogram are cumulative"""
+        histogram = Histogram("test_seconds", "A test histogram.", buckets=(0.1, 1.0))
+        registry.remove(histogram)
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        assert histogram.count() == 4
+        lines = histogram.render().splitlines()[2:]
+        assert lines == [
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1.0"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            "test_seconds_sum 2.65",
+            "test_seconds_count 4",
+        ]
+
+    def test_callback(self):
+        """It tests a callback metric is read when it's rendered"""
+        values = {("x",): 1}
+        metric = CallbackMetric("test_size", "A test gauge.", "gauge",
+                                lambda: values, ("name",))
+        registry.remove(metric)
+        values[("x",)] = 5
+        assert metric.render().splitlines()[-1] == 'test_size{name="x"} 5'
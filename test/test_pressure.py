@@ -0,0 +1,121 @@
+import datetime
+import os
+import socket
+
+import pytest
+
+from app import mem_info
+from app.config import pressure_settings, settings
+from app.metrics import sampler_missed_ticks
+from app.pressure import PressureTrigger, PsiReader, open_pressure_trigger
+
+
+class FakeTrigger:
+    """A PSI trigger which fires at the given times of a fake clock"""
+    def __init__(self, times):
+        self.now = 100.0
+        self.times = list(times)
+
+    def __call__(self) -> float:
+        return self.now
+
+    def start(self):
+        pass
+
+    async def wait(self, timeout: float) -> bool:
+        timeout = max(0.0, timeout)
+        if self.times and self.times[0] <= self.now + timeout:
+            self.now = max(self.now, self.times.pop(0))
+            return True
+        self.now += timeout
+        return False
+
+
+class Stop(Exception):
+    pass
+
+
+class TestPressure:
+    def test_psi_reader(self, tmp_path):
+        """It tests reading the averages of the `some` line"""
+        path = tmp_path / "memory"
+        path.write_text("some avg10=1.50 avg60=0.25 avg300=0.00 total=1234\n"
+                        "full avg10=0.50 avg60=0.10 avg300=0.00 total=567\n")
+        reader = PsiReader(str(path))
+        assert reader.read() == (1.5, 0.25)
+        path.write_text("full avg10=0.50 avg60=0.10 avg300=0.00 total=567\n")
+        assert reader.read() is None
+        reader.close()
+
+    def test_no_psi(self, tmp_path):
+        """It tests a trigger is not made without PSI"""
+        assert open_pressure_trigger(str(tmp_path / "missing"), 0.2, 2) is None
+
+    async def test_trigger(self):
+        """It tests waiting for the notifications of a file by POLLPRI (the urgent data
+        of a socket stands for a notification of PSI)"""
+        a, b = socket.socketpair()
+        try:
+            trigger = PressureTrigger(os.dup(a.fileno()))
+            trigger.start()
+            assert not await trigger.wait(0.01)
+            b.send(b"!", socket.MSG_OOB)
+            assert await trigger.wait(1)
+            a.recv(1, socket.MSG_OOB)
+            trigger.close()
+        finally:
+            a.close()
+            b.close()
+
+    def test_collect_sample(self):
+        """It tests a sample is marked by its trigger"""
+        sample = mem_info.collect_sample(pressure_triggered=True)
+        assert sample.pressure_triggered is True
+        if os.path.exists(pressure_settings.psi_path):
+            assert sample.psi_avg10 is not None and sample.psi_avg60 is not None
+
+    async def test_adaptive_rate(self, monkeypatch):
+        """It tests a trigger takes a sample at once and raises the rate until it's calm"""
+        monkeypatch.setattr(settings, "delta_time_check_memory",
+                            datetime.timedelta(seconds=60))
+        monkeypatch.setattr(pressure_settings, "pressure_interval",
+                            datetime.timedelta(seconds=1))
+        monkeypatch.setattr(pressure_settings, "calm_after",
+                            datetime.timedelta(seconds=5))
+        trigger = FakeTrigger([110.5, 112.2])
+        samples = []
+
+        async def take_sample(pressure_triggered=False):
+            samples.append((trigger.now, pressure_triggered))
+            if len(samples) == 11:
+                raise Stop()
+
+        monkeypatch.setattr(mem_info, "take_sample", take_sample)
+        with pytest.raises(Stop):
+            await mem_info.log_memory_usage_on_pressure(trigger, clock=trigger)
+        assert samples == [(100.0, False), (110.5, True), (111.5, False),
+                           (112.2, True), (113.2, False), (114.2, False),
+                           (115.2, False), (116.2, False), (117.2, False),
+                           (177.2, False), (237.2, False)]
+
+    async def test_stall(self, monkeypatch):
+        """It tests the deadlines which are passed by a slow sample are skipped and
+        counted as missed, and the ticks keep their phase"""
+        monkeypatch.setattr(settings, "delta_time_check_memory",
+                            datetime.timedelta(seconds=60))
+        trigger = FakeTrigger([])
+        samples = []
+
+        async def take_sample(pressure_triggered=False):
+            samples.append(trigger.now)
+            if len(samples) == 2:
+                trigger.now += 300
+            if len(samples) == 4:
+                raise Stop()
+
+        monkeypatch.setattr(mem_info, "take_sample", take_sample)
+        missed = sampler_missed_ticks.value()
+        with pytest.raises(Stop):
+            await mem_info.log_memory_usage_on_pressure(trigger, clock=trigger)
+        assert samples == [100.0, 160.0, 460.0, 520.0]
+        assert sampler_missed_ticks.value() == missed + 4
@@ -0,0 +1,84 @@
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app import profiling
+from app.config import profiling_settings
+from app.dependencies import create_access_token
+from app.metrics import phase, request_phases
+from app.sql import run_db
+
+
+def _make_client() -> TestClient:
+    app = FastAPI()
+
+    @app.get("/work")
+    async def work():
+        with phase("sleep"):
+            time.sleep(0.01)
+        await run_db(time.sleep, 0.01)
+        return {}
+
+    app.add_middleware(profiling.ProfilingMiddleware)
+    return TestClient(app)
+
+
+@pytest.fixture()
+def store(monkeypatch):
+    store = profiling.ProfileStore(keep=3)
+    monkeypatch.setattr(profiling, "profile_store", store)
+    monkeypatch.setattr(profiling_settings, "admins", ["admin"])
+    return store
+
+
+class TestProfiling:
+    def test_phase_without_profile(self):
+        """It tests a phase does nothing out of a profiled request"""
+        assert request_phases.get() is None
+        with phase("nothing"):
+            pass
+        assert request_phases.get() is None
+
+    def test_phase(self):
+        """It tests the time of a phase is summed"""
+        timings = {}
+        token = request_phases.set(timings)
+        try:
+            for _ in range(2):
+                with phase("sleep"):
+                    time.sleep(0.01)
+        finally:
+            request_phases.reset(token)
+        assert timings["sleep"] >= 20
+
+    def test_admin_header(self, store):
+        """It tests only the requests of admins with the header are profiled"""
+        client = _make_client()
+        header = profiling_settings.profile_header
+        admin = create_access_token({"username": "admin"})
+        user = create_access_token({"username": "user"})
+        client.get("/work")
+        client.get("/work", headers={header: "1", "Authorization": f"Bearer {user}"})
+        client.get("/work", headers={header: "1", "Authorization": "Bearer bad"})
+        assert len(store.profiles) == 0
+        client.get("/work", headers={header: "1", "Authorization": f"Bearer {admin}"})
+        profile, = store.list().profiles
+        assert (profile.path, profile.status, profile.reason) == ("/work", 200, "header")
+        assert profile.phases["sleep"] >= 10
+        # the database threads add to the phases of the request
+        assert profile.phases["db"] >= 10
+        assert profile.total_ms >= profile.phases["sleep"] + profile.phases["db"]
+        assert "cumulative" in profile.stack
+        assert store.get(profile.id) == profile
+
+    def test_sampling(self, store, monkeypatch):
+        """It tests one of each N requests is profiled and the last ones are kept"""
+        monkeypatch.setattr(profiling_settings, "sample_every", 2)
+        client = _make_client()
+        for _ in range(10):
+            client.get("/work")
+        profiles = store.list().profiles
+        assert [profile.reason for profile in profiles] == ["sampled"] * 3
+        assert [profile.id for profile in profiles] == [5, 4, 3]
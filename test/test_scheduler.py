@@ -0,0 +1,68 @@
+import time
+
+import pytest
+
+from app.scheduler import FixedRateScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        self.now += seconds
+
+
+class TestScheduler:
+    async def run(self, scheduler, clock, costs):
+        """Runs a tick for each cost and returns the ticks"""
+        ticks = []
+        generator = scheduler.ticks()
+        for cost in costs:
+            ticks.append(await generator.__anext__())
+            clock.now += cost
+        await generator.aclose()
+        return ticks
+
+    async def test_no_drift(self):
+        """It tests the time spent in the ticks does not shift the deadlines"""
+        clock = FakeClock()
+        scheduler = FixedRateScheduler(0.5, clock, clock.sleep)
+        ticks = await self.run(scheduler, clock, [0.3, 0.1, 0.49, 0.2])
+        assert [tick.deadline for tick in ticks] == [100.0, 100.5, 101.0, 101.5]
+        assert all(tick.lateness == 0 and tick.missed == 0 for tick in ticks)
+
+    async def test_missed_ticks(self):
+        """It tests a long tick skips the passed deadlines and keeps the phase"""
+        clock = FakeClock()
+        scheduler = FixedRateScheduler(1.0, clock, clock.sleep)
+        ticks = await self.run(scheduler, clock, [2.5, 0.1, 0.1])
+        assert [(t.deadline, t.missed) for t in ticks] == [(100.0, 0), (102.0, 1),
+                                                           (103.0, 0)]
+        assert ticks[1].lateness == pytest.approx(0.5)
+
+    def test_bad_interval(self):
+        """It tests the interval should be positive"""
+        with pytest.raises(ValueError):
+            FixedRateScheduler(0)
+
+    async def test_high_rate(self):
+        """It tests ticks of 10 ms on the real clock"""
+        scheduler = FixedRateScheduler(0.01)
+        start = time.monotonic()
+        ticks = []
+        async for tick in scheduler.ticks():
+            ticks.append(tick)
+            if len(ticks) == 20:
+                break
+        elapsed = time.monotonic() - start
+        # the deadlines are on the grid of the interval (a busy loop could miss some)
+        steps = 0
+        for tick in ticks:
+            steps += tick.missed
+            assert tick.deadline - ticks[0].deadline == pytest.approx(steps * 0.01)
+            steps += 1
+        assert elapsed >= (steps - 1) * 0.01
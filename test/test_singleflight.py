@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from app.singleflight import SingleFlight
+
+
+class TestSingleFlight:
+    async def test_coalesce(self):
+        """It tests the concurrent calls of a key share one call"""
+        flight = SingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        results = await asyncio.gather(*(flight.do("key", fetch) for _ in range(10)))
+        assert results == [1] * 10
+        assert (flight.executed, flight.coalesced, len(flight)) == (1, 9, 0)
+        # a call after the running one is done runs again
+        assert await flight.do("key", fetch) == 2
+        assert flight.stats().executed == 2
+
+    async def test_keys(self):
+        """It tests the calls of different keys do not wait for each other"""
+        flight = SingleFlight()
+
+        async def fetch(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        results = await asyncio.gather(flight.do(1, lambda: fetch(1)),
+                                       flight.do(2, lambda: fetch(2)))
+        assert results == [1, 2]
+        assert (flight.executed, flight.coalesced) == (2, 0)
+
+    async def test_exception(self):
+        """It tests an exception of the call is raised for all the callers"""
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("failed")
+
+        results = await asyncio.gather(flight.do("key", fail), flight.do("key", fail),
+                                       return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert len(flight) == 0
+
+    async def test_cancel_caller(self):
+        """It tests cancelling the caller which started the call does not cancel it for
+        the others"""
+        flight = SingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.05)
+            return "done"
+
+        first = asyncio.create_task(flight.do("key", fetch))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(flight.do("key", fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == "done"
+        with pytest.raises(asyncio.CancelledError):
+            await first
@@ -0,0 +1,502 @@
+import asyncio
+import datetime
+import random
+import time
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import OperationalError
+
+from app import retention
+from app.sql import crud, schemas, models, get_db, run_db
+from app.sql import ReadSessionLocal, SessionLocal, in_write_session, run_write
+from app.sql import migrations, segments
+from app.sql.ring import MemoryRing, memory_ring
+from app.sql.segments import SegmentStore, decode_block, encode_block
+from app.sql.writer import MemoryWriter, ProcessWriter
+
+
+def _fake_memories(n: int):
+    """Creates n fake memory samples with unique times"""
+    now = datetime.datetime.now()
+    return [schemas.MemCreate(time=now + datetime.timedelta(microseconds=i),
+                              free=1.0, used=2.0, total=3.0)
+            for i in range(n)]
+
+
+def _count(memories) -> int:
+    """Counts how many of the memories are stored in the database"""
+    times = [memory.time for memory in memories]
+    with get_db() as db:
+        return db.query(models.Memory).filter(models.Memory.time.in_(times)).count()
+
+
+class TestOffload:
+    async def test_run_db_overlaps(self):
+        """It tests the blocking database calls do not block each other"""
+        start = time.monotonic()
+        await asyncio.gather(run_db(time.sleep, 0.2), run_db(time.sleep, 0.2))
+        assert time.monotonic() - start < 0.35
+
+    async def test_run_db(self, db):
+        """It tests running a crud function in the database threads"""
+        memories = _fake_memories(2)
+        assert await run_db(crud.create_memories, db, memories) == 2
+        assert _count(memories) == 2
+
+    async def test_run_write(self):
+        """It tests running a crud function in the writer thread"""
+        memories = _fake_memories(2)
+        assert await run_write(in_write_session, crud.create_memories, memories) == 2
+        assert _count(memories) == 2
+
+    def test_read_session_is_read_only(self):
+        """It tests the sessions of the requests could not write"""
+        with ReadSessionLocal() as db:
+            with pytest.raises(OperationalError):
+                crud.create_memories(db, _fake_memories(1))
+
+    def test_read_while_writing(self):
+        """It tests a reader is not blocked by an open write transaction (WAL)"""
+        memories = _fake_memories(1)
+        with SessionLocal() as writer, ReadSessionLocal() as reader:
+            assert writer.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+            writer.add(models.Memory(**memories[0].model_dump()))
+            writer.flush()
+            # the write transaction is open and not committed yet
+            query = reader.query(models.Memory).filter(
+                models.Memory.time == memories[0].time)
+            assert query.count() == 0
+            writer.commit()
+            reader.commit()
+            assert query.count() == 1
+
+
+class TestWriter:
+    def test_create_memories(self, db):
+        """It tests inserting a batch of memories"""
+        memories = _fake_memories(10)
+        assert crud.create_memories(db, memories) == 10
+        assert _count(memories) == 10
+
+    def test_flush_by_size(self):
+        """It tests the writer flushes when its buffer is full"""
+        writer = MemoryWriter(flush_size=3, flush_interval=3600)
+        memories = _fake_memories(3)
+        assert writer.add(memories[0]) == 0
+        assert writer.add(memories[1]) == 0
+        assert _count(memories) == 0
+        assert writer.add(memories[2]) == 3
+        assert len(writer) == 0
+        assert _count(memories) == 3
+
+    def test_flush_by_interval(self):
+        """It tests the writer flushes when the interval is passed"""
+        writer = MemoryWriter(flush_size=100, flush_interval=0)
+        memories = _fake_memories(1)
+        assert writer.add(memories[0]) == 1
+        assert _count(memories) == 1
+
+    async def test_flush_async(self):
+        """It tests flushing the buffer in the database threads"""
+        writer = MemoryWriter(flush_size=2, flush_interval=3600)
+        memories = _fake_memories(2)
+        assert not writer.append(memories[0])
+        assert writer.append(memories[1])
+        assert await writer.flush_async() == 2
+        assert len(writer) == 0
+        assert _count(memories) == 2
+
+    def test_flush_on_demand(self):
+        """It tests flushing the buffer manually e.g. in shutdown"""
+        writer = MemoryWriter(flush_size=100, flush_interval=3600)
+        memories = _fake_memories(5)
+        for memory in memories:
+            writer.add(memory)
+        assert writer.flush() == 5
+        assert writer.flush() == 0
+        assert _count(memories) == 5
+
+    def test_failed_flush(self, monkeypatch):
+        """It tests the samples of a failed flush are kept for the next one and only the
+        ones over the max buffer are dropped"""
+        writer = MemoryWriter(flush_size=100, flush_interval=3600, max_buffer=4)
+        memories = _fake_memories(5)
+
+        def fail(samples):
+            raise OperationalError("INSERT", {}, Exception("table Memory has no column"))
+
+        monkeypatch.setattr(writer, "write", fail)
+        for memory in memories[:3]:
+            writer.add(memory)
+        with pytest.raises(OperationalError):
+            writer.flush()
+        assert writer.buffer == memories[:3]
+        writer.buffer += memories[3:]
+        with pytest.raises(OperationalError):
+            writer.flush()
+        assert writer.buffer == memories[1:]
+        monkeypatch.undo()
+        assert writer.flush() == 4
+        assert _count(memories) == 4
+
+    async def test_process_writer(self, db):
+        """It tests the processes of the ticks are buffered and written together"""
+        writer = ProcessWriter(flush_size=4, flush_interval=3600)
+        host = f"processes-{random.randint(0, 10 ** 9)}"
+        now = datetime.datetime.now()
+        ticks = [[schemas.ProcessMemory(host=host, time=now + datetime.timedelta(i),
+                                        pid=pid, name="p", cmdline="p", rss=1.0, vms=2.0)
+                  for pid in (1, 2)]
+                 for i in range(2)]
+        assert not writer.extend(ticks[0])
+        assert crud.get_process_snapshot(db, host).time is None
+        assert writer.extend(ticks[1])
+        assert await writer.flush_async() == 4
+        assert crud.get_process_snapshot(db, host).time == ticks[1][0].time
+
+
+class TestMigrations:
+    def test_upgrade_old_database(self, tmp_path):
+        """It tests a database of the first version is upgraded: the Memory table gets
+        its host in the primary key and the new columns, and the old samples are kept"""
+        engine = create_engine(f"sqlite:///{tmp_path}/old.sqlite")
+        with engine.begin() as connection:
+            connection.execute(text(
+                'CREATE TABLE "Memory" (time TIMESTAMP NOT NULL, free FLOAT, '
+                'used FLOAT, total FLOAT, PRIMARY KEY (time))'))
+            connection.execute(text(
+                'CREATE TABLE "User" (username VARCHAR NOT NULL, email VARCHAR, '
+                'password VARCHAR(64), activated BOOLEAN, PRIMARY KEY (username))'))
+            connection.execute(text(
+                "INSERT INTO \"Memory\" VALUES ('2023-01-01 00:00:00.000000', 1, 2, 3)"))
+        with engine.begin() as connection:
+            migrations.upgrade(connection)
+        inspector = inspect(engine)
+        assert inspector.get_pk_constraint("Memory")["constrained_columns"] == \
+            ["host", "time"]
+        assert {"available", "psi_avg10", "pressure_triggered"} <= \
+            {column["name"] for column in inspector.get_columns("Memory")}
+        assert "Memory_old" not in inspector.get_table_names()
+        with engine.connect() as connection:
+            row = connection.execute(text(
+                'SELECT host, free, available FROM "Memory"')).one()
+        assert tuple(row) == (migrations.FILL_VALUES["host"], 1.0, None)
+        # the upgraded database is not changed again
+        with engine.begin() as connection:
+            migrations.upgrade(connection)
+        engine.dispose()
+
+    def test_refuse_unknown_column(self, tmp_path, monkeypatch):
+        """It tests the app does not start on a table which misses a required column"""
+        engine = create_engine(f"sqlite:///{tmp_path}/old.sqlite")
+        with engine.begin() as connection:
+            connection.execute(text(
+                'CREATE TABLE "Memory" (time TIMESTAMP NOT NULL, PRIMARY KEY (time))'))
+        monkeypatch.setattr(migrations, "FILL_VALUES", {})
+        with pytest.raises(migrations.SchemaError):
+            with engine.begin() as connection:
+                migrations.upgrade(connection)
+        engine.dispose()
+
+
+class TestRing:
+    def test_latest(self):
+        """It tests the ring returns the last samples from the newest one"""
+        ring = MemoryRing(capacity=3)
+        memories = _fake_memories(5)
+        memories[4].available = 4.0
+        for memory in memories:
+            ring.append(memory)
+        assert len(ring) == 3
+        latest = ring.latest(10)
+        assert [memory.time for memory in latest] == [m.time for m in memories[:1:-1]]
+        assert latest[0].available == 4.0
+        assert latest[1].available is None
+        assert ring.oldest_time() == memories[2].time
+
+    def test_get_mem_from_ring(self, db):
+        """It tests get_mem answers from the ring when the limit fits in it"""
+        memories = _fake_memories(3)
+        memory_ring.clear()
+        for memory in memories:
+            memory_ring.append(memory)
+        hits, misses = memory_ring.hits, memory_ring.misses
+        try:
+            mem = crud.get_mem(db, 2)
+            assert memory_ring.hits == hits + 1
+            assert [m.time for m in mem.mem_data] == [memories[2].time, memories[1].time]
+            # the older ones come from database
+            older = _fake_memories(1)
+            older[0].time -= datetime.timedelta(days=1)
+            crud.create_memories(db, older)
+            mem = crud.get_mem(db, 4)
+            assert memory_ring.misses == misses + 1
+            assert [m.time for m in mem.mem_data][:3] == [m.time for m in memories[::-1]]
+            assert len(mem.mem_data) == 4
+        finally:
+            memory_ring.clear()
+
+
+def _fake_day():
+    """Returns start of a random day in the past to not collide with other tests"""
+    return datetime.datetime(1900, 1, 1) + datetime.timedelta(days=random.randrange(40000))
+
+
+class TestRollup:
+    def test_incremental_rollup(self, db):
+        """It tests rollups are merged by the batches of samples"""
+        day = _fake_day()
+        memories = [schemas.MemCreate(time=day + datetime.timedelta(seconds=10 * i),
+                                      free=float(i), used=2.0 * i, total=100.0)
+                    for i in range(12)]
+        # in two batches to merge the second one into the existing rollups
+        crud.create_memories(db, memories[:5])
+        crud.create_memories(db, memories[5:])
+        rows = db.query(models.MemoryRollup1m).filter(
+            models.MemoryRollup1m.time >= day,
+            models.MemoryRollup1m.time < day + datetime.timedelta(days=1)).all()
+        assert [row.count for row in rows] == [6, 6]
+        assert rows[0].free_min == 0 and rows[0].free_max == 5
+        assert rows[0].free_avg == 2.5 and rows[0].free_last == 5
+        assert rows[1].used_avg == 17.0 and rows[1].used_last == 22
+        day_row = db.query(models.MemoryRollup1d).filter(
+            models.MemoryRollup1d.time == day).one()
+        assert day_row.count == 12 and day_row.free_avg == 5.5 and day_row.total_max == 100
+
+    def test_tier_selection(self, db):
+        """It tests the range query picks the coarsest tier that meets the points"""
+        day = _fake_day()
+        memories = [schemas.MemCreate(time=day + datetime.timedelta(minutes=30 * i),
+                                      free=1.0, used=2.0, total=3.0)
+                    for i in range(48)]
+        crud.create_memories(db, memories)
+        end = day + datetime.timedelta(days=1)
+        mem = crud.get_mem_range(db, day, end, points=24)
+        assert mem.resolution == 3600
+        assert len(mem.mem_data) == 24
+        mem = crud.get_mem_range(db, day, end, resolution=86400)
+        assert mem.resolution == 86400
+        assert [point.count for point in mem.mem_data] == [48]
+        mem = crud.get_mem_range(db, day, end, resolution=30)
+        assert mem.resolution == 0
+        assert len(mem.mem_data) == 48
+
+
+class TestPagination:
+    def test_walk_pages(self, db):
+        """It tests walking a window page by page in both orders"""
+        day = _fake_day()
+        memories = [schemas.MemCreate(time=day + datetime.timedelta(minutes=i),
+                                      free=1.0, used=2.0, total=3.0)
+                    for i in range(10)]
+        crud.create_memories(db, memories[:8])
+        memory_ring.clear()
+        # the last ones are only in the ring (not written yet)
+        for memory in memories[7:]:
+            memory_ring.append(memory)
+        end = day + datetime.timedelta(days=1)
+        try:
+            for descending in (True, False):
+                times, cursor = [], None
+                while True:
+                    page = crud.get_mem_page(db, limit=3, start=day, end=end,
+                                             cursor=cursor, descending=descending)
+                    times += [memory.time for memory in page.mem_data]
+                    cursor = page.next_cursor
+                    if cursor is None:
+                        break
+                expected = [memory.time for memory in memories]
+                assert times == (expected[::-1] if descending else expected)
+        finally:
+            memory_ring.clear()
+
+    def test_invalid_cursor(self, db):
+        """It tests a broken cursor is rejected"""
+        with pytest.raises(ValueError):
+            crud.get_mem_page(db, cursor="not a cursor")
+
+
+class TestSegments:
+    @classmethod
+    def _memories(cls, n: int, start: datetime.datetime):
+        """Creates n samples one second apart with changing values"""
+        return [schemas.MemCreate(time=start + datetime.timedelta(seconds=i),
+                                  free=1000.0 + i % 7, used=2000.5 - (i % 3),
+                                  total=3000.0, available=(None if i % 5 else 1.5))
+                for i in range(n)]
+
+    def test_block_roundtrip(self):
+        """It tests encoding and decoding a block"""
+        times = [0, 1000, 2000, 3005, 3005, 10 ** 15]
+        columns = [[1.0, 1.0, 2.5, -3.0, 0.0, 1e300], [0.1, 0.2, 0.3, 0.4, 0.5, 0.6]]
+        decoded_times, decoded_columns = decode_block(encode_block(times, columns))
+        assert decoded_times == times
+        assert decoded_columns == columns
+
+    def test_scan_and_latest(self, tmp_path):
+        """It tests reading samples back by time ranges and from the newest one"""
+        store = SegmentStore(str(tmp_path), segment_size=10, block_size=4)
+        start = datetime.datetime(2023, 1, 1)
+        memories = self._memories(25, start)
+        assert store.append(memories[:13]) == 13
+        assert store.append(memories[13:]) == 12
+        # the old samples are not appended again
+        assert store.append(memories[:2]) == 0
+        assert len(store.segments) == 2
+        rows = list(store.scan(memories[3].time, memories[20].time))
+        assert [row[0] for row in rows] == [m.time for m in memories[3:20]]
+        assert rows[0][1:5] == (memories[3].free, memories[3].used, memories[3].total, None)
+        assert rows[2][4] == 1.5
+        latest = store.latest(3, before=memories[10].time)
+        assert [m.time for m in latest] == [m.time for m in memories[9:6:-1]]
+        store.close()
+        # it's loaded again from the files
+        store = SegmentStore(str(tmp_path), segment_size=10, block_size=4)
+        assert len(store) == 25
+        assert [row[0] for row in store.scan()] == [m.time for m in memories]
+        store.close()
+
+    def test_small_appends(self, tmp_path):
+        """It tests the samples which are appended one by one are written in full
+        blocks, and the ones of the tail are read and loaded again"""
+        store = SegmentStore(str(tmp_path), segment_size=10, block_size=4)
+        memories = self._memories(10, datetime.datetime(2023, 1, 1))
+        for memory in memories:
+            assert store.append([memory]) == 1
+        assert [entry.count for entry in store.segments[0].index] == [4, 4]
+        assert store.segments[0].count == 8
+        assert len(store) == 10
+        assert [row[0] for row in store.scan(memories[6].time)] == \
+            [m.time for m in memories[6:]]
+        assert [m.time for m in store.latest(3)] == [m.time for m in memories[9:6:-1]]
+        store.close()
+        store = SegmentStore(str(tmp_path), segment_size=10, block_size=4)
+        assert len(store.tail) == 2
+        newer = self._memories(3, memories[-1].time)[1:]
+        assert store.append(memories[8:] + newer) == 2
+        assert [entry.count for entry in store.segments[0].index] == [4, 4, 4]
+        assert [row[0] for row in store.scan()] == [m.time for m in memories + newer]
+        store.close()
+
+    def test_recover_index(self, tmp_path):
+        """It tests the index entry of a synced block is rebuilt and a partly written
+        block is cut"""
+        store = SegmentStore(str(tmp_path), segment_size=10, block_size=4)
+        memories = self._memories(8, datetime.datetime(2023, 1, 1))
+        store.append(memories)
+        path = store.segments[0].path
+        store.close()
+        with open(path + ".idx", "rb+") as f:
+            f.truncate(f.seek(0, 2) // 2)
+        with open(path + ".seg", "ab") as f:
+            f.write(b"\x04\x00\x00\x00\xff")
+        store = SegmentStore(str(tmp_path), segment_size=10, block_size=4)
+        assert len(store) == 8
+        assert [row[0] for row in store.scan()] == [m.time for m in memories]
+        store.close()
+
+    def test_stores_of_processes(self, tmp_path):
+        """It tests two stores of a directory (like the stores of two workers) which
+        append samples in turn do not lose the samples of each other"""
+        stores = [SegmentStore(str(tmp_path), segment_size=8, block_size=4)
+                  for _ in range(2)]
+        memories = self._memories(19, datetime.datetime(2023, 1, 1))
+        for i, memory in enumerate(memories):
+            assert stores[i % 2].append([memory]) == 1
+        for store in stores:
+            assert [row[0] for row in store.scan()] == [m.time for m in memories]
+            assert len(store) == 19
+        assert stores[0].drop_before(memories[10].time) == 8
+        assert [row[0] for row in stores[1].scan()] == [m.time for m in memories[8:]]
+        for store in stores:
+            store.close()
+        store = SegmentStore(str(tmp_path), segment_size=8, block_size=4)
+        assert [row[0] for row in store.scan()] == [m.time for m in memories[8:]]
+        assert len(store.tail) == 3
+        store.close()
+
+    def test_backend(self, tmp_path, monkeypatch, db):
+        """It tests crud reads and writes samples by the segment backend"""
+        monkeypatch.setattr(segments.storage_settings, "backend", "segments")
+        monkeypatch.setattr(segments.storage_settings, "directory", str(tmp_path))
+        monkeypatch.setattr(segments, "_segment_stores", {})
+        memories = self._memories(5, _fake_day())
+        assert crud.create_memories(db, memories) == 5
+        assert _count(memories) == 0
+        memory_ring.clear()
+        mem = crud.get_mem(db, 2)
+        assert [m.time for m in mem.mem_data] == [memories[4].time, memories[3].time]
+        page = crud.get_mem_page(db, limit=3, descending=False,
+                                 start=memories[0].time)
+        assert [m.time for m in page.mem_data] == [m.time for m in memories[:3]]
+
+
+class TestRetention:
+    async def test_prune_in_chunks(self, monkeypatch, db):
+        """It tests old rows are deleted chunk by chunk and the new ones are kept"""
+        monkeypatch.setattr(retention.retention_settings, "chunk_size", 4)
+        monkeypatch.setattr(retention.retention_settings, "pause",
+                            datetime.timedelta(0))
+        day = datetime.datetime(1800, 1, 1)
+        memories = [schemas.MemCreate(time=day + datetime.timedelta(minutes=i),
+                                      free=1.0, used=2.0, total=3.0)
+                    for i in range(10)]
+        crud.create_memories(db, memories)
+        cutoff = memories[7].time
+        assert await retention.prune_table(models.Memory, cutoff) == 7
+        assert _count(memories) == 3
+        assert await retention.prune_table(models.Memory, cutoff) == 0
+        # the rollups are kept
+        assert db.query(models.MemoryRollup1m).filter(
+            models.MemoryRollup1m.time == day).count() == 1
+        assert await retention.prune_table(models.Memory, day + datetime.timedelta(days=1)) == 3
+
+    async def test_enforce_retention(self, monkeypatch, db):
+        """It tests a run of the retention reports the pruned rows"""
+        monkeypatch.setattr(retention.retention_settings, "raw",
+                            datetime.timedelta(days=1))
+        for name in ("rollup_1m", "rollup_1h", "rollup_1d"):
+            monkeypatch.setattr(retention.retention_settings, name, None)
+        day = datetime.datetime(1800, 1, 1)
+        memories = [schemas.MemCreate(time=day + datetime.timedelta(hours=i),
+                                      free=1.0, used=2.0, total=3.0)
+                    for i in range(48)]
+        crud.create_memories(db, memories)
+        runs = retention.retention_stats.runs
+        run = await retention.enforce_retention(now=day + datetime.timedelta(days=2))
+        assert run.rows_pruned == 24 and run.seconds > 0
+        assert _count(memories) == 24
+        assert retention.retention_stats.runs == runs + 1
+        # the rest is deleted, so the test could run again on the same database
+        await retention.prune_table(models.Memory, day + datetime.timedelta(days=3))
+
+    def test_drop_segments(self, tmp_path):
+        """It tests whole segments before the time are deleted"""
+        store = SegmentStore(str(tmp_path), segment_size=10, block_size=5)
+        day = _fake_day()
+        memories = [schemas.MemCreate(time=day + datetime.timedelta(seconds=i),
+                                      free=1.0, used=2.0, total=3.0)
+                    for i in range(25)]
+        store.append(memories)
+        assert len(store.segments) == 3
+        # the second segment has the time, so only the first one is deleted
+        assert store.drop_before(memories[15].time) == 10
+        assert [row[0] for row in store.scan()] == [m.time for m in memories[10:]]
+        store.close()
+
+    def test_incremental_vacuum(self, tmp_path, monkeypatch):
+        """It tests the free pages of a SQLite file are given back"""
+        engine = create_engine(f"sqlite:///{tmp_path / 'vacuum.sqlite'}")
+        with engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.exec_driver_sql("CREATE TABLE t (x)")
+            connection.exec_driver_sql("INSERT INTO t VALUES (?)",
+                                       [("x" * 1000,)] * 500)
+            connection.exec_driver_sql("DELETE FROM t")
+            connection.commit()
+        monkeypatch.setattr(retention, "engine", engine)
+        assert retention.incremental_vacuum(10) == 10
+        assert retention.incremental_vacuum(10 ** 6) > 0
+        assert retention.incremental_vacuum(10) == 0
+        engine.dispose()
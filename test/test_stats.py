@@ -0,0 +1,149 @@
+import datetime
+import math
+import random
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from app import stats
+from app.sql import Base, crud, get_db, migrations, schemas
+from app.sql.sketch import RELATIVE_ACCURACY, LogHistogram
+
+
+def _fake_host_samples(day: datetime.datetime, n: int):
+    """Creates n samples of a new host (a second apart) whose used is 0 to n-1"""
+    host = f"stats-{random.randint(0, 10 ** 9)}"
+    memories = [schemas.MemCreate(host=host, time=day + datetime.timedelta(seconds=i),
+                                  free=float(n - i), used=float(i), total=float(n))
+                for i in range(n)]
+    with get_db() as db:
+        crud.create_memories(db, memories)
+    return host, memories
+
+
+def _percentile(values, q: float) -> float:
+    """the exact percentile by linear interpolation between the closest ranks"""
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    low = math.floor(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+class TestStats:
+    def test_histogram(self):
+        """It tests the percentiles of a histogram are in its relative error, also after
+        merging and encoding it"""
+        values = [random.uniform(0, 16000) for _ in range(1000)] + [0.0] * 10
+        first, second = LogHistogram(), LogHistogram()
+        first.extend(values[:500])
+        second.extend(values[500:])
+        first.merge(LogHistogram.decode(second.encode()))
+        assert first.count == len(values)
+        for q in (0, 1, 50, 95, 99.9, 100):
+            assert first.quantile(q) == pytest.approx(_percentile(values, q),
+                                                      rel=RELATIVE_ACCURACY, abs=1e-9)
+        assert LogHistogram().quantile(50) is None
+        assert stats.percentile_name(99.9) == "p99.9"
+
+    @pytest.mark.parametrize("day", [datetime.datetime(1950, 1, 1),
+                                     datetime.datetime(2020, 1, 1)])
+    @pytest.mark.parametrize("bucket", [60, 120, 3600])
+    def test_aggregates(self, day, bucket, db):
+        """It tests the aggregates of the rollups (and the raw edges of the window) are
+        the ones of the samples, with and without percentiles"""
+        host, memories = _fake_host_samples(day, 150)
+        start = day + datetime.timedelta(seconds=15)
+        end = day + datetime.timedelta(hours=1, seconds=15)
+        samples = [m for m in memories if start <= m.time < end]
+        expected = {}
+        for memory in samples:
+            key = memory.time - datetime.timedelta(
+                seconds=(memory.time - datetime.datetime(1970, 1, 1)).total_seconds()
+                % bucket)
+            expected.setdefault(key, []).append(memory)
+        for percentiles in ([], [50, 95]):
+            result = stats.get_mem_stats(db, start, end, percentiles=percentiles,
+                                         bucket=bucket, host=host)
+            assert [b.time for b in result.mem_data] == sorted(expected)
+            for item in result.mem_data:
+                bucket_samples = expected[item.time]
+                assert item.count == len(bucket_samples)
+                for name in stats.STAT_FIELDS:
+                    values = [getattr(m, name) for m in bucket_samples]
+                    field = getattr(item, name)
+                    assert (field.min, field.max) == (min(values), max(values))
+                    assert field.mean == pytest.approx(sum(values) / len(values))
+                    for q in percentiles:
+                        assert field.percentiles[f"p{q}"] == pytest.approx(
+                            _percentile(values, q), rel=RELATIVE_ACCURACY)
+
+    def test_percentiles(self, db):
+        """It tests the percentiles of each bucket"""
+        day = datetime.datetime(2020, 1, 1)
+        host, memories = _fake_host_samples(day, 120)
+        result = stats.get_mem_stats(db, day, day + datetime.timedelta(hours=1),
+                                     percentiles=[50, 95], bucket=60, host=host)
+        used = result.mem_data[1].used
+        assert (used.min, used.max, used.mean) == (60.0, 119.0, 89.5)
+        assert used.percentiles == {"p50": pytest.approx(89.5, rel=RELATIVE_ACCURACY),
+                                    "p95": pytest.approx(116.05, rel=RELATIVE_ACCURACY)}
+
+    def test_bucket_step(self, db):
+        """It tests the buckets which do not have whole minutes are rejected"""
+        day = datetime.datetime(2020, 1, 1)
+        with pytest.raises(ValueError):
+            stats.get_mem_stats(db, day, day + datetime.timedelta(hours=1),
+                                bucket=90)
+
+    def test_whole_window(self, db):
+        """It tests the whole window is one bucket which starts at the window"""
+        day = datetime.datetime(2021, 1, 1)
+        host, memories = _fake_host_samples(day, 10)
+        start = day - datetime.timedelta(days=1)
+        for percentiles in ([], [50]):
+            result = stats.get_mem_stats(db, start, day + datetime.timedelta(days=1),
+                                         percentiles=percentiles, host=host)
+            assert len(result.mem_data) == 1
+            assert result.mem_data[0].time == start and result.mem_data[0].count == 10
+            assert result.mem_data[0].used.mean == 4.5
+            assert result.mem_data[0].total.stddev == 0.0
+        result = stats.get_mem_stats(db, start, day, host=host)
+        assert result.mem_data == []
+
+    def test_upgraded_database(self, tmp_path):
+        """It tests the rollups of an older version (without the sums of squares and the
+        histograms) in a database which is upgraded have no stddev and no percentiles,
+        also after merging new samples into them"""
+        engine = create_engine(f"sqlite:///{tmp_path}/old.sqlite")
+        day = datetime.datetime(2020, 1, 1)
+        fields = ", ".join(f"{name}_{kind} FLOAT" for name in stats.STAT_FIELDS
+                           for kind in ("min", "max", "avg", "last"))
+        with engine.begin() as connection:
+            for table in ("MemoryRollup1m", "MemoryRollup1h", "MemoryRollup1d"):
+                connection.execute(text(
+                    f'CREATE TABLE "{table}" (host VARCHAR NOT NULL, time TIMESTAMP '
+                    f'NOT NULL, last_time TIMESTAMP, count INTEGER, {fields}, '
+                    f'PRIMARY KEY (host, time))'))
+            values = ", ".join(["1.0", "3.0", "2.0", "3.0"] * len(stats.STAT_FIELDS))
+            connection.execute(text(
+                f"INSERT INTO \"MemoryRollup1m\" VALUES ('old', "
+                f"'{day}.000000', '{day}.000000', 2, {values})"))
+        with engine.begin() as connection:
+            migrations.upgrade(connection)
+        Base.metadata.create_all(engine)
+        end = day + datetime.timedelta(minutes=2)
+        with Session(engine) as db:
+            crud.create_memories(db, [
+                schemas.MemCreate(host="old", time=day + datetime.timedelta(seconds=s),
+                                  free=2.0, used=2.0, total=2.0)
+                for s in (30, 60, 90)])
+            result = stats.get_mem_stats(db, day, end, percentiles=[50], bucket=60,
+                                         host="old")
+        engine.dispose()
+        merged, new = result.mem_data
+        assert (merged.count, merged.used.mean) == (3, 2.0)
+        assert merged.used.stddev is None and merged.used.percentiles == {}
+        assert new.count == 2 and new.used.stddev == 0.0
+        assert new.used.percentiles == {"p50": pytest.approx(2.0, rel=RELATIVE_ACCURACY)}